@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Проверка crash-consistency state.bin (MmapStore):
+#   kill — дочерний процесс делает put() и после каждого сообщает номер операции; в случайный момент
+#          убиваем его SIGKILL и открываем файл заново: каждая подтверждённая запись на месте
+#          (или заменена более поздней из неподтверждённых), флаг DIRTY замечен, таблица пересобрана
+#   torn — сбой ОС посреди записи: в закрытом файле ставим DIRTY и портим (нули или мусор) случайную
+#          страницу таблицы; файл должен открыться, записи вне испорченной страницы — уцелеть,
+#          а из мусора не должно появиться ни одного неизвестного chat_id
+#
+#   python bench/crash_mmap.py                 — 20 раундов каждого вида
+#   python bench/crash_mmap.py --rounds 100 --users 200000
+# Код возврата 1, если хоть одна проверка не прошла.
+
+import os
+import sys
+import mmap
+import shutil
+import random
+import signal
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from storage import MmapStore, _HEADER, _REC  # noqa: E402
+
+INTERVAL = 86400.0
+MAX_STEP = 200
+BASE_TS = 1_700_000_000  # last у операций: BASE_TS + номер (не от time.time() — иначе у процессов разные)
+
+
+def ops(seed: int, users: int, n: int) -> List[Tuple[int, int, int]]:
+    # Одинаковая последовательность put() у родителя и у дочернего процесса
+    rnd = random.Random(seed)
+    return [(100_000_000 + rnd.randrange(users), rnd.randint(1, MAX_STEP), BASE_TS + i) for i in range(n)]
+
+
+def child(path: str, seed: int, users: int, n: int, max_dirty: int) -> None:
+    store = MmapStore(path, INTERVAL, MAX_STEP, max_dirty=max_dirty)
+    store.load()
+    out = sys.stdout
+    for i, (cid, step, last) in enumerate(ops(seed, users, n)):
+        store.put(cid, step, last)
+        out.write(f"{i}\n")
+        out.flush()
+    store.close()
+    out.write("done\n")
+    out.flush()
+
+
+def kill_round(work: str, seed: int, users: int) -> List[str]:
+    rnd = random.Random(seed)
+    path = os.path.join(work, f"kill-{seed}.bin")
+    n = users * 2
+    max_dirty = rnd.choice((1, 50, 1000, 10 ** 9))
+    proc = subprocess.Popen([sys.executable, __file__, "--child", path, str(seed), str(users), str(n), str(max_dirty)],
+                            stdout=subprocess.PIPE, text=True)
+    stop_after = rnd.randrange(n // 20, n)
+    acked = -1
+    for line in proc.stdout:
+        if line.strip() == "done":
+            break
+        acked = int(line)
+        if acked >= stop_after:
+            break
+    proc.send_signal(signal.SIGKILL)
+    proc.wait()
+
+    seq = ops(seed, users, n)
+    expected: Dict[int, Tuple[int, int]] = {}
+    for cid, step, last in seq[:acked + 1]:
+        expected[cid] = (step, last)
+    later: Dict[int, set] = {}
+    for cid, step, last in seq[acked + 1:]:
+        later.setdefault(cid, set()).add((step, last))
+
+    store = MmapStore(path, INTERVAL, MAX_STEP)
+    store.load()
+    errors = []
+    for cid, want in expected.items():
+        got = store.get(cid)
+        if got != want and got not in later.get(cid, ()):
+            errors.append(f"kill seed={seed}: {cid} = {got}, ожидалось {want}")
+    known = {cid for cid, _, _ in seq}
+    phantom = [cid for cid, _, _ in store.iter_users() if cid not in known]
+    if phantom:
+        errors.append(f"kill seed={seed}: после пересборки {len(phantom)} неизвестных chat_id, например {phantom[:3]}")
+    extra = len(store) - len(expected)
+    if extra < 0 or extra > len(set(later) - set(expected)):
+        errors.append(f"kill seed={seed}: пользователей {len(store)}, подтверждено {len(expected)}")
+    if sum(store.count_by_step().values()) != len(store):
+        errors.append(f"kill seed={seed}: счётчики по урокам не сходятся с числом пользователей")
+    print(f"kill  seed={seed:<4} max_dirty={max_dirty:<10} подтверждено {acked + 1:>7} "
+          f"пересборка {'да' if store.stats['recovered'] else 'нет':<3} ошибок {len(errors)}")
+    store.close()
+    return errors
+
+
+def torn_round(work: str, seed: int, users: int) -> List[str]:
+    rnd = random.Random(seed)
+    path = os.path.join(work, f"torn-{seed}.bin")
+    store = MmapStore(path, INTERVAL, MAX_STEP)
+    store.load()
+    for cid, step, last in ops(seed, users, users):
+        store.put(cid, step, last)
+    store.close()
+    with open(path, "rb") as f:
+        raw = f.read()
+    header = MmapStore.HEADER_SIZE
+    slots = {}  # chat_id -> (смещение, значение)
+    for i, (cid, step, last, _) in enumerate(_REC.iter_unpack(raw[header:])):
+        if cid:
+            slots[cid] = (header + i * _REC.size, (step, last))
+
+    # «Сбой ОС»: флаг DIRTY успел попасть на диск, а одна страница таблицы — нет или наполовину
+    page = rnd.randrange(header // mmap.PAGESIZE, len(raw) // mmap.PAGESIZE + 1) * mmap.PAGESIZE
+    lo, hi = max(page, header), min(page + mmap.PAGESIZE, len(raw))
+    garbage = rnd.random() < 0.5
+    with open(path, "r+b") as f:
+        magic, version, _, capacity, count = _HEADER.unpack_from(raw, 0)
+        f.write(_HEADER.pack(magic, version, MmapStore.FLAG_DIRTY, capacity, count))
+        f.seek(lo)
+        f.write(os.urandom(hi - lo) if garbage else bytes(hi - lo))
+
+    store = MmapStore(path, INTERVAL, MAX_STEP)
+    errors = []
+    try:
+        store.load()
+    except Exception as e:
+        return [f"torn seed={seed}: не открылся: {e}"]
+    hit = 0
+    for cid, (off, want) in slots.items():
+        if off + _REC.size <= lo or off >= hi:
+            got = store.get(cid)
+            if got != want:
+                errors.append(f"torn seed={seed}: {cid} = {got}, ожидалось {want}")
+        else:
+            hit += 1
+    # мусорная страница не должна превращаться в «пользователей» со случайными chat_id
+    phantom = [cid for cid, _, _ in store.iter_users() if cid not in slots]
+    if phantom:
+        errors.append(f"torn seed={seed}: после пересборки {len(phantom)} неизвестных chat_id, например {phantom[:3]}")
+    if not store.stats["recovered"]:
+        errors.append(f"torn seed={seed}: флаг DIRTY не замечен")
+    store.close()
+    # после пересборки файл чистый: повторное открытие — без пересборки и с теми же данными
+    again = MmapStore(path, INTERVAL, MAX_STEP)
+    again.load()
+    if again.stats["recovered"] or len(again) != len(store):
+        errors.append(f"torn seed={seed}: повторное открытие не сошлось")
+    again.close()
+    print(f"torn  seed={seed:<4} {'мусор' if garbage else 'нули ':<5} страница {page:>9} "
+          f"задето записей {hit:>4} чужих {len(phantom):>3} ошибок {len(errors)}")
+    return errors
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        path, seed, users, n, max_dirty = sys.argv[2:7]
+        child(path, int(seed), int(users), int(n), int(max_dirty))
+        return
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=20)
+    ap.add_argument("--users", type=int, default=50000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="crash-mmap-")
+    errors: List[str] = []
+    try:
+        for r in range(args.rounds):
+            errors += kill_round(work, args.seed + r, args.users)
+        for r in range(args.rounds):
+            errors += torn_round(work, args.seed + r, args.users)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    for e in errors[:50]:
+        print(e)
+    if errors:
+        print(f"НЕ ПРОШЛО: {len(errors)} ошибок")
+        raise SystemExit(1)
+    print(f"OK: {args.rounds} × kill, {args.rounds} × torn")
+
+
+if __name__ == "__main__":
+    main()
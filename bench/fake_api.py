@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Локальная подмена Telegram Bot API для замеров: бот подключается через ApplicationBuilder().base_url.
+# Отвечает на getMe/getUpdates/sendMessage/... правдоподобным JSON и сообщает, когда в чат ушло сообщение.
+# Настраивается задержка ответа, доля ответов 429 (RetryAfter) и скорость приёма загружаемых файлов.
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from httpd import start_http_server  # noqa: E402
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+# Эти методы не считаются сообщениями пользователю: на них не отвечаем 429 и не будим expect_message
+SERVICE_METHODS = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "answerCallbackQuery"}
+
+
+def command_update(update_id: int, chat_id: int, text: str = "/start") -> Dict[str, Any]:
+    # Апдейт «пользователь написал команду» в формате Bot API
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> Dict[str, Any]:
+    # Апдейт «нажата inline-кнопка» под сообщением бота
+    chat = {"id": chat_id, "type": "private"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "урок"},
+        },
+    }
+
+
+def parse_multipart(body: bytes, ctype: str) -> Tuple[Dict[str, str], Dict[str, int]]:
+    # Поля формы и размеры файлов (имя файла -> байт); разбор ровно настолько, насколько нужно подмене
+    m = re.search(r'boundary="?([^";]+)"?', ctype)
+    if not m:
+        return {}, {}
+    fields: Dict[str, str] = {}
+    files: Dict[str, int] = {}
+    for part in body.split(b"--" + m.group(1).encode("latin-1")):
+        head, sep, content = part.partition(b"\r\n\r\n")
+        if not sep:
+            continue
+        content = content[:-2] if content.endswith(b"\r\n") else content
+        disp = head.decode("utf-8", "replace")
+        name = re.search(r'name="([^"]*)"', disp)
+        fname = re.search(r'filename="([^"]*)"', disp)
+        if fname:
+            files[fname.group(1)] = len(content)
+        elif name:
+            fields[name.group(1)] = content.decode("utf-8", "replace")
+    return fields, files
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1,
+                 upload_bps: float = 0.0) -> None:
+        self.latency = latency          # сек на каждый ответ
+        self.error_rate = error_rate    # доля отправок, на которые отвечаем 429
+        self.retry_after = retry_after  # сек в ответе 429
+        self.upload_bps = upload_bps    # байт/с при приёме файлов (0 — без ограничения)
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.base_url = ""
+        self.updates: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.waiters: Dict[int, List[Tuple[Optional[str], asyncio.Future]]] = {}  # chat_id -> [(метод, future)]
+        self.calls: Counter = Counter()
+        self.sent: Counter = Counter()  # chat_id -> сколько сообщений ушло в чат (ловим двойные отправки)
+        self.message_id = 0
+        self.uploaded_bytes = 0
+        self.file_ids: Dict[str, str] = {}  # имя загруженного файла -> выданный file_id
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        # сюда заливают файлы в мегабайты и гигабайты — лимиты служебного порта не подходят
+        self.server = await start_http_server(host, port, self.handle, max_body=1 << 40, timeout=None)
+        port = self.server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}/bot"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        self.updates.put_nowait(update)
+
+    def expect_message(self, chat_id: int, method: Optional[str] = None) -> "asyncio.Future[float]":
+        # Future завершится временем (perf_counter), когда боту ответят на первое сообщение в этот чат
+        # (method — только на сообщение этим методом, например sendDocument)
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(chat_id, []).append((method, fut))
+        return fut
+
+    def _message(self, chat_id: int, text: str = "") -> Dict[str, Any]:
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+
+    def _document(self, chat_id: int, params: Dict[str, str], files: Dict[str, int]) -> Dict[str, Any]:
+        msg = self._message(chat_id)
+        msg.pop("text")
+        if files:
+            name, size = next(iter(files.items()))
+            file_id = self.file_ids.setdefault(name, f"FAKEFILE{len(self.file_ids) + 1}")
+        else:
+            file_id, name, size = params.get("document", ""), "cached", 0
+        msg["document"] = {"file_id": file_id, "file_unique_id": file_id, "file_name": name, "file_size": size}
+        return msg
+
+    def _notify(self, chat_id: int, method: str) -> None:
+        now = time.perf_counter()
+        rest = []
+        for want, fut in self.waiters.pop(chat_id, []):
+            if want is not None and want != method:
+                rest.append((want, fut))
+            elif not fut.done():
+                fut.set_result(now)
+        if rest:
+            self.waiters[chat_id] = rest
+
+    async def _get_updates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        timeout = float(params.get("timeout", 0) or 0)
+        out: List[Dict[str, Any]] = []
+        try:
+            out.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return out
+        while not self.updates.empty() and len(out) < 100:
+            out.append(self.updates.get_nowait())
+        return out
+
+    async def call(self, method: str, params: Dict[str, str], files: Optional[Dict[str, int]] = None) -> Tuple[int, Any]:
+        if method == "getMe":
+            return 200, BOT_USER
+        if method == "getUpdates":
+            return 200, await self._get_updates(params)
+        if method not in SERVICE_METHODS and self.error_rate and random.random() < self.error_rate:
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        if method in ("sendMessage", "sendDocument", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            self.sent[chat_id] += 1
+            if method == "sendDocument":
+                msg = self._document(chat_id, params, files or {})
+            else:
+                msg = self._message(chat_id, params.get("text", ""))
+            self._notify(chat_id, method)
+            return 200, msg
+        return 200, True
+
+    async def handle(self, http_method: str, target: str, headers: Dict[str, str],
+                     body: bytes) -> Tuple[int, str, bytes]:
+        # /bot<token>/<method>
+        method = target.split("?", 1)[0].rsplit("/", 1)[-1]
+        self.calls[method] += 1
+        ctype = headers.get("content-type", "")
+        files: Dict[str, int] = {}
+        if body and "multipart" in ctype:
+            params, files = parse_multipart(body, ctype)
+        else:
+            params = dict(parse_qsl(body.decode("utf-8"))) if body and "urlencoded" in ctype else {}
+        if files:
+            self.uploaded_bytes += sum(files.values())
+            if self.upload_bps:
+                await asyncio.sleep(sum(files.values()) / self.upload_bps)
+        if self.latency and method != "getUpdates":
+            await asyncio.sleep(self.latency)
+        status, result = await self.call(method, params, files)
+        payload = {"ok": True, "result": result} if status == 200 else result
+        return status, "application/json", json.dumps(payload).encode("utf-8")
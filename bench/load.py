@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Нагрузочные сценарии: бот подключается к FakeBotAPI через base_url, замеряем пропускную способность
+# и задержку до первого сообщения в чат (p50/p95/p99).
+#
+#   python bench/load.py start    [--users 10000]            — лавина /start от новых пользователей
+#   python bench/load.py tick     [--users 100000]           — утренний tick: всем пора выдать урок
+#   python bench/load.py download [--users 200 --file-mb 5]  — одновременные нажатия «Скачать видео»
+#   python bench/load.py all                                 — все три, каждый в отдельном процессе
+#   python bench/load.py shards   [--users 20000 --workers 4] — рассылка несколькими процессами ROLE=delivery
+#                                  на общей state.db; --kill-one убивает один воркер на середине
+#
+# Общие ключи: --latency (сек на ответ API), --error-rate (доля 429), --upload-mbps, --api-rate
+# (лимит бота на отправки; по умолчанию снят, чтобы мерить сам бот, а не лимитер).
+
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_api import FakeBotAPI, callback_update, command_update  # noqa: E402
+from report import summarize, print_table  # noqa: E402
+
+SCENARIOS = ("start", "tick", "download")
+FIRST_CHAT = 10_000_000
+BOT = os.path.join(os.path.dirname(HERE), "bot.py")
+
+
+def prepare_env(args: argparse.Namespace) -> None:
+    # Всё окружение бота — до import bot: настройки читаются при импорте
+    work = tempfile.mkdtemp(prefix=f"bench-{args.scenario}-")
+    os.environ["BOT_TOKEN"] = "123456:TEST"
+    os.environ["DATA_DIR"] = os.path.join(work, "data")
+    os.environ["API_RATE"] = str(args.api_rate)
+    os.environ["API_BURST"] = str(args.api_rate)
+    os.environ.setdefault("OUTBOX_POLL", "1")
+    if args.scenario == "download":
+        # Отдельный каталог с одним уроком и файлом заданного размера
+        os.makedirs(os.path.join(work, "media"))
+        with open(os.path.join(work, "media", "bench.mp4"), "wb") as f:
+            chunk = b"\0" * (1024 * 1024)
+            for _ in range(args.file_mb):
+                f.write(chunk)
+        lessons = {"lessons": [{"title": "Замер", "video_file": "bench.mp4", "docs": []}]}
+        with open(os.path.join(work, "lessons.json"), "w", encoding="utf-8") as f:
+            json.dump(lessons, f)
+        os.environ["LESSONS_FILE"] = os.path.join(work, "lessons.json")
+        os.chdir(work)
+
+
+async def wait_all(futures: List["asyncio.Future[float]"], t0: float, timeout: float) -> List[float]:
+    done, _ = await asyncio.wait(futures, timeout=timeout)
+    return [f.result() - t0 for f in done]
+
+
+async def run(args: argparse.Namespace) -> Dict[str, float]:
+    import bot
+    api = FakeBotAPI(latency=args.latency, error_rate=args.error_rate,
+                     upload_bps=args.upload_mbps * 1024 * 1024 / 8)
+    base_url = await api.start()
+    app = bot.build_app(base_url)
+    chats = range(FIRST_CHAT, FIRST_CHAT + args.users)
+    async with app:
+        await bot.on_init(app)
+        await app.start()
+        await app.updater.start_polling(poll_interval=0.0, timeout=10)
+
+        if args.scenario == "tick":
+            past = time.time() - 2 * 86400
+            for cid in chats:
+                bot.STORE.put(cid, 1, past)
+            bot.STORE.flush()
+        # download: ждём сам документ, а не «Готовлю файл…» из очереди на заливку
+        method = "sendDocument" if args.scenario == "download" else None
+        futures = [api.expect_message(cid, method) for cid in chats]
+        t0 = time.perf_counter()
+        if args.scenario == "start":
+            for i, cid in enumerate(chats):
+                api.push_update(command_update(i + 1, cid))
+        elif args.scenario == "tick":
+            await bot.tick(SimpleNamespace(job_queue=app.job_queue, bot=app.bot))
+        else:
+            for i, cid in enumerate(chats):
+                api.push_update(callback_update(i + 1, cid, "dl_video_1"))
+        latencies = await wait_all(futures, t0, args.timeout)
+        elapsed = time.perf_counter() - t0
+
+        await app.updater.stop()
+        await bot.on_stop(app)
+        await app.stop()
+    await api.stop()
+    row = summarize(latencies, elapsed)
+    row["lost"] = args.users - len(latencies)
+    row["uploaded_mb"] = api.uploaded_bytes / 1024 / 1024
+    row["calls"] = dict(api.calls)
+    row["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return row
+
+
+def _leases_settled(path: str, workers: int, shards: int) -> bool:
+    # Все воркеры живы и части поделены поровну (не больше ceil(shards / workers) на каждого)
+    try:
+        with open(path, encoding="utf-8") as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        return False
+    owners = [owner for owner, _ in table["shards"].values()]
+    return (len(table["workers"]) == workers and len(owners) == shards
+            and max(owners.count(w) for w in set(owners)) <= -(-shards // workers))
+
+
+async def run_shards(args: argparse.Namespace) -> Dict[str, Any]:
+    from storage import SqliteStore
+    api = FakeBotAPI(latency=args.latency, error_rate=args.error_rate)
+    base_url = await api.start()
+    data = os.environ["DATA_DIR"]
+    os.makedirs(data, exist_ok=True)
+    env = dict(os.environ, STORAGE="sqlite", ROLE="delivery", DELIVERY_SHARDS=str(args.shards),
+               LEASE_TTL=str(args.lease_ttl), BOT_API_BASE_URL=base_url)
+    worker_log = open(os.path.join(data, "workers.log"), "w")
+    procs = [subprocess.Popen([sys.executable, BOT], env=dict(env, WORKER_ID=f"w{i}"),
+                              stdout=worker_log, stderr=subprocess.STDOUT) for i in range(args.workers)]
+    try:
+        # Пользователей добавляем, когда части уже поделены: иначе первый поднявшийся заберёт всех
+        deadline = time.time() + 120
+        while not _leases_settled(os.path.join(data, "leases.json"), args.workers, args.shards):
+            if time.time() > deadline:
+                raise SystemExit(f"части не поделились, см. {worker_log.name}")
+            await asyncio.sleep(0.2)
+        chats = range(FIRST_CHAT, FIRST_CHAT + args.users)
+        futures = [api.expect_message(cid) for cid in chats]
+        store = SqliteStore(os.path.join(data, "state.db"), 86400, 1000, max_dirty=10 ** 9)
+        past = time.time() - 2 * 86400
+        t0 = time.perf_counter()
+        for cid in chats:
+            store.put(cid, 1, past)
+        store.close()
+
+        killed = ""
+        if args.kill_one:
+            while sum(f.done() for f in futures) < args.users // 2:
+                await asyncio.sleep(0.05)
+            procs[0].send_signal(signal.SIGKILL)
+            killed = "w0"
+        latencies = await wait_all(futures, t0, args.timeout)
+        elapsed = time.perf_counter() - t0
+        await asyncio.sleep(args.lease_ttl)  # вдруг кто-то дошлёт повторно
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(signal.SIGTERM)
+        for p in procs:
+            p.wait()
+        worker_log.close()
+        await api.stop()
+    row: Dict[str, Any] = summarize(latencies, elapsed)
+    row["lost"] = args.users - len(latencies)
+    row["duplicates"] = sum(n - 1 for cid, n in api.sent.items() if n > 1)
+    row["killed"] = killed
+    return row
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("scenario", choices=SCENARIOS + ("shards", "all"))
+    ap.add_argument("--users", type=int, default=0,
+                    help="по умолчанию: start 10000, tick 100000, download 200, shards 20000")
+    ap.add_argument("--latency", type=float, default=0.0, help="сек на ответ Bot API")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="доля отправок с ответом 429")
+    ap.add_argument("--upload-mbps", type=float, default=100.0, help="скорость приёма файлов, Мбит/с")
+    ap.add_argument("--file-mb", type=int, default=5, help="размер файла для download, МБ")
+    ap.add_argument("--api-rate", type=float, default=100000, help="API_RATE бота (28 — как в проде)")
+    ap.add_argument("--timeout", type=float, default=600, help="сек на сценарий")
+    ap.add_argument("--workers", type=int, default=4, help="shards: процессов ROLE=delivery")
+    ap.add_argument("--shards", type=int, default=16, help="shards: DELIVERY_SHARDS")
+    ap.add_argument("--lease-ttl", type=float, default=3, help="shards: LEASE_TTL воркеров, сек")
+    ap.add_argument("--kill-one", action="store_true", help="shards: убить один воркер на середине рассылки")
+    ap.add_argument("--json", action="store_true", help="вывести итог одной строкой JSON")
+    args = ap.parse_args()
+
+    if args.scenario == "all":
+        # бот — модуль с глобальным состоянием, поэтому каждый сценарий в своём процессе
+        rows: Dict[str, Dict[str, Any]] = {}
+        passthrough = [a for a in sys.argv[2:] if a != "--json"]
+        for name in SCENARIOS:
+            out = subprocess.run([sys.executable, __file__, name, "--json"] + passthrough,
+                                 check=True, capture_output=True, text=True).stdout
+            rows[name] = json.loads(out.strip().splitlines()[-1])
+        print_table(rows)
+        return
+
+    args.users = args.users or {"start": 10000, "tick": 100000, "download": 200, "shards": 20000}[args.scenario]
+    prepare_env(args)
+    row = asyncio.run(run_shards(args) if args.scenario == "shards" else run(args))
+    if args.json:
+        print(json.dumps(row))
+    else:
+        print_table({f"{args.scenario} ×{args.users}": row})
+        if args.scenario == "shards":
+            print(f"потеряно: {row['lost']}, повторных отправок: {row['duplicates']}"
+                  + (f", убит {row['killed']}" if row["killed"] else ""))
+        else:
+            print(f"потеряно: {row['lost']}, загружено {row['uploaded_mb']:.1f} МБ, "
+                  f"пик RSS {row['peak_rss_mb']:.0f} МБ (бот и подмена API), вызовы API: {row['calls']}")
+
+
+if __name__ == "__main__":
+    main()
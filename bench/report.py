@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Общие помощники для замеров: перцентили и печать итогов.
+
+from typing import Dict, List
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(p / 100 * (len(s) - 1)))))
+    return s[k]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    # latencies — в секундах; в отчёте миллисекунды и операции в секунду
+    n = len(latencies)
+    return {
+        "n": n,
+        "throughput": n / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def print_table(rows: Dict[str, Dict[str, float]]) -> None:
+    cols = ["n", "throughput", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    print(f"{'сценарий':<28}" + "".join(f"{c:>12}" for c in cols))
+    for name, r in rows.items():
+        print(f"{name:<28}" + "".join(f"{r.get(c, 0):>12.1f}" for c in cols))
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# Микробенчмарки хранилища на синтетических пользователях: загрузка, полный снимок, сброс пачки,
+# регистрация в users.csv и подсчёт по урокам. Каждая операция — в отдельном процессе на свежей
+# копии данных, чтобы пиковый RSS и записанные байты относились только к ней.
+#
+#   python bench/storage_bench.py                        — таблица для 10k/100k/1M, json, sqlite и mmap
+#   python bench/storage_bench.py --sizes 10000,100000 --storage json
+#   python bench/storage_bench.py --save-baseline        — записать bench/baselines/storage.json
+#   python bench/storage_bench.py --check                — сравнить с базой, код 1 при регрессии
+#   python bench/storage_bench.py --memory               — байт на пользователя: UserTable против dict
+#   python bench/storage_bench.py --cold-start           — загрузка JsonStore: state.json против state.snap
+#                                                          (и state.snap + журнал на пороге сжатия)
+#
+# Метрики: wall_ms — время самой операции; rss_mb — пиковый RSS процесса (вместе с загрузкой данных);
+# bytes — записано процессом за время операции (wchar из /proc/self/io, где он есть).
+# У mmap load_state — только открытие файла; расписание строится в фоне (index_ms — его длительность).
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from storage import (  # noqa: E402
+    JOURNAL_HEADER, JsonStore, MmapStore, SqliteStore, Store, UserRegistry, UserTable, journal_records, ts_to_iso,
+)
+
+BASELINE = os.path.join(HERE, "baselines", "storage.json")
+SIZES = (10_000, 100_000, 1_000_000)
+COLD_SIZES = (100_000, 1_000_000)
+STORAGES = ("json", "sqlite", "mmap")
+OPS = ("load_state", "save_state", "flush_1k", "append_user_csv", "stats_counts")
+INTERVAL = 86400.0
+MAX_STEP = 4
+BATCH = 1000
+# Ниже этих абсолютных разниц изменение не считается регрессией (шум измерений)
+FLOORS = {"wall_ms": 5.0, "rss_mb": 5.0, "bytes": 4096}
+
+
+def make_store(d: str, storage: str, migrate: bool = False) -> Store:
+    js = JsonStore(os.path.join(d, "state.json"), os.path.join(d, "state.journal"), INTERVAL, MAX_STEP,
+                   max_dirty=10 ** 9)
+    if storage == "sqlite":
+        return SqliteStore(os.path.join(d, "state.db"), INTERVAL, MAX_STEP, max_dirty=10 ** 9,
+                           migrate_from=js if migrate else None)
+    if storage == "mmap":
+        return MmapStore(os.path.join(d, "state.bin"), INTERVAL, MAX_STEP, max_dirty=10 ** 9,
+                         migrate_from=js if migrate else None)
+    return js
+
+
+def generate(d: str, n: int, storage: str) -> None:
+    # Синтетика: шаги 1..4, последний урок — за последние 3 суток
+    os.makedirs(d)
+    rnd = random.Random(n)
+    now = time.time()
+    js = make_store(d, "json")
+    js.load()
+    with open(os.path.join(d, "users.csv"), "w", encoding="utf-8") as f:
+        for i in range(n):
+            cid = 100_000_000 + i
+            js.put(cid, rnd.randint(1, MAX_STEP), now - rnd.random() * 3 * 86400)
+            f.write(f"{cid},{datetime.fromtimestamp(now - i).isoformat()}\n")
+    js.save()
+    if storage != "json":
+        db = make_store(d, storage, migrate=True)
+        db.load()
+        db.close()
+
+
+def io_written() -> Optional[int]:
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb() -> float:
+    # VmHWM сбрасывается при exec, а ru_maxrss на Linux наследует пик родителя
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_op(op: str, d: str, storage: str, n: int) -> Dict[str, Any]:
+    # Выполняется в дочернем процессе
+    extra: Dict[str, Any] = {}
+    store = make_store(d, storage)
+    if op != "load_state":
+        store.load()
+    w0, t0 = io_written(), time.perf_counter()
+    if op == "load_state":
+        store.load()
+        if isinstance(store, MmapStore):
+            wall = time.perf_counter() - t0
+            store.count_by_step()  # дождаться фонового построения расписания
+            extra["index_ms"] = store.stats["index_ms"]
+            t0 = time.perf_counter() - wall
+    elif op == "save_state":
+        if not isinstance(store, JsonStore):
+            return {"skipped": f"полного снимка у {storage} нет"}
+        store.save()
+    elif op == "flush_1k":
+        now = time.time()
+        for i in range(BATCH):
+            store.put(100_000_000 + i * (n // BATCH or 1), 2, now)
+        store.flush()
+    elif op == "append_user_csv":
+        reg = UserRegistry(os.path.join(d, "users.csv"), max_pending=10 ** 9)
+        reg.load()
+        w0, t0 = io_written(), time.perf_counter()
+        when = datetime.now()
+        for i in range(BATCH):
+            reg.add(900_000_000 + i, when)
+        reg.flush()
+        extra["per_add_us"] = (time.perf_counter() - t0) / BATCH * 1e6
+    elif op == "stats_counts":
+        # быстрая операция — лучшее из пяти, иначе шум планировщика ОС сравним с ней самой
+        best = float("inf")
+        for _ in range(5):
+            t1 = time.perf_counter()
+            store.count_by_step()
+            best = min(best, time.perf_counter() - t1)
+        t0 = time.perf_counter() - best
+    wall = time.perf_counter() - t0
+    w1 = io_written()
+    store.close()
+    return dict(extra, wall_ms=wall * 1000,
+                rss_mb=peak_rss_mb(),
+                bytes=(w1 - w0) if w0 is not None and w1 is not None else None)
+
+
+def measure(data: str, storage: str, n: int, op: str) -> Dict[str, Any]:
+    work = tempfile.mkdtemp(prefix="storage-op-")
+    try:
+        d = os.path.join(work, "d")
+        shutil.copytree(data, d)
+        out = subprocess.run([sys.executable, __file__, "--child", op, d, storage, str(n)],
+                             check=True, capture_output=True, text=True).stdout
+        return json.loads(out.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def run_all(sizes: List[int], storages: List[str]) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    root = tempfile.mkdtemp(prefix="storage-bench-")
+    try:
+        for storage in storages:
+            for n in sizes:
+                data = os.path.join(root, f"{storage}-{n}")
+                t0 = time.perf_counter()
+                generate(data, n, storage)
+                print(f"# {storage} {n}: данные за {time.perf_counter() - t0:.1f} с", file=sys.stderr)
+                for op in OPS:
+                    r = measure(data, storage, n, op)
+                    if "skipped" not in r:
+                        results[f"{storage}/{n}/{op}"] = r
+                shutil.rmtree(data, ignore_errors=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def _legacy_users(n: int, now: float) -> Dict[str, Dict[str, Any]]:
+    # Как было в bot.py: USERS[str(chat_id)] = {"step": int, "last": datetime}
+    return {str(100_000_000 + i): {"step": 1 + i % MAX_STEP, "last": datetime.fromtimestamp(now - i)}
+            for i in range(n)}
+
+
+def _tuple_users(n: int, now: float) -> Dict[int, Tuple[int, float]]:
+    # JsonStore до UserTable: {chat_id: (step, last)}
+    return {100_000_000 + i: (1 + i % MAX_STEP, now - i) for i in range(n)}
+
+
+def _table_users(n: int, now: float) -> UserTable:
+    t = UserTable()
+    for i in range(n):
+        t.set(100_000_000 + i, 1 + i % MAX_STEP, int(now - i))
+    return t
+
+
+def memory_bench(sizes: List[int]) -> None:
+    # Сколько памяти занимает таблица пользователей (tracemalloc: только живые объекты самой таблицы)
+    kinds = (("dict+datetime (старый USERS)", _legacy_users), ("dict кортежей", _tuple_users),
+             ("UserTable", _table_users))
+    print(f"{'представление':<32}{'пользователей':>14}{'МБ':>10}{'байт/польз.':>14}")
+    now = time.time()
+    for n in sizes:
+        for name, build in kinds:
+            tracemalloc.start()
+            users = build(n, now)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del users
+            print(f"{name:<32}{n:>14}{size / 1024 / 1024:>10.1f}{size / n:>14.1f}")
+
+
+def write_journal(d: str, n: int) -> int:
+    # Журнал чуть меньше порога сжатия (compact_ratio 1.0 × размер снимка): худший случай при старте.
+    # Записи — смена урока у случайных пользователей, как их пишет JsonStore.flush()
+    limit = os.path.getsize(os.path.join(d, "state.snap"))
+    rnd = random.Random(n)
+    now = int(time.time())
+    count = (limit - len(JOURNAL_HEADER)) // 24 - 1
+    rows = [(100_000_000 + rnd.randrange(n), rnd.randint(1, MAX_STEP), now - rnd.randrange(86400))
+            for _ in range(count)]
+    with open(os.path.join(d, "state.journal"), "wb") as f:
+        f.write(JOURNAL_HEADER + journal_records(rows))
+    return count
+
+
+def cold_start_bench(sizes: List[int]) -> None:
+    # Один и тот же набор пользователей в прежнем state.json и в бинарном state.snap (журнал пуст),
+    # затем state.snap + журнал на пороге сжатия; каждый load_state — в свежем процессе (measure)
+    print(f"{'пользователей':>14}{'state.json, мс':>16}{'state.snap, мс':>16}{'быстрее':>10}"
+          f"{'json МБ':>10}{'snap МБ':>10}{'+журнал, мс':>13}{'записей':>9}")
+    root = tempfile.mkdtemp(prefix="cold-start-")
+    try:
+        for n in sizes:
+            snap_dir, json_dir = os.path.join(root, f"snap-{n}"), os.path.join(root, f"json-{n}")
+            generate(snap_dir, n, "json")
+            os.makedirs(json_dir)
+            js = make_store(snap_dir, "json")
+            js.load()
+            legacy = {str(cid): {"step": step, "last": ts_to_iso(last)} for cid, step, last in js.iter_users()}
+            with open(os.path.join(json_dir, "state.json"), "w", encoding="utf-8") as f:
+                json.dump(legacy, f, ensure_ascii=False, separators=(",", ":"))
+            del legacy, js
+            old = measure(json_dir, "json", n, "load_state")
+            new = measure(snap_dir, "json", n, "load_state")
+            lines = write_journal(snap_dir, n)
+            journal = measure(snap_dir, "json", n, "load_state")
+            print(f"{n:>14}{old['wall_ms']:>16.0f}{new['wall_ms']:>16.0f}{old['wall_ms'] / new['wall_ms']:>9.1f}×"
+                  f"{os.path.getsize(os.path.join(json_dir, 'state.json')) / 1e6:>10.1f}"
+                  f"{os.path.getsize(os.path.join(snap_dir, 'state.snap')) / 1e6:>10.1f}"
+                  f"{journal['wall_ms']:>13.0f}{lines:>9}")
+            shutil.rmtree(snap_dir, ignore_errors=True)
+            shutil.rmtree(json_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def print_results(results: Dict[str, Dict[str, Any]]) -> None:
+    print(f"{'замер':<34}{'wall_ms':>12}{'rss_mb':>10}{'bytes':>14}{'µs/добавл.':>12}")
+    for key, r in results.items():
+        b = "—" if r.get("bytes") is None else str(r["bytes"])
+        per = f"{r['per_add_us']:.1f}" if "per_add_us" in r else ""
+        print(f"{key:<34}{r['wall_ms']:>12.1f}{r['rss_mb']:>10.1f}{b:>14}{per:>12}")
+
+
+def compare(results: Dict[str, Dict[str, Any]], base: Dict[str, Dict[str, Any]],
+            tolerance: float) -> List[Tuple[str, str, float, float]]:
+    regressions = []
+    for key, r in results.items():
+        b = base.get(key)
+        if b is None:
+            continue
+        for metric, floor in FLOORS.items():
+            new, old = r.get(metric), b.get(metric)
+            if new is None or old is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > floor:
+                regressions.append((key, metric, old, new))
+    return regressions
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        op, d, storage, n = sys.argv[2:6]
+        print(json.dumps(run_op(op, d, storage, int(n))))
+        return
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", help=f"по умолчанию {','.join(map(str, SIZES))}, для --cold-start "
+                                    f"{','.join(map(str, COLD_SIZES))}")
+    ap.add_argument("--storage", default=",".join(STORAGES))
+    ap.add_argument("--baseline", default=BASELINE, help="файл с базовыми результатами")
+    ap.add_argument("--save-baseline", action="store_true", help="записать результаты как базу")
+    ap.add_argument("--check", action="store_true", help="сравнить с базой и вернуть 1 при регрессии")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="допустимое ухудшение (0.25 = +25%%)")
+    ap.add_argument("--out", help="сохранить результаты в JSON")
+    ap.add_argument("--memory", action="store_true", help="только замер памяти таблицы пользователей")
+    ap.add_argument("--cold-start", action="store_true", help="только загрузка: state.json против state.snap")
+    args = ap.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")] if args.sizes else list(COLD_SIZES if args.cold_start else SIZES)
+
+    if args.memory:
+        memory_bench(sizes)
+        return
+    if args.cold_start:
+        cold_start_bench(sizes)
+        return
+
+    results = run_all(sizes, args.storage.split(","))
+    print_results(results)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        base = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                base = json.load(f)
+        base.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(base, f, indent=1, sort_keys=True)
+        print(f"База обновлена: {args.baseline}")
+    if args.check:
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+        regressions = compare(results, base, args.tolerance)
+        for key, metric, old, new in regressions:
+            print(f"РЕГРЕССИЯ {key} {metric}: {old:.1f} -> {new:.1f}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"Регрессий нет (допуск {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
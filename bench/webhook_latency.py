@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Сквозная задержка обработки /start: вебхук против long polling на локальной подмене Bot API.
+# Замеряем время от доставки апдейта боту до первого sendMessage в этот чат.
+#
+#   python bench/webhook_latency.py [-n 200]
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench-webhook-"))
+os.environ.setdefault("API_RATE", "100000")  # меряем обработку, а не собственный лимитер бота
+os.environ.setdefault("API_BURST", "100000")
+
+import bot  # noqa: E402
+from fake_api import FakeBotAPI, command_update  # noqa: E402
+from report import summarize, print_table  # noqa: E402
+
+SECRET = "bench-secret"
+
+
+async def run(mode: str, n: int, port: int) -> dict:
+    api = FakeBotAPI()
+    base_url = await api.start()
+    app = bot.build_app(base_url)
+    latencies = []
+    async with app:
+        await bot.on_init(app)
+        await app.start()
+        if mode == "webhook":
+            await app.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path="telegram", secret_token=SECRET,
+                webhook_url=f"http://127.0.0.1:{port}/telegram",
+            )
+        else:
+            await app.updater.start_polling(poll_interval=0.0, timeout=10)
+        started = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            for i in range(n):
+                chat_id = 10_000_000 + i  # каждый раз новый пользователь
+                upd = command_update(i + 1, chat_id)
+                got = api.expect_message(chat_id)
+                t0 = time.perf_counter()
+                if mode == "webhook":
+                    r = await client.post(f"http://127.0.0.1:{port}/telegram", json=upd,
+                                          headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                    r.raise_for_status()
+                else:
+                    api.push_update(upd)
+                latencies.append(await asyncio.wait_for(got, 10) - t0)
+        elapsed = time.perf_counter() - started
+        await app.updater.stop()
+        await bot.on_stop(app)
+        await app.stop()
+    await api.stop()
+    return summarize(latencies, elapsed)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=200, help="сколько апдейтов отправить в каждом режиме")
+    ap.add_argument("--port", type=int, default=18443, help="порт вебхука")
+    args = ap.parse_args()
+    rows = {}
+    for mode in ("polling", "webhook"):
+        rows[mode] = asyncio.run(run(mode, args.n, args.port))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,36 @@
 # -*- coding: utf-8 -*-
 # Бот: YouTube + скачивание оригиналов по кнопкам (без авто-видео/превью).
-# Выдаёт следующий урок каждые 24 часа (JobQueue).
-# Требуется: python-telegram-bot[job-queue]==20.7  (эта строка должна быть в requirements.txt)
+# Выдаёт следующий урок каждые 24 часа (JobQueue, куча по времени выдачи).
+# Требуется: python-telegram-bot[job-queue,webhooks]==20.7  (эта строка должна быть в requirements.txt)
 
 import os
-import re
-import csv
 import json
+import time
+import signal
+import socket
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Tuple
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
+    Application, ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
 )
 
+from catalog import Catalog, CatalogError, MediaFile, MediaIndex, load_catalog
+from delivery import RateLimiter, DeliveryEngine, Outbox
+from export import USAGE as EXPORT_USAGE, ExportFilter, parse_filter, write_export
+from httpd import start_http_server, routes
+import metrics
+import profiler
+from profiler import Profiler, format_report
+from shards import ShardLeases
+from storage import Store, JsonStore, MmapStore, SqliteStore, UserRegistry, atomic_write
+from timeseries import TimeSeries, sparkline
+from uploads import StreamingInputFile, UploadGate
+
 logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO)
 log = logging.getLogger("bot")
 
@@ -24,179 +39,380 @@ TOKEN = (os.getenv("BOT_TOKEN") or os.getenv("TOKEN") or "").strip()
 YOUR_USERNAME = os.getenv("YOUR_USERNAME", "vadimpobedniy")
 
 # Постоянное хранилище (Railway Volume смонтируй в /app/data)
-DATA_DIR = "/app/data"
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 os.makedirs(DATA_DIR, exist_ok=True)
-STATE_FILE = os.path.join(DATA_DIR, "state.json")
+STATE_FILE = os.path.join(DATA_DIR, "state.json")  # прежний формат: читается для переноса в state.snap
+DB_FILE    = os.path.join(DATA_DIR, "state.db")
+BIN_FILE   = os.path.join(DATA_DIR, "state.bin")
+STORAGE    = os.getenv("STORAGE", "json").strip().lower()  # json | sqlite | mmap
 USERS_CSV  = os.path.join(DATA_DIR, "users.csv")
+FILE_IDS_FILE = os.path.join(DATA_DIR, "file_ids.json")  # кэш file_id загруженных в Telegram файлов
+SERIES_FILE = os.path.join(DATA_DIR, "timeseries.json")  # старты/выдачи по часам и дням для /stats
+
+# Отложенная запись состояния: сбрасываем изменения пачкой раз в N секунд или при накоплении M изменений
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5"))
+STATE_MAX_DIRTY = int(os.getenv("STATE_MAX_DIRTY", "500"))
+
+# Журнал изменений: сброс дописывает строки в state.journal, а state.snap — бинарный снимок.
+# Снимок пересобирается в фоне, когда журнал вырос больше RATIO × размер снимка (но не меньше MIN байт)
+JOURNAL_FILE = os.path.join(DATA_DIR, "state.journal")
+JOURNAL_COMPACT_RATIO = float(os.getenv("JOURNAL_COMPACT_RATIO", "1.0"))
+JOURNAL_COMPACT_MIN = int(os.getenv("JOURNAL_COMPACT_MIN", str(1024 * 1024)))
+
+# Рассылка: воркеры и лимиты Bot API (общий ~30 сообщений/с, в один чат — 1/с с небольшим запасом)
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+API_RATE = float(os.getenv("API_RATE", "28"))
+API_BURST = float(os.getenv("API_BURST", "30"))
+CHAT_RATE = float(os.getenv("CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("CHAT_BURST", "3"))
+API_MAX_INFLIGHT = int(os.getenv("API_MAX_INFLIGHT", "16"))  # одновременных запросов к Bot API (0 — без ограничения)
+OUTBOX_FILE = os.path.join(DATA_DIR, "outbox.json")  # уроки, которые ещё надо доставить
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "5"))   # сек: как часто забирать повторы из outbox
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+
+# Заливка файлов по кнопкам: потоком с диска, не больше UPLOAD_CONCURRENCY одновременно и не больше
+# UPLOAD_BUDGET_MB в полёте; остальные ждут в очереди с сообщением «Готовлю файл…»
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+UPLOAD_BUDGET_MB = float(os.getenv("UPLOAD_BUDGET_MB", "2048"))
+
+# Шардированная рассылка на несколько процессов (нужен STORAGE=sqlite на общем volume):
+# DELIVERY_SHARDS=N делит пользователей на N частей по chat_id, части распределяются между живыми
+# процессами через DATA_DIR/leases.json. ROLE: all — апдейты и рассылка, updates — только апдейты
+# (обработчики команд), delivery — только рассылка. Например, один «ROLE=updates» и несколько
+# «ROLE=delivery WORKER_ID=d1 …» с одинаковым DELIVERY_SHARDS. 0 — один процесс, как раньше.
+# WORKER_ID процесса рассылки должен переживать перезапуск: по нему называется его outbox-<id>.json
+DELIVERY_SHARDS = int(os.getenv("DELIVERY_SHARDS", "0"))
+ROLE = os.getenv("ROLE", "all").strip().lower()  # all | updates | delivery
+WORKER_ID = os.getenv("WORKER_ID", "").strip() or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_FILE = os.path.join(DATA_DIR, "leases.json")
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))  # сек: без продления части переходят к другим
+
+# Режим получения апдейтов: если задан WEBHOOK_URL — вебхук (run_webhook), иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")  # публичный адрес, например https://bot.up.railway.app
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8443")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")  # свой путь на каждого бота
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()  # проверяется по X-Telegram-Bot-Api-Secret-Token
+
+# Служебный HTTP (/health, /metrics в формате Prometheus): включается, если задан SERVICE_PORT
+SERVICE_LISTEN = os.getenv("SERVICE_LISTEN", "0.0.0.0")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "0"))
+
+# Профилирование обработчиков и tick (PROFILE=1): операции дольше PROFILE_SLOW_MS пишутся в slow.log,
+# /slow показывает самые медленные. PROFILE_CPROFILE=N — cProfile каждой N-й минуты (0 — выключен)
+PROFILE = os.getenv("PROFILE", "").strip().lower() in ("1", "true", "yes")
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))
+PROFILE_CPROFILE = int(os.getenv("PROFILE_CPROFILE", "0"))
+SLOW_LOG = os.path.join(DATA_DIR, "slow.log")
+
+# Описание уроков: DATA_DIR/lessons.json (правится на volume без деплоя), иначе lessons.json рядом с ботом.
+# Кандидаты в DATA_DIR проверяются на каждом опросе catalog_job: файл, положенный на volume
+# после старта, подхватывается без перезапуска
+def find_lessons_file() -> str:
+    return os.getenv("LESSONS_FILE") or next(
+        (p for p in (os.path.join(DATA_DIR, "lessons.json"), os.path.join(DATA_DIR, "lessons.toml"))
+         if os.path.exists(p)),
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "lessons.json"),
+    )
+
+LESSONS_FILE = find_lessons_file()
+CATALOG_POLL = float(os.getenv("CATALOG_POLL", "30"))  # сек: как часто проверять mtime файла уроков
 
-# Админы (кому доступны /users /stuck1 /stats /checkfiles /exportusers)
+# Админы (кому доступны /users /stuck1 /stats /checkfiles /exportusers /catalog /slow)
 ADMIN_IDS = {"444338007"}  # добавь ещё ID при необходимости
 
 if not TOKEN:
     log.error("Не задан BOT_TOKEN в Railway → Variables.")
     raise SystemExit(1)
 
-# Где ищем файлы уроков: сначала в media/, затем в корне репо
+if ROLE not in ("all", "updates", "delivery"):
+    log.error(f"ROLE={ROLE}: допустимо all, updates или delivery")
+    raise SystemExit(1)
+if (DELIVERY_SHARDS or ROLE != "all") and (STORAGE != "sqlite" or DELIVERY_SHARDS < 1):
+    log.error("Несколько процессов рассылки: нужны STORAGE=sqlite и DELIVERY_SHARDS >= 1")
+    raise SystemExit(1)
+if DELIVERY_SHARDS and ROLE != "updates" and not os.getenv("WORKER_ID", "").strip():
+    # имя по умолчанию (хост-pid) меняется при каждом запуске: прежний outbox с попытками и паузами
+    # никто бы не прочитал, а файлы копились бы в DATA_DIR
+    log.error("При DELIVERY_SHARDS задай каждому процессу рассылки постоянный WORKER_ID (d1, d2, …)")
+    raise SystemExit(1)
+
+# Где ищем файлы уроков: сначала в media/, затем в корне репо.
+# Индекс строится при старте и обновляется фоновой задачей — в обработчиках только поиск по словарю
 SEARCH_DIRS: List[str] = ["media", "."]
+MEDIA_POLL = float(os.getenv("MEDIA_POLL", "30"))       # сек: проверка mtime каталогов
+MEDIA_RESCAN = float(os.getenv("MEDIA_RESCAN", "300"))  # сек: полный проход (ловит замену файла на месте)
+MEDIA = MediaIndex(SEARCH_DIRS, full_rescan=MEDIA_RESCAN)
+MEDIA.scan()
 
 def find_path(filename: Optional[str]) -> Optional[str]:
     if not filename:
         return None
-    for base in SEARCH_DIRS:
-        path = os.path.join(base, filename) if base != "." else filename
-        if os.path.exists(path):
-            return path
-    return None
-
-# ===== УРОКИ =====
-LESSONS: Dict[int, Dict[str, Any]] = {
-    1: {
-        "title": "Урок 1: Цена тени",
-        "youtube": "https://youtu.be/ssLtF2UIVVc",
-        "video_file": "lesson1.mp4",
-        "docs": [],
-        "links": [
-            ("🧭 Получить разбор (Evolution)", "https://evolution.life/p/vadimpobedniy/products"),
-            ("ℹ️ Что такое Evolution? (видео)", "https://youtu.be/jjq8STmDlf4?si=EQ9imb8Pw2lE9FTB"),
-            ("📩 Связаться с Вадимом", f"https://t.me/{YOUR_USERNAME}"),
-        ],
-        "final_note": None,
-    },
-    2: {
-        "title": "Урок 2: Обнуляем страх",
-        "youtube": "https://youtu.be/wRysU2M19vI",
-        "video_file": "lesson2.mp4",
-        "docs": ["podcast_30_questions.pdf"],
-        "links": [("📩 Связаться с Вадимом", f"https://t.me/{YOUR_USERNAME}")],
-        "final_note": None,
-    },
-    3: {
-        "title": "Урок 3: Говори так, чтобы тебя слушали",
-        "youtube": "https://youtu.be/zc5NLQ3y_68",
-        "video_file": "lesson3.mp4",
-        "docs": [],
-        "links": [("📩 Связаться с Вадимом", f"https://t.me/{YOUR_USERNAME}")],
-        "final_note": None,
-    },
-    4: {
-        "title": "Урок 4: Выход в эфир = рост возможностей",
-        "youtube": "https://youtu.be/YoNxh203KCE",
-        "video_file": "lesson4.mp4",
-        "docs": ["open any door.pdf"],  # проверь точное имя
-        "links": [
-            ("📩 Связаться с Вадимом", f"https://t.me/{YOUR_USERNAME}"),
-            ("🎵 «Маленькие шаги»", "https://youtu.be/-orqHfJdo3E?si=7sCs_q7KTyd0rD8i"),
-            ("📺 Подписаться на YouTube «Главный Герой»", "https://www.youtube.com/@Protagonistofgame"),
-        ],
-        "final_note": (
-            "Благодарю за то, что был со мной эти четыре дня. Я верю в твой успех. "
-            "Начинай записывать видео — и у тебя всё обязательно получится.\n\n"
-            "Открыт к предложениям по совместным эфирам, подкастам и другим взаимодействиям. Я на связи."
-        ),
-    },
-}
+    return MEDIA.get(filename).path
 
-# ===== ПРОГРЕСС ПОЛЬЗОВАТЕЛЕЙ =====
-USERS: Dict[str, Dict[str, Any]] = {}  # chat_id -> {"step": int, "last": datetime}
+async def media_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if await asyncio.to_thread(MEDIA.refresh):
+        log.info(f"Файлы уроков изменились: в индексе {len(MEDIA.files)}")
 
-def load_state() -> None:
-    global USERS
+# ===== УРОКИ (lessons.json, перечитывается на лету) =====
+def _load_catalog_or_exit() -> Catalog:
     try:
-        if os.path.exists(STATE_FILE) and os.path.getsize(STATE_FILE) > 0:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                raw = json.load(f)
-            USERS = {}
-            for cid, st in raw.items():
-                last = st.get("last")
-                USERS[cid] = {
-                    "step": st.get("step", 1),
-                    "last": datetime.fromisoformat(last) if last else datetime.min
-                }
-            log.info(f"Загружено пользователей: {len(USERS)}")
-        else:
-            USERS = {}
-            log.info("STATE не найден или пуст — начнём с нуля")
+        catalog = load_catalog(LESSONS_FILE, MEDIA.get, YOUR_USERNAME)
     except Exception as e:
-        log.warning(f"Не удалось загрузить состояние: {e}")
-        USERS = {}
+        log.error(f"Не удалось загрузить уроки из {LESSONS_FILE}: {e}")
+        raise SystemExit(1)
+    log.info(f"Уроки: {len(catalog.lessons)} из {LESSONS_FILE}")
+    return catalog
 
-def save_state() -> None:
-    out = {
-        cid: {"step": st.get("step", 1), "last": st.get("last", datetime.min).isoformat()}
-        for cid, st in USERS.items()
-    }
+CATALOG: Catalog = _load_catalog_or_exit()
+CATALOG_STATUS: Dict[str, Any] = {"loaded_at": time.time(), "reloads": 0, "reload_ms": 0.0, "errors": []}
+_CATALOG_BAD: Tuple[str, int] = ("", 0)  # (файл, mtime), о битой версии которого уже сообщили
+
+async def catalog_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Следим за mtime файла уроков (и за тем, какой файл сейчас главный); сборка нового каталога —
+    # в отдельном потоке, обработчики видят либо старый каталог целиком, либо новый
+    global CATALOG, LESSONS_FILE, _CATALOG_BAD
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(out, f, ensure_ascii=False, indent=2)
+        path = await asyncio.to_thread(find_lessons_file)
+        mtime_ns = (await asyncio.to_thread(os.stat, path)).st_mtime_ns
+    except OSError as e:
+        log.warning(f"Файл уроков недоступен: {e}")
+        return
+    if (path == LESSONS_FILE and mtime_ns == CATALOG.mtime_ns) or (path, mtime_ns) == _CATALOG_BAD:
+        return
+    t0 = time.perf_counter()
+    try:
+        new = await asyncio.to_thread(load_catalog, path, MEDIA.get, YOUR_USERNAME)
+        if new.last < CATALOG.last:
+            raise CatalogError([f"уроков стало {new.last}, было {CATALOG.last}: убирать уроки нельзя"])
     except Exception as e:
-        log.warning(f"Не удалось сохранить состояние: {e}")
+        _CATALOG_BAD = (path, mtime_ns)
+        CATALOG_STATUS["errors"] = e.errors if isinstance(e, CatalogError) else [str(e)]
+        log.warning(f"Уроки не перезагружены: {e}")
+        for admin in ADMIN_IDS:
+            try:
+                await context.bot.send_message(chat_id=int(admin), text=f"⚠️ {path} не принят:\n{e}"[:4000])
+            except Exception as send_err:
+                log.warning(f"Не удалось уведомить админа {admin}: {send_err}")
+        return
+    if path != LESSONS_FILE:
+        log.info(f"Файл уроков теперь {path} (был {LESSONS_FILE})")
+        LESSONS_FILE = path
+    CATALOG = new
+    STORE.set_max_step(new.last)
+    CATALOG_STATUS.update(loaded_at=time.time(), reload_ms=(time.perf_counter() - t0) * 1000, errors=[])
+    CATALOG_STATUS["reloads"] += 1
+    log.info(f"Уроки перезагружены: {len(new.lessons)} за {CATALOG_STATUS['reload_ms']:.0f} мс")
+
+# ===== ПРОГРЕСС ПОЛЬЗОВАТЕЛЕЙ =====
+LESSON_INTERVAL = timedelta(days=1)
+TICK_MAX_SLEEP = 3600  # сек: даже при пустой очереди просыпаемся хотя бы раз в час
+
+def make_store() -> Store:
+    json_store = JsonStore(
+        STATE_FILE, JOURNAL_FILE, LESSON_INTERVAL.total_seconds(), CATALOG.last,
+        max_dirty=STATE_MAX_DIRTY, compact_ratio=JOURNAL_COMPACT_RATIO, compact_min=JOURNAL_COMPACT_MIN,
+    )
+    if STORAGE == "mmap":
+        # при первом запуске переносим пользователей из снимка (state.snap или state.json) + журнала в state.bin
+        return MmapStore(BIN_FILE, LESSON_INTERVAL.total_seconds(), CATALOG.last,
+                         max_dirty=STATE_MAX_DIRTY, migrate_from=json_store)
+    if STORAGE == "sqlite":
+        # при первом запуске на пустой базе переносим пользователей из снимка + журнала
+        return SqliteStore(DB_FILE, LESSON_INTERVAL.total_seconds(), CATALOG.last,
+                           max_dirty=STATE_MAX_DIRTY, migrate_from=json_store, shared=DELIVERY_SHARDS > 0)
+    return json_store
+
+STORE: Store = make_store()
+STORE.on_flush = lambda sec, nbytes: (metrics.FLUSH_SECONDS.observe(sec), metrics.FLUSH_BYTES.inc(nbytes))
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    STORE.flush()
+    OUTBOX.save()
+    REGISTRY.flush()
+    SERIES.save()
+
+REGISTRY = UserRegistry(USERS_CSV, max_pending=STATE_MAX_DIRTY)
 
 def _append_user_csv(chat_id: str, when: datetime) -> None:
+    REGISTRY.add(int(chat_id), when)
+
+# При шардах у каждого процесса свой outbox: забранное им, но не выданное, при переезде части
+# новый владелец возвращает в расписание из базы (reschedule_shard), а этот процесс — выбрасывает
+if DELIVERY_SHARDS:
+    OUTBOX_FILE = os.path.join(DATA_DIR, f"outbox-{WORKER_ID}.json")
+OUTBOX = Outbox(OUTBOX_FILE, max_attempts=OUTBOX_MAX_ATTEMPTS)
+
+# События для трендов: starts — новые /start, delivered — уроки по расписанию, next — уроки по /next
+SERIES = TimeSeries(SERIES_FILE, ("starts", "delivered", "next"), shared=DELIVERY_SHARDS > 0)
+
+# ===== ПЛАНИРОВЩИК ВЫДАЧИ (ближайшее время выдачи берём из хранилища) =====
+_TICK_JOB = None
+LEASES: Optional[ShardLeases] = (
+    ShardLeases(LEASE_FILE, DELIVERY_SHARDS, WORKER_ID, LEASE_TTL) if DELIVERY_SHARDS and ROLE != "updates" else None
+)
+
+def _my_shards() -> Optional[Tuple[int, List[int]]]:
+    return (DELIVERY_SHARDS, LEASES.active()) if LEASES is not None else None
+
+async def lease_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    renew_leases(context.job_queue)
+
+def renew_leases(job_queue) -> None:
+    # Продлеваем аренду; полученные части возвращаем в расписание. Другие процессы тоже меняют
+    # расписание (/start, /next), поэтому заодно перепроверяем время ближайшей выдачи
+    try:
+        gained, _ = LEASES.renew()
+    except Exception as e:
+        log.warning(f"Не удалось продлить аренду шардов: {e}")
+        return
+    for shard in gained:
+        n = STORE.reschedule_shard(shard, DELIVERY_SHARDS)
+        if n:
+            log.info(f"Шард {shard}: возвращено в расписание {n}")
+    arm_tick(job_queue)
+
+def arm_tick(job_queue) -> None:
+    # Следующий запуск tick — ко времени ближайшей выдачи (не позже TICK_MAX_SLEEP)
+    global _TICK_JOB
+    if job_queue is None or ROLE == "updates":
+        return  # в процессе только для апдейтов рассылки нет — выдают процессы ROLE=delivery
+    now_ts = time.time()
+    when = now_ts + TICK_MAX_SLEEP
+    next_due = STORE.next_due(_my_shards())
+    if next_due is not None:
+        when = min(when, next_due)
+    if _TICK_JOB is not None:
+        next_t = getattr(_TICK_JOB, "next_t", None)  # до старта JobQueue атрибут недоступен
+        if next_t is not None and next_t.timestamp() <= when:
+            return
+        _TICK_JOB.schedule_removal()
+    _TICK_JOB = job_queue.run_once(TICK, when=max(0.0, when - now_ts), name="tick")
+
+# ===== КЭШ FILE_ID (чтобы не заливать один и тот же файл повторно) =====
+FILE_IDS: Dict[str, str] = {}  # "путь:размер:mtime" -> file_id
+
+def load_file_ids() -> None:
+    global FILE_IDS
     try:
-        seen = set()
-        if os.path.exists(USERS_CSV):
-            with open(USERS_CSV, "r", newline="", encoding="utf-8") as f:
-                for row in csv.reader(f):
-                    if row:
-                        seen.add(row[0])
-        if chat_id not in seen:
-            with open(USERS_CSV, "a", newline="", encoding="utf-8") as f:
-                w = csv.writer(f)
-                w.writerow([chat_id, when.isoformat()])
+        if os.path.exists(FILE_IDS_FILE) and os.path.getsize(FILE_IDS_FILE) > 0:
+            with open(FILE_IDS_FILE, "r", encoding="utf-8") as f:
+                FILE_IDS = json.load(f)
+            log.info(f"Загружено file_id: {len(FILE_IDS)}")
     except Exception as e:
-        log.warning(f"Не удалось обновить {USERS_CSV}: {e}")
-
-# ===== КНОПКИ =====
-def kb_for_lesson(n: int) -> InlineKeyboardMarkup:
-    meta = LESSONS[n]
-    rows: List[List[InlineKeyboardButton]] = []
-    if meta.get("youtube"):
-        rows.append([InlineKeyboardButton("▶️ Смотреть на YouTube", url=meta["youtube"])])
-    if meta.get("video_file"):
-        rows.append([InlineKeyboardButton("📥 Скачать видео (MP4, без сжатия)", callback_data=f"dl_video_{n}")])
-    if meta.get("docs"):
-        rows.append([InlineKeyboardButton("📎 Скачать материалы (PDF)", callback_data=f"dl_docs_{n}")])
-    for text, url in meta.get("links", []):
-        rows.append([InlineKeyboardButton(text, url=url)])
-    return InlineKeyboardMarkup(rows) if rows else InlineKeyboardMarkup([])
+        log.warning(f"Не удалось загрузить {FILE_IDS_FILE}: {e}")
+        FILE_IDS = {}
+
+UPLOAD_GATE = UploadGate(UPLOAD_CONCURRENCY, int(UPLOAD_BUDGET_MB * 1024 * 1024))
+
+def save_file_ids() -> None:
+    try:
+        atomic_write(FILE_IDS_FILE, json.dumps(FILE_IDS, ensure_ascii=False).encode("utf-8"))
+    except Exception as e:
+        log.warning(f"Не удалось сохранить {FILE_IDS_FILE}: {e}")
+
+# Заливки в процессе: ключ файла -> future, которая завершится по окончании заливки (успешной или нет).
+# Одновременные запросы того же файла ждут её и отправляют готовый file_id — одна заливка на всю волну нажатий
+_UPLOADING: Dict[str, "asyncio.Future[None]"] = {}
+COALESCE_NOTICE_AFTER = 3.0  # сек: ждущему чужую заливку дольше — пишем «Готовлю файл…»
+
+async def send_file(context: ContextTypes.DEFAULT_TYPE, chat_id: int, media: MediaFile, caption: str) -> None:
+    key = media.key
+    coalesced = False
+    while True:
+        file_id = FILE_IDS.get(key)
+        if file_id:
+            try:
+                with profiler.step(f"file_id:{media.name}"):
+                    await context.bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+                metrics.UPLOADS.inc(1, "cached")
+                if coalesced:
+                    metrics.UPLOAD_FLIGHTS.inc(1, "coalesced")
+                return
+            except BadRequest as e:
+                # Telegram не принял сохранённый file_id — забываем его и заливаем файл заново
+                log.warning(f"file_id для {media.path} отклонён ({e}), загружаю заново")
+                FILE_IDS.pop(key, None)
+        pending = _UPLOADING.get(key)
+        if pending is None:
+            break
+        # Этот файл уже заливается — ждём и берём его file_id. Если заливка не удалась, следующий
+        # круг цикла: file_id нет — заливку начинает один из ждавших, остальные снова ждут его
+        coalesced = True
+        done, _ = await asyncio.wait({pending}, timeout=COALESCE_NOTICE_AFTER)
+        if not done:
+            await context.bot.send_message(chat_id=chat_id, text="⏳ Готовлю файл…")
+            await asyncio.wait({pending})
+
+    async def queued(position: int) -> None:
+        await context.bot.send_message(chat_id=chat_id, text=f"⏳ Готовлю файл… (в очереди: {position})")
+
+    flight: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+    _UPLOADING[key] = flight
+    try:
+        # StreamingInputFile: файл уходит в запрос кусками с диска, а не читается целиком в память
+        async with UPLOAD_GATE.slot(media.size, queued):
+            with profiler.step(f"upload:{media.name}"), open(media.path, "rb") as f:
+                msg = await context.bot.send_document(
+                    chat_id=chat_id,
+                    document=StreamingInputFile(f, os.path.basename(media.path), media.mime),
+                    caption=caption
+                )
+        metrics.UPLOADS.inc(1, "upload")
+        metrics.UPLOAD_FLIGHTS.inc(1, "leader")
+        metrics.UPLOAD_BYTES.inc(media.size)
+        att = msg.effective_attachment
+        if getattr(att, "file_id", None):
+            FILE_IDS[key] = att.file_id
+            save_file_ids()
+    finally:
+        del _UPLOADING[key]
+        flight.set_result(None)
+
+def _located(media: MediaFile) -> MediaFile:
+    # Актуальная версия из индекса: файл могли докинуть на volume или заменить после сборки каталога
+    return MEDIA.get(media.name)
 
 # ===== ОТПРАВКА УРОКА (ТОЛЬКО ТЕКСТ + КНОПКИ) =====
-async def send_lesson(context: ContextTypes.DEFAULT_TYPE, chat_id: int, n: int) -> None:
-    meta = LESSONS[n]
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"⭐️ {meta['title']}\n\nВыбирай: смотреть на YouTube или скачать оригиналы кнопками ниже ⤵️",
-        reply_markup=kb_for_lesson(n)
-    )
-    if n == 4 and meta.get("final_note"):
-        await context.bot.send_message(chat_id=chat_id, text=meta["final_note"], reply_markup=kb_for_lesson(n))
+async def send_lesson(bot: Bot, chat_id: int, n: int) -> None:
+    lesson = CATALOG.lessons[n]
+    with profiler.step(f"send_lesson:{n}"):
+        await bot.send_message(chat_id=chat_id, text=lesson.text, reply_markup=lesson.markup)
+        if lesson.final_note:
+            await bot.send_message(chat_id=chat_id, text=lesson.final_note, reply_markup=lesson.markup)
 
 # ===== КОМАНДЫ ПОЛЬЗОВАТЕЛЯ =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = str(update.effective_chat.id)
-    if chat_id not in USERS:
-        USERS[chat_id] = {"step": 1, "last": datetime.now()}
-        save_state()
-        _append_user_csv(chat_id, USERS[chat_id]["last"])
+    chat_id = update.effective_chat.id
+    st = STORE.get(chat_id)
+    if st is None:
+        now = datetime.now()
+        STORE.put(chat_id, 1, now.timestamp())
+        SERIES.add("starts")
+        _append_user_csv(str(chat_id), now)
+        arm_tick(context.job_queue)
         await update.message.reply_text("🚀 Стартуем. Твой первый урок готов 👇")
-        await send_lesson(context, int(chat_id), 1)
+        await send_lesson(context.bot, chat_id, 1)
     else:
-        cur = USERS[chat_id]["step"]
+        cur = st[0]
+        if STORE.unblock(chat_id):
+            log.info(f"{chat_id} снова с ботом — рассылка возобновлена с урока {cur}")
+            arm_tick(context.job_queue)
         await update.message.reply_text("Мы уже начали. Твой текущий урок 👇")
-        await send_lesson(context, int(chat_id), cur)
+        await send_lesson(context.bot, chat_id, cur)
 
 async def next_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = str(update.effective_chat.id)
-    if chat_id not in USERS:
-        USERS[chat_id] = {"step": 0, "last": datetime.now() - timedelta(days=2)}
-    cur = USERS[chat_id]["step"]
-    if cur >= 4:
-        await update.message.reply_text("Все 4 урока уже выданы 🎉")
+    chat_id = update.effective_chat.id
+    st = STORE.get(chat_id)
+    cur = st[0] if st else 0
+    if cur >= CATALOG.last:
+        await update.message.reply_text("Все уроки уже выданы 🎉")
         return
-    USERS[chat_id]["step"] = cur + 1
-    USERS[chat_id]["last"] = datetime.now()
-    save_state()
-    await send_lesson(context, int(chat_id), USERS[chat_id]["step"])
+    # сначала отправка, потом фиксация: при ошибке урок не засчитывается
+    await send_lesson(context.bot, chat_id, cur + 1)
+    STORE.put(chat_id, cur + 1, time.time())
+    SERIES.add("next")
+    arm_tick(context.job_queue)
 
 # ===== ОБРАБОТКА КНОПОК (ОТПРАВКА ФАЙЛОВ ПО ТРЕБОВАНИЮ) =====
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -205,147 +421,252 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     data = (q.data or "").strip()
     chat_id = int(q.message.chat.id)
 
+    hit = CATALOG.callbacks.get(data)
+    if hit is None:
+        return
+    kind, lesson = hit
+
     # Скачать видео как документ
-    m = re.match(r"dl_video_(\d+)$", data)
-    if m:
-        n = int(m.group(1))
-        meta = LESSONS.get(n, {})
-        vname = meta.get("video_file")
-        vpath = find_path(vname)
-        if vpath:
+    if kind == "video":
+        video = _located(lesson.video) if lesson.video else None
+        if video and video.path:
             try:
-                with open(vpath, "rb") as vf:
-                    await context.bot.send_document(
-                        chat_id=chat_id,
-                        document=vf,
-                        filename=os.path.basename(vpath),
-                        caption="Скачай оригинальное видео (MP4)"
-                    )
+                await send_file(context, chat_id, video, "Скачай оригинальное видео (MP4)")
             except Exception as e:
                 await context.bot.send_message(chat_id=chat_id, text=f"Не удалось отправить видео: {e}")
         else:
-            await context.bot.send_message(chat_id=chat_id, text=f"Видео не найдено: {vname or '—'}")
+            await context.bot.send_message(chat_id=chat_id, text=f"Видео не найдено: {video.name if video else '—'}")
         return
 
     # Скачать все материалы
-    m = re.match(r"dl_docs_(\d+)$", data)
-    if m:
-        n = int(m.group(1))
-        docs = LESSONS.get(n, {}).get("docs") or []
-        if not docs:
-            await context.bot.send_message(chat_id=chat_id, text="Материалы отсутствуют.")
-            return
-        sent_any = False
-        for dname in docs:
-            dpath = find_path(dname)
-            if dpath:
-                try:
-                    with open(dpath, "rb") as df:
-                        await context.bot.send_document(
-                            chat_id=chat_id,
-                            document=df,
-                            filename=os.path.basename(dpath),
-                            caption="Материалы к уроку"
-                        )
-                    sent_any = True
-                except Exception as e:
-                    await context.bot.send_message(chat_id=chat_id, text=f"Не удалось отправить: {os.path.basename(dpath)}\n{e}")
-            else:
-                await context.bot.send_message(chat_id=chat_id, text=f"Не найден: {dname}")
-        if not sent_any:
-            await context.bot.send_message(chat_id=chat_id, text="Материалы сейчас недоступны.")
+    if not lesson.docs:
+        await context.bot.send_message(chat_id=chat_id, text="Материалы отсутствуют.")
         return
+    sent_any = False
+    for doc in lesson.docs:
+        doc = _located(doc)
+        if doc.path:
+            try:
+                await send_file(context, chat_id, doc, "Материалы к уроку")
+                sent_any = True
+            except Exception as e:
+                await context.bot.send_message(chat_id=chat_id, text=f"Не удалось отправить: {os.path.basename(doc.path)}\n{e}")
+        else:
+            await context.bot.send_message(chat_id=chat_id, text=f"Не найден: {doc.name}")
+    if not sent_any:
+        await context.bot.send_message(chat_id=chat_id, text="Материалы сейчас недоступны.")
 
 # ===== АДМИН-ХЕЛПЕРЫ и КОМАНДЫ =====
 def _is_admin(chat_id: int) -> bool:
     return str(chat_id) in ADMIN_IDS
 
 def _stats_counts() -> Tuple[int, Dict[int, int]]:
-    total = len(USERS)
-    by_step: Dict[int, int] = {1: 0, 2: 0, 3: 0, 4: 0}
-    for st in USERS.values():
-        s = st.get("step", 1)
-        by_step[s] = by_step.get(s, 0) + 1
-    return total, by_step
+    # Счётчики хранилище ведёт само при каждом переходе — здесь только копия словаря
+    by_step: Dict[int, int] = {n: 0 for n in CATALOG.lessons}
+    by_step.update(STORE.count_by_step())
+    return sum(by_step.values()), by_step
+
+async def _send_export(update: Update, context: ContextTypes.DEFAULT_TYPE, flt: ExportFilter,
+                       name: str, empty: str) -> None:
+    # Один документ .csv.gz / .jsonl.gz вместо сотен сообщений по 4000 символов
+    f, n = await write_export(STORE.iter_users(flt.step), flt)
+    with f:
+        if not n:
+            await update.message.reply_text(empty)
+            return
+        stamp = datetime.now().strftime("%Y%m%d-%H%M")
+        # Файл уходит потоком, как видео уроков: выгрузка по миллиону пользователей — десятки МБ
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=StreamingInputFile(f, f"{name}-{stamp}.{flt.fmt}.gz", "application/gzip"),
+            caption=f"Пользователей: {n} ({flt.describe()})"
+        )
+
+# /users без аргументов (или со step=N) — листалка по страницам; с форматом/фильтрами — выгрузка файлом
+USERS_PAGE = 20
+USERS_INDEX_BUILDING = "⏳ Индекс для /users строится (первый просмотр после запуска) — повтори через пару секунд."
+
+def _fmt_last(last: float) -> str:
+    return datetime.fromtimestamp(last).strftime("%Y-%m-%d %H:%M") if last else "—"
+
+def _browse_data(kind: str, step: Optional[int], row: Optional[Tuple[int, int, float]] = None) -> str:
+    # callback_data (до 64 байт): ub:<s|n|p>:<урок|a>[:<step>:<last>:<chat_id> крайней строки]
+    data = f"ub:{kind}:{'a' if step is None else step}"
+    if row is not None:
+        cid, rs, last = row
+        data += f":{rs}:{last!r}:{cid}"
+    return data
+
+def _users_page(step: Optional[int], cursor: Optional[Tuple[int, int, float]],
+                backward: bool) -> Tuple[str, InlineKeyboardMarkup]:
+    # Лишняя строка сверх страницы показывает, есть ли куда листать дальше в этом направлении
+    rows = STORE.page(cursor, USERS_PAGE + 1, step, backward)
+    if backward:
+        has_prev, has_next = len(rows) > USERS_PAGE, cursor is not None
+        rows = rows[-USERS_PAGE:]
+    else:
+        has_prev, has_next = cursor is not None, len(rows) > USERS_PAGE
+        rows = rows[:USERS_PAGE]
+    total, by_step = _stats_counts()
+    head = f"👥 Урок {step}: {by_step.get(step, 0)} из {total}" if step is not None else f"👥 Все пользователи: {total}"
+    lines = [f"{cid} — урок {s} (последний: {_fmt_last(last)})" for cid, s, last in rows]
+    text = head + "\n\n" + ("\n".join(lines) if lines else "Никого.")
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton("◀️ Назад", callback_data=_browse_data("p", step, rows[0])))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton("Вперёд ▶️", callback_data=_browse_data("n", step, rows[-1])))
+    filters = [InlineKeyboardButton(("• " if step is None else "") + "Все", callback_data=_browse_data("s", None))]
+    for n in CATALOG.lessons:
+        filters.append(InlineKeyboardButton(("• " if step == n else "") + str(n), callback_data=_browse_data("s", n)))
+    keyboard = ([nav] if nav else []) + [filters[i:i + 8] for i in range(0, len(filters), 8)]
+    return text, InlineKeyboardMarkup(keyboard)
 
 async def users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_chat.id):
         return
-    if not USERS:
+    if not len(STORE):
         await update.message.reply_text("Пока никто не нажимал /start.")
         return
-    lines: List[str] = []
-    for uid, st in USERS.items():
-        step = st.get("step", 1)
-        last = st.get("last")
-        last_str = last.strftime("%Y-%m-%d %H:%M") if hasattr(last, "strftime") else str(last)
-        lines.append(f"{uid} — урок {step} (последний: {last_str})")
-    chunk = ""
-    for line in lines:
-        if len(chunk) + len(line) + 1 > 4000:
-            await update.message.reply_text(chunk)
-            chunk = ""
-        chunk += line + "\n"
-    if chunk:
-        await update.message.reply_text(chunk)
+    args = context.args or []
+    if not args or (len(args) == 1 and args[0].startswith("step=") and args[0][5:].isdigit()):
+        if not STORE.page_ready():
+            await update.message.reply_text(USERS_INDEX_BUILDING)
+            return
+        text, markup = _users_page(int(args[0][5:]) if args else None, None, False)
+        await update.message.reply_text(text, reply_markup=markup)
+        return
+    try:
+        flt = parse_filter(args)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n{EXPORT_USAGE}")
+        return
+    await _send_export(update, context, flt, "users", f"Никого не нашлось ({flt.describe()}).")
+
+async def users_browse(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Кнопки листалки: та же страница перерисовывается через edit_message_text
+    q = update.callback_query
+    if not _is_admin(update.effective_chat.id):
+        await q.answer()
+        return
+    if not STORE.page_ready():  # кнопка старого сообщения после перезапуска
+        await q.answer(USERS_INDEX_BUILDING)
+        return
+    await q.answer()
+    parts = (q.data or "").split(":")
+    try:
+        step = None if parts[2] == "a" else int(parts[2])
+        cursor = (int(parts[5]), int(parts[3]), float(parts[4])) if len(parts) == 6 else None
+    except (IndexError, ValueError):
+        return
+    text, markup = _users_page(step, cursor, parts[1] == "p")
+    try:
+        await q.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
 
 async def stuck1_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_chat.id):
         return
-    stuck = []
-    for uid, st in USERS.items():
-        if st.get("step", 1) == 1:
-            last = st.get("last")
-            last_str = last.strftime("%Y-%m-%d %H:%M") if hasattr(last, "strftime") else str(last)
-            stuck.append(f"{uid} — урок 1 (последний: {last_str})")
-    if not stuck:
-        await update.message.reply_text("Никто не застрял на уроке 1 🎉")
+    try:
+        flt = parse_filter(context.args or [], step=1)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n{EXPORT_USAGE}")
         return
-    chunk = ""
-    for line in stuck:
-        if len(chunk) + len(line) + 1 > 4000:
-            await update.message.reply_text(chunk)
-            chunk = ""
-        chunk += line + "\n"
-    if chunk:
-        await update.message.reply_text(chunk)
+    await _send_export(update, context, flt, "stuck1", "Никто не застрял на уроке 1 🎉")
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_chat.id):
         return
     total, by_step = _stats_counts()
+    ss = STORE.stats
     msg = (
         f"📊 Статистика\n"
         f"Всего пользователей: {total}\n"
-        f"• Урок 1: {by_step.get(1,0)}\n"
-        f"• Урок 2: {by_step.get(2,0)}\n"
-        f"• Урок 3: {by_step.get(3,0)}\n"
-        f"• Урок 4: {by_step.get(4,0)}\n"
+        + "".join(f"• Урок {n}: {c}\n" for n, c in sorted(by_step.items())) +
+        f"\n🗄 Хранилище: {STORAGE}\n"
+        f"⏱ Планировщик: в очереди {ss.get('heap', '—')}, "
+        f"извлечено за последний запуск {ss['popped_last']} (к выдаче {ss['due_last']})\n"
+        f"💾 Запись состояния: {ss['flushes']} сбросов, последний {ss['last_flush_ms']:.1f} мс"
+        f" / {ss.get('last_bytes', '—')} байт\n"
     )
+    if "journal_bytes" in ss:
+        msg += f"📒 Журнал: {ss['journal_bytes']} байт, сжатий {ss['compactions']}\n"
+    if "capacity" in ss:
+        msg += f"📐 state.bin: слотов {ss['capacity']}, пересборок после сбоя {ss['recovered']}\n"
+    msg += _trends()
+    us = UPLOAD_GATE.stats
+    msg += (f"📥 Заливки: сейчас {UPLOAD_GATE.active} ({UPLOAD_GATE.in_flight // (1024 * 1024)} МБ), "
+            f"в очереди {len(UPLOAD_GATE.queue)}, всего {us['uploads']}, ждали {us['queued']} ({us['wait_s']:.0f} с)\n")
+    flights = metrics.UPLOAD_FLIGHTS.values
+    if flights.get(("coalesced",)):
+        msg += (f"🤝 Одинаковые запросы: {flights[('coalesced',)]:.0f} дождались чужой заливки, "
+                f"заливок {flights.get(('leader',), 0):.0f}\n")
+    if DELIVERY is not None:
+        ds, ls = DELIVERY.stats, LIMITER.stats
+        msg += (
+            f"📤 Рассылка: очередь {DELIVERY.queue.qsize()}, в работе {DELIVERY.in_flight}, "
+            f"{DELIVERY.rate():.1f}/с, отправлено {ds['sent']}, ошибок {ds['failed']}\n"
+            f"📮 Outbox: ждут {len(OUTBOX)}, повторов {OUTBOX.stats['retries']}, брошено {OUTBOX.stats['gave_up']}\n"
+            f"🚦 Лимиты API: приторможено {ls['throttled']} ({ls['wait_s']:.0f} с), 429: {ls['retry_after']}\n"
+        )
     await update.message.reply_text(msg)
 
+def _trends() -> str:
+    starts, delivered, nexts = SERIES.days("starts"), SERIES.days("delivered"), SERIES.days("next")
+    day = lambda series: sum(c for _, c in SERIES.hours(series, 24))
+    lines = [
+        f"\n📈 За 24 ч: стартов {day('starts')}, уроков {day('delivered')} (+ по /next {day('next')})",
+        f"За 30 дней: стартов {sum(c for _, c in starts)}, уроков {sum(c for _, c in delivered)}"
+        f" (+ по /next {sum(c for _, c in nexts)})",
+        f"Старты по дням: {sparkline([c for _, c in starts])}",
+    ]
+    for (ts, s), (_, d), (_, x) in list(zip(starts, delivered, nexts))[-7:]:
+        lines.append(f"• {datetime.fromtimestamp(ts):%d.%m}: стартов {s}, уроков {d + x}")
+    return "\n".join(lines) + "\n"
+
+def _file_status(media: MediaFile) -> str:
+    if not media.path:
+        return "NOT FOUND"
+    return f"OK ({media.size / 1024 / 1024:.1f} МБ, {media.mime})"
+
 async def checkfiles_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_chat.id):
         return
     lines: List[str] = []
-    lines.append("🗂 Проверка файлов (ищем в media/ и в корне)")
-    for n, meta in LESSONS.items():
-        title = meta.get("title", f"Урок {n}")
-        vname = meta.get("video_file")
-        vpath = find_path(vname) if vname else None
-        lines.append(f"[{n}] {title}")
-        lines.append(f"  video: {vname} -> {'OK' if vpath else 'NOT FOUND'}")
-        for dname in meta.get("docs", []):
-            dpath = find_path(dname)
-            lines.append(f"  doc:   {dname} -> {'OK' if dpath else 'NOT FOUND'}")
+    scanned = datetime.fromtimestamp(MEDIA.scanned_at).strftime("%H:%M:%S")
+    lines.append(f"🗂 Проверка файлов (ищем в media/ и в корне, индекс от {scanned})")
+    for n, lesson in CATALOG.lessons.items():
+        lines.append(f"[{n}] {lesson.title}")
+        if lesson.video:
+            lines.append(f"  video: {lesson.video.name} -> {_file_status(MEDIA.get(lesson.video.name))}")
+        else:
+            lines.append("  video: None -> NOT FOUND")
+        for doc in lesson.docs:
+            lines.append(f"  doc:   {doc.name} -> {_file_status(MEDIA.get(doc.name))}")
     text = "\n".join(lines)
     while text:
         await update.message.reply_text(text[:3900])
         text = text[3900:]
 
+async def catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not _is_admin(update.effective_chat.id):
+        return
+    loaded = datetime.fromtimestamp(CATALOG_STATUS["loaded_at"]).strftime("%Y-%m-%d %H:%M:%S")
+    msg = (
+        f"📚 Уроки: {len(CATALOG.lessons)} из {CATALOG.source}\n"
+        f"Загружены: {loaded}, перезагрузок {CATALOG_STATUS['reloads']}, "
+        f"последняя {CATALOG_STATUS['reload_ms']:.0f} мс\n"
+    )
+    if CATALOG_STATUS["errors"]:
+        msg += "⚠️ Последняя правка не принята:\n" + "\n".join(f"• {e}" for e in CATALOG_STATUS["errors"])
+    await update.message.reply_text(msg[:4000])
+
 async def exportusers_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not _is_admin(update.effective_chat.id):
         return
+    REGISTRY.flush()
     if not os.path.exists(USERS_CSV):
         await update.message.reply_text("Файл с пользователями пока не создан.")
         return
@@ -360,44 +681,280 @@ async def exportusers_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception as e:
         await update.message.reply_text(f"Не удалось отправить CSV: {e}")
 
+async def slow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /slow [N] — N самых медленных операций с момента запуска; /slow profile — cProfile последней минуты
+    if not _is_admin(update.effective_chat.id):
+        return
+    if PROFILER is None:
+        await update.message.reply_text("Профилирование выключено (PROFILE=1 в Variables).")
+        return
+    arg = context.args[0].lower() if context.args else ""
+    if arg == "profile":
+        if not PROFILER.last_profile:
+            hint = "ещё не готов, подожди минуту" if PROFILE_CPROFILE else "выключен (PROFILE_CPROFILE=1)"
+            await update.message.reply_text(f"cProfile {hint}.")
+            return
+        stamp = datetime.fromtimestamp(PROFILER.last_profile_at).strftime("%Y%m%d-%H%M")
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=PROFILER.last_profile.encode("utf-8"),
+            filename=f"cprofile-{stamp}.txt",
+            caption="cProfile за минуту (сортировка по cumulative)"
+        )
+        return
+    n = int(arg) if arg.isdigit() else 10
+    top = PROFILER.top(n)
+    ps = PROFILER.stats
+    head = f"🐢 Медленные операции: {ps['slow']} из {ps['traces']} дольше {PROFILE_SLOW_MS:.0f} мс\n"
+    if not top:
+        await update.message.reply_text(head + "Пока ничего не записано.")
+        return
+    text = head + "\n".join(format_report(rep) for rep in top)
+    while text:
+        await update.message.reply_text(text[:3900])
+        text = text[3900:]
+
 # ===== АВТОВЫДАЧА КАЖДЫЕ 24 ЧАСА =====
 async def tick(context: ContextTypes.DEFAULT_TYPE) -> None:
-    now = datetime.now()
-    for chat_id, st in list(USERS.items()):
-        step = st.get("step", 1)
-        last = st.get("last", datetime.min)
-        if step < 4 and now - last >= timedelta(days=1):
-            USERS[chat_id]["step"] = step + 1
-            USERS[chat_id]["last"] = now
-            save_state()
-            await send_lesson(context, int(chat_id), USERS[chat_id]["step"])
+    global _TICK_JOB
+    _TICK_JOB = None
+    t0 = time.perf_counter()
+    try:
+        with profiler.step("pop_due"):
+            due = STORE.pop_due(time.time(), _my_shards())
+        metrics.TICK_USERS.observe(len(due))
+        with profiler.step("outbox.save"):
+            added = sum(OUTBOX.add(chat_id, step + 1) for chat_id, step in due)
+            OUTBOX.save()  # пачка записана на диск до начала отправки
+        if due:
+            log.info(f"tick: к выдаче {len(due)} (новых в outbox {added}), извлечено {STORE.stats['popped_last']}")
+        with profiler.step("drain_outbox"):
+            drain_outbox()
+    finally:
+        arm_tick(context.job_queue)
+        metrics.TICK_SECONDS.observe(time.perf_counter() - t0)
+
+TICK = tick  # при PROFILE=1 подменяется обёрткой профилировщика (см. ЗАПУСК)
+
+def drain_outbox() -> None:
+    for chat_id, lesson in OUTBOX.take_due(time.time()):
+        DELIVERY.submit(chat_id, lesson)
+
+async def outbox_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    drain_outbox()
+
+async def deliver(bot: Bot, chat_id: int, lesson: int) -> None:
+    if LEASES is None:
+        await _deliver(bot, chat_id, lesson)
+        return
+    if not LEASES.owns(chat_id):
+        OUTBOX.done(chat_id)
+        if LEASES.handing_over(chat_id):
+            return  # часть переехала — выдаст новый владелец (reschedule_shard при получении)
+        # часть наша, просто аренда близка к концу: pop_due уже снял due — возвращаем в расписание,
+        # иначе его вернул бы только reschedule_shard, а эту часть никто не получает
+        STORE.reschedule_user(chat_id)
+        return
+    # пока отправка идёт (в том числе ждёт RetryAfter), аренду отдаваемой части не снимаем
+    with LEASES.hold(chat_id):
+        await _deliver(bot, chat_id, lesson)
+
+async def _deliver(bot: Bot, chat_id: int, lesson: int) -> None:
+    # Урок засчитывается (step/last) только после успешной отправки
+    st = STORE.get(chat_id)
+    if st is None or st[0] >= lesson:
+        OUTBOX.done(chat_id)  # уже выдан (например, через /next) — повторно не шлём
+        return
+    try:
+        await send_lesson(bot, chat_id, lesson)
+    except Exception as e:
+        # пока шла отправка, пользователь мог сам взять урок через /next — его шаг не трогаем
+        cur = STORE.get(chat_id)
+        moved = cur is None or cur[0] != st[0]
+        if isinstance(e, Forbidden):
+            # бот заблокирован: урок не засчитываем и больше не планируем — до /start (STORE.unblock),
+            # иначе попытка (и место в лимите API) каждые сутки
+            OUTBOX.done(chat_id)
+            if not moved:
+                STORE.block(chat_id)
+            metrics.BLOCKED.inc()
+            log.info(f"{chat_id} заблокировал бота — рассылка ему остановлена")
+        elif not OUTBOX.fail(chat_id, e.retry_after if isinstance(e, RetryAfter) else None):
+            # попытки кончились: отложим урок на сутки, не засчитывая
+            OUTBOX.done(chat_id)
+            if not moved:
+                STORE.put(chat_id, st[0], time.time())
+        raise
+    # только вперёд: если за время отправки пользователь ушёл дальше через /next, шаг не откатываем
+    cur = STORE.get(chat_id)
+    if cur is None or cur[0] < lesson:
+        STORE.put(chat_id, lesson, time.time())
+    OUTBOX.done(chat_id)
+    metrics.DELIVERED.inc()
+    SERIES.add("delivered")
 
 # ===== ЗАПУСК =====
-def main() -> None:
-    load_state()
-    app = ApplicationBuilder().token(TOKEN).build()
+LIMITER = RateLimiter(API_RATE, API_BURST, CHAT_RATE, CHAT_BURST, max_inflight=API_MAX_INFLIGHT)
+DELIVERY: Optional[DeliveryEngine] = None
+SERVICE: Optional[asyncio.AbstractServer] = None
+STARTED_AT = time.time()
+PROFILER: Optional[Profiler] = Profiler(PROFILE_SLOW_MS, SLOW_LOG) if PROFILE else None
+if PROFILER is not None:
+    TICK = PROFILER.wrap("tick", tick)
+
+def _instrument(name: str, fn):
+    # Метрики для всех обработчиков; трассировка — только при PROFILE=1
+    fn = metrics.timed(name, fn)
+    return PROFILER.wrap(name, fn) if PROFILER is not None else fn
+
+async def cprofile_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    PROFILER.rotate_cprofile()
+
+async def health() -> Tuple[int, str, bytes]:
+    body = {
+        "status": "ok",
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "uptime": int(time.time() - STARTED_AT),
+        "delivery_queue": DELIVERY.queue.qsize() if DELIVERY else 0,
+        "outbox": len(OUTBOX),
+    }
+    if LEASES is not None:
+        body.update(role=ROLE, worker=WORKER_ID, shards=LEASES.active())
+    return 200, "application/json", json.dumps(body).encode("utf-8")
+
+async def metrics_page() -> Tuple[int, str, bytes]:
+    return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render()
+
+# Текущие значения читаются только при запросе /metrics
+metrics.Gauge("bot_users", "Пользователей в хранилище", lambda: len(STORE))
+metrics.Gauge("bot_users_by_step", "Пользователей по текущему уроку",
+              lambda: {(str(n),): c for n, c in _stats_counts()[1].items()}, ["step"])
+metrics.Gauge("bot_outbox_pending", "Уроков ждут доставки в outbox", lambda: len(OUTBOX))
+metrics.Gauge("bot_delivery_queue", "Очередь воркеров рассылки", lambda: DELIVERY.queue.qsize() if DELIVERY else 0)
+metrics.Gauge("bot_ratelimit_wait_seconds", "Суммарное ожидание в лимитере API", lambda: LIMITER.stats["wait_s"])
+metrics.Gauge("bot_ratelimit_retry_after", "Ответов 429 (RetryAfter) от Bot API", lambda: LIMITER.stats["retry_after"])
+metrics.Gauge("bot_file_ids", "Закэшированных file_id", lambda: len(FILE_IDS))
+metrics.Gauge("bot_uploads_active", "Файлов заливается сейчас", lambda: UPLOAD_GATE.active)
+metrics.Gauge("bot_uploads_inflight_bytes", "Байт в заливаемых сейчас файлах", lambda: UPLOAD_GATE.in_flight)
+metrics.Gauge("bot_uploads_queue", "Заливок ждут очереди", lambda: len(UPLOAD_GATE.queue))
+metrics.Gauge("bot_uploads_coalescing", "Файлов заливается, их ждут одинаковые запросы", lambda: len(_UPLOADING))
+metrics.Gauge("bot_uploads_wait_seconds", "Суммарное ожидание в очереди на заливку",
+              lambda: UPLOAD_GATE.stats["wait_s"])
+metrics.Gauge("bot_shards_owned", "Частей рассылки у этого процесса",
+              lambda: len(LEASES.active()) if LEASES is not None else 0)
+metrics.Gauge("bot_uptime_seconds", "Время работы процесса", lambda: time.time() - STARTED_AT)
+
+async def on_init(app) -> None:
+    global DELIVERY, SERVICE
+    DELIVERY = DeliveryEngine(lambda chat_id, n: deliver(app.bot, chat_id, n), workers=DELIVERY_WORKERS)
+    DELIVERY.start()
+    if LEASES is not None:
+        renew_leases(app.job_queue)  # части — до первого tick
+    if SERVICE_PORT:
+        SERVICE = await start_http_server(SERVICE_LISTEN, SERVICE_PORT,
+                                          routes({"/health": health, "/metrics": metrics_page}))
+        log.info(f"Служебный HTTP: {SERVICE_LISTEN}:{SERVICE_PORT} (/health, /metrics)")
+
+async def on_stop(app) -> None:
+    # до app.shutdown(): бот ещё может отправлять, дожидаемся очереди рассылки
+    await DELIVERY.stop()
+    if LEASES is not None:
+        LEASES.release_all()  # очередь дослана — части можно отдавать сразу, не дожидаясь ttl
+    if SERVICE is not None:
+        SERVICE.close()
+
+async def on_shutdown(app) -> None:
+    STORE.close()
+    OUTBOX.save()
+    REGISTRY.flush()
+    SERIES.save()
+    log.info("Состояние сохранено перед остановкой")
+
+def build_app(base_url: Optional[str] = None) -> Application:
+    global _TICK_JOB
+    STORE.load()
+    OUTBOX.load()
+    REGISTRY.load()
+    SERIES.load()
+    load_file_ids()
+    builder = (
+        ApplicationBuilder().token(TOKEN).rate_limiter(LIMITER)
+        .request(metrics.MeteredRequest(connection_pool_size=256))  # как у PTB по умолчанию, плюс замеры
+        .post_init(on_init).post_stop(on_stop).post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)  # например, локальный Bot API или тестовый стенд
+    if ROLE == "delivery":
+        builder = builder.updater(None)  # апдейты получает процесс ROLE=updates/all
+    app = builder.build()
 
     # пользовательские команды
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("next", next_cmd))
+    # (каждый обработчик обёрнут _instrument — метрики и, при PROFILE=1, трассировка)
+    app.add_handler(CommandHandler("start", _instrument("start", start)))
+    app.add_handler(CommandHandler("next", _instrument("next", next_cmd)))
 
-    # обработка кнопок
-    app.add_handler(CallbackQueryHandler(on_callback))
+    # обработка кнопок (листалка /users — раньше общего обработчика)
+    app.add_handler(CallbackQueryHandler(_instrument("users_browse", users_browse), pattern=r"^ub:"))
+    # кнопки скачивания — без блокировки: долгая заливка не задерживает остальные апдейты,
+    # одновременные заливки ограничивает UPLOAD_GATE
+    app.add_handler(CallbackQueryHandler(_instrument("on_callback", on_callback), block=False))
 
     # админ-команды
-    app.add_handler(CommandHandler("users", users_cmd))
-    app.add_handler(CommandHandler("stuck1", stuck1_cmd))
-    app.add_handler(CommandHandler("stats", stats_cmd))
-    app.add_handler(CommandHandler("checkfiles", checkfiles_cmd))
-    app.add_handler(CommandHandler("exportusers", exportusers_cmd))
+    app.add_handler(CommandHandler("users", _instrument("users", users_cmd)))
+    app.add_handler(CommandHandler("stuck1", _instrument("stuck1", stuck1_cmd)))
+    app.add_handler(CommandHandler("stats", _instrument("stats", stats_cmd)))
+    app.add_handler(CommandHandler("checkfiles", _instrument("checkfiles", checkfiles_cmd)))
+    app.add_handler(CommandHandler("exportusers", _instrument("exportusers", exportusers_cmd)))
+    app.add_handler(CommandHandler("catalog", _instrument("catalog", catalog_cmd)))
+    app.add_handler(CommandHandler("slow", _instrument("slow", slow_cmd)))
 
     if app.job_queue is None:
-        log.error('Нужен пакет: python-telegram-bot[job-queue]==20.7 в requirements.txt')
+        log.error('Нужен пакет: python-telegram-bot[job-queue,webhooks]==20.7 в requirements.txt')
         raise SystemExit(1)
-    app.job_queue.run_repeating(tick, interval=60, first=10)
+    app.job_queue.run_repeating(flush_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+    if ROLE != "updates":
+        _TICK_JOB = app.job_queue.run_once(TICK, when=10, name="tick")
+        app.job_queue.run_repeating(outbox_job, interval=OUTBOX_POLL, first=OUTBOX_POLL)
+    if LEASES is not None:
+        app.job_queue.run_repeating(lease_job, interval=LEASE_TTL / 3, first=LEASE_TTL / 3)
+    app.job_queue.run_repeating(catalog_job, interval=CATALOG_POLL, first=CATALOG_POLL)
+    app.job_queue.run_repeating(media_job, interval=MEDIA_POLL, first=MEDIA_POLL)
+    if PROFILER is not None and PROFILE_CPROFILE > 0:
+        PROFILER.start_cprofile(PROFILE_CPROFILE)
+        app.job_queue.run_repeating(cprofile_job, interval=60, first=60)
+    return app
+
+async def run_delivery(app: Application) -> None:
+    # ROLE=delivery: без polling/вебхука — только JobQueue (tick, outbox, аренда шардов) до SIGTERM
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await on_init(app)
+        await app.start()
+        await stop.wait()
+        await app.stop()
+        await on_stop(app)
+    await on_shutdown(app)
 
-    log.info("Бот запущен… (YouTube + кнопки скачивания, 1 урок/сутки, без авто-видео)")
-    app.run_polling()
+def main() -> None:
+    app = build_app(os.getenv("BOT_API_BASE_URL") or None)
+    if ROLE == "delivery":
+        log.info(f"Процесс рассылки {WORKER_ID}: частей {DELIVERY_SHARDS}, аренда {LEASE_FILE}")
+        asyncio.run(run_delivery(app))
+    elif WEBHOOK_URL:
+        log.info(f"Бот запущен… (вебхук {WEBHOOK_URL}/{WEBHOOK_PATH}, слушаю {WEBHOOK_LISTEN}:{WEBHOOK_PORT})")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+        )
+    else:
+        log.info("Бот запущен… (YouTube + кнопки скачивания, 1 урок/сутки, без авто-видео)")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
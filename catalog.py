@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Каталог уроков, собранный один раз: готовые клавиатуры, текст сообщения, найденные файлы
+# и callback_data кнопок. Объекты неизменяемые — обработчики только читают их по ключу.
+# Описание уроков — в lessons.json (или .toml); при изменении файла бот собирает новый каталог
+# и подменяет ссылку целиком.
+
+import os
+import json
+import time
+import mimetypes
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+LESSON_TEXT = "⭐️ {title}\n\nВыбирай: смотреть на YouTube или скачать оригиналы кнопками ниже ⤵️"
+
+
+@dataclass(frozen=True)
+class MediaFile:
+    name: str            # имя из описания урока
+    path: Optional[str]  # где нашли (None — файла нет)
+    size: int = 0
+    mtime_ns: int = 0
+    mime: str = "application/octet-stream"
+    real: str = ""       # path без симлинков — считается в MediaIndex.scan, а не на каждое нажатие
+
+    @property
+    def key(self) -> str:
+        # Ключ кэша file_id: заменённый файл (другой размер/mtime) получит новый ключ
+        return f"{self.real or self.path}:{self.size}:{self.mtime_ns}" if self.path else ""
+
+
+@dataclass(frozen=True)
+class Lesson:
+    n: int
+    title: str
+    text: str
+    markup: InlineKeyboardMarkup
+    video: Optional[MediaFile]
+    docs: Tuple[MediaFile, ...]
+    final_note: Optional[str]
+    video_token: str
+    docs_token: str
+
+
+@dataclass(frozen=True)
+class Catalog:
+    lessons: Mapping[int, Lesson]
+    callbacks: Mapping[str, Tuple[str, Lesson]]  # callback_data -> ("video" | "docs", урок)
+    source: str = ""   # файл, из которого собран каталог
+    mtime_ns: int = 0  # его mtime на момент чтения
+
+    @property
+    def last(self) -> int:
+        return max(self.lessons)
+
+
+class CatalogError(ValueError):
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def _is_url(v: Any) -> bool:
+    return isinstance(v, str) and v.startswith(("https://", "http://", "tg://"))
+
+
+def load_lessons(path: str, username: str) -> Dict[int, Dict[str, Any]]:
+    # Читает и проверяет файл уроков; все ошибки собираются в один CatalogError
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".toml"):
+        import tomllib
+        data = tomllib.loads(raw.decode("utf-8"))
+    else:
+        data = json.loads(raw)
+    items = data.get("lessons") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise CatalogError(["нужен непустой список lessons"])
+    errors: List[str] = []
+    lessons: Dict[int, Dict[str, Any]] = {}
+    for n, item in enumerate(items, start=1):
+        where = f"урок {n}"
+        if not isinstance(item, dict):
+            errors.append(f"{where}: ожидается объект")
+            continue
+        title = item.get("title")
+        if not isinstance(title, str) or not title.strip():
+            errors.append(f"{where}: нет title")
+        youtube = item.get("youtube")
+        if youtube is not None and not _is_url(youtube):
+            errors.append(f"{where}: youtube должен быть ссылкой")
+        video = item.get("video_file")
+        if video is not None and (not isinstance(video, str) or not video):
+            errors.append(f"{where}: video_file должен быть строкой")
+        docs = item.get("docs") or []
+        if not isinstance(docs, list) or not all(isinstance(d, str) and d for d in docs):
+            errors.append(f"{where}: docs должен быть списком имён файлов")
+        links: List[Tuple[str, str]] = []
+        for i, link in enumerate(item.get("links") or [], start=1):
+            text = link.get("text") if isinstance(link, dict) else None
+            url = link.get("url") if isinstance(link, dict) else None
+            if isinstance(url, str):
+                url = url.replace("{username}", username)
+            if not isinstance(text, str) or not text or not _is_url(url):
+                errors.append(f"{where}: ссылка {i} должна быть {{text, url}}")
+                continue
+            links.append((text, url))
+        note = item.get("final_note")
+        if note is not None and not isinstance(note, str):
+            errors.append(f"{where}: final_note должен быть строкой")
+        lessons[n] = {"title": title, "youtube": youtube, "video_file": video, "docs": docs,
+                      "links": links, "final_note": note}
+    if errors:
+        raise CatalogError(errors)
+    return lessons
+
+
+class MediaIndex:
+    # Имя файла -> MediaFile по каталогам поиска (как раньше: первый каталог в списке побеждает).
+    # Строится одним проходом scandir; refresh() пересканирует, если поменялся mtime каталога
+    # или с прошлого полного прохода прошло full_rescan секунд (замена файла «на месте» mtime каталога не меняет)
+    def __init__(self, search_dirs: List[str], full_rescan: float = 300.0) -> None:
+        self.search_dirs = list(search_dirs)
+        self.full_rescan = full_rescan
+        self.files: Mapping[str, MediaFile] = MappingProxyType({})
+        self.dir_mtimes: Dict[str, int] = {}
+        self.scanned_at = 0.0
+        self.stats: Dict[str, float] = {"scans": 0, "changes": 0, "last_scan_ms": 0.0}
+
+    def get(self, name: str) -> MediaFile:
+        return self.files.get(name) or MediaFile(name, None)
+
+    def _dir_mtimes(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for base in self.search_dirs:
+            try:
+                out[base] = os.stat(base).st_mtime_ns
+            except OSError:
+                out[base] = -1
+        return out
+
+    def scan(self) -> bool:
+        # Полный проход; возвращает True, если набор файлов или их размеры/mtime изменились
+        t0 = time.perf_counter()
+        mtimes = self._dir_mtimes()
+        files: Dict[str, MediaFile] = {}
+        for base in self.search_dirs:
+            try:
+                entries = list(os.scandir(base))
+            except OSError:
+                continue
+            real_base = os.path.realpath(base)
+            for entry in entries:
+                if entry.name in files or not entry.is_file():
+                    continue
+                st = entry.stat()
+                path = entry.name if base == "." else os.path.join(base, entry.name)
+                real = os.path.realpath(path) if entry.is_symlink() else os.path.join(real_base, entry.name)
+                mime = mimetypes.guess_type(entry.name)[0] or "application/octet-stream"
+                files[entry.name] = MediaFile(entry.name, path, st.st_size, st.st_mtime_ns, mime, real)
+        changed = files != dict(self.files)
+        self.files = MappingProxyType(files)  # подмена целиком: читатели видят старый или новый индекс
+        self.dir_mtimes = mtimes
+        self.scanned_at = time.time()
+        self.stats["scans"] += 1
+        self.stats["last_scan_ms"] = (time.perf_counter() - t0) * 1000
+        if changed:
+            self.stats["changes"] += 1
+        return changed
+
+    def refresh(self) -> bool:
+        if self._dir_mtimes() != self.dir_mtimes or time.time() - self.scanned_at >= self.full_rescan:
+            return self.scan()
+        return False
+
+
+def _keyboard(n: int, meta: Dict[str, Any], video_token: str, docs_token: str) -> InlineKeyboardMarkup:
+    rows: List[List[InlineKeyboardButton]] = []
+    if meta.get("youtube"):
+        rows.append([InlineKeyboardButton("▶️ Смотреть на YouTube", url=meta["youtube"])])
+    if meta.get("video_file"):
+        rows.append([InlineKeyboardButton("📥 Скачать видео (MP4, без сжатия)", callback_data=video_token)])
+    if meta.get("docs"):
+        rows.append([InlineKeyboardButton("📎 Скачать материалы (PDF)", callback_data=docs_token)])
+    for text, url in meta.get("links", []):
+        rows.append([InlineKeyboardButton(text, url=url)])
+    return InlineKeyboardMarkup(rows)
+
+
+def compile_catalog(lessons: Dict[int, Dict[str, Any]], resolve: Callable[[str], MediaFile],
+                    source: str = "", mtime_ns: int = 0) -> Catalog:
+    compiled: Dict[int, Lesson] = {}
+    callbacks: Dict[str, Tuple[str, Lesson]] = {}
+    for n, meta in sorted(lessons.items()):
+        video_token, docs_token = f"dl_video_{n}", f"dl_docs_{n}"
+        vname = meta.get("video_file")
+        lesson = Lesson(
+            n=n,
+            title=meta["title"],
+            text=LESSON_TEXT.format(title=meta["title"]),
+            markup=_keyboard(n, meta, video_token, docs_token),
+            video=resolve(vname) if vname else None,
+            docs=tuple(resolve(d) for d in meta.get("docs") or []),
+            final_note=meta.get("final_note"),
+            video_token=video_token,
+            docs_token=docs_token,
+        )
+        compiled[n] = lesson
+        callbacks[video_token] = ("video", lesson)
+        callbacks[docs_token] = ("docs", lesson)
+    return Catalog(MappingProxyType(compiled), MappingProxyType(callbacks), source, mtime_ns)
+
+
+def load_catalog(path: str, resolve: Callable[[str], MediaFile], username: str) -> Catalog:
+    # Тяжёлая часть перезагрузки (чтение, проверка) — вызывать вне event loop
+    mtime_ns = os.stat(path).st_mtime_ns
+    return compile_catalog(load_lessons(path, username), resolve, path, mtime_ns)
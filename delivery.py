@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Рассылка уроков: пул воркеров + ограничение частоты запросов к Bot API.
+#   RateLimiter      — подключается к ApplicationBuilder().rate_limiter(): общий лимит (~30 сообщений/с),
+#                      лимит на чат и повтор после RetryAfter для ВСЕХ вызовов бота
+#   DeliveryEngine   — очередь + N воркеров, через которые tick отправляет уроки
+#   Outbox           — сохранённые на диск ожидающие выдачи: урок засчитывается только после отправки
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Coroutine, Deque, Dict, List, Optional, Set, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import profiler
+from storage import atomic_write
+
+log = logging.getLogger("bot.delivery")
+
+# Эти методы не отправляют сообщений в чат — их не тормозим
+UNLIMITED_ENDPOINTS = {"answerCallbackQuery", "getMe", "getUpdates", "setWebhook", "deleteWebhook", "getFile"}
+# Долгий опрос держит соединение до timeout — в число одновременных запросов его не считаем
+LONG_POLL_ENDPOINTS = {"getUpdates"}
+
+
+class TokenBucket:
+    # rate токенов в секунду, не больше burst подряд; pause() останавливает выдачу на время
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self) -> float:
+        # Сколько ждать до следующего токена (0 — токен взят)
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            d = self.delay()
+            if d <= 0:
+                return waited
+            waited += d
+            await asyncio.sleep(d)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class RateLimiter(BaseRateLimiter):
+    def __init__(self, rate: float = 28, burst: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3, max_inflight: int = 0) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats: Dict[Any, TokenBucket] = {}
+        self.max_retries = max_retries
+        # Не больше max_inflight запросов в полёте (0 — без ограничения): пул соединений httpcore 1.0
+        # на каждый запрос перебирает все соединения, и сотни одновременных запросов упираются в CPU
+        self.inflight = asyncio.Semaphore(max_inflight) if max_inflight > 0 else None
+        self.stats: Dict[str, float] = {"requests": 0, "throttled": 0, "wait_s": 0.0, "retry_after": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        b = self.chats.get(chat_id)
+        if b is None:
+            if len(self.chats) > 10000:
+                # Полностью восстановившиеся корзины ничем не отличаются от новых — выбрасываем
+                now = time.monotonic()
+                full = self.chat_burst / self.chat_rate
+                self.chats = {k: v for k, v in self.chats.items() if now - v.stamp < full}
+            b = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        limited = endpoint not in UNLIMITED_ENDPOINTS
+        chat_id = data.get("chat_id")
+        attempt = 0
+        while True:
+            if limited:
+                waited = 0.0
+                if chat_id is not None:
+                    waited += await self._chat_bucket(chat_id).acquire()
+                waited += await self.bucket.acquire()
+                if waited:
+                    self.stats["throttled"] += 1
+                    self.stats["wait_s"] += waited
+                    profiler.note("wait", endpoint, waited)
+            self.stats["requests"] += 1
+            try:
+                if self.inflight is None or endpoint in LONG_POLL_ENDPOINTS:
+                    return await callback(*args, **kwargs)
+                async with self.inflight:
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # Telegram просит подождать — стопорим все отправки, а не только этот запрос
+                self.stats["retry_after"] += 1
+                attempt += 1
+                log.warning(f"RetryAfter {e.retry_after} с на {endpoint} (попытка {attempt})")
+                self.bucket.pause(e.retry_after)
+                if attempt > self.max_retries:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+
+class DeliveryEngine:
+    # send(chat_id, payload) выполняется в одном из workers воркеров; ошибки логируются и считаются
+    RATE_WINDOW = 10.0
+
+    def __init__(self, send: Callable[[int, Any], Awaitable[None]], workers: int = 8) -> None:
+        self.send = send
+        self.workers = workers
+        self.queue: "asyncio.Queue[Tuple[int, Any]]" = asyncio.Queue()
+        self.tasks: List[asyncio.Task] = []
+        self.in_flight = 0
+        self.done: Deque[float] = deque()  # время завершения отправок за последние RATE_WINDOW секунд
+        self.stats: Dict[str, float] = {"submitted": 0, "sent": 0, "failed": 0}
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        log.info(f"Рассылка: запущено воркеров {self.workers}")
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"Рассылка: остановка, не отправлено {self.queue.qsize()}")
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, chat_id: int, payload: Any) -> None:
+        self.queue.put_nowait((chat_id, payload))
+        self.stats["submitted"] += 1
+
+    def rate(self) -> float:
+        cutoff = time.monotonic() - self.RATE_WINDOW
+        while self.done and self.done[0] < cutoff:
+            self.done.popleft()
+        return len(self.done) / self.RATE_WINDOW
+
+    async def _worker(self, i: int) -> None:
+        while True:
+            chat_id, payload = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await self.send(chat_id, payload)
+                self.stats["sent"] += 1
+                self.done.append(time.monotonic())
+            except Exception as e:
+                self.stats["failed"] += 1
+                log.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+
+class Outbox:
+    # chat_id -> [урок, попыток, не раньше (unix-время)]. Пишется в файл целиком при save(),
+    # после перезапуска недоставленное продолжает отправляться с того же места
+    def __init__(self, path: str, max_attempts: int = 8, base_delay: float = 30, max_delay: float = 3600) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.items: Dict[int, List[float]] = {}
+        self.taken: Set[int] = set()  # уже отданы воркерам, повторно не выдаём
+        self.dirty = False
+        self.stats: Dict[str, float] = {"added": 0, "done": 0, "retries": 0, "gave_up": 0}
+
+    def load(self) -> None:
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.items = {int(cid): v for cid, v in json.load(f).items()}
+        except Exception as e:
+            log.warning(f"Не удалось загрузить {self.path}: {e}")
+            self.items = {}
+        if self.items:
+            log.info(f"Outbox: ожидают отправки {len(self.items)}")
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        try:
+            data = json.dumps({str(cid): v for cid, v in self.items.items()}, separators=(",", ":"))
+            atomic_write(self.path, data.encode("utf-8"))
+            self.dirty = False
+        except Exception as e:
+            log.warning(f"Не удалось сохранить {self.path}: {e}")
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, chat_id: int) -> Optional[int]:
+        item = self.items.get(chat_id)
+        return int(item[0]) if item else None
+
+    def add(self, chat_id: int, lesson: int) -> bool:
+        if chat_id in self.items:
+            return False
+        self.items[chat_id] = [lesson, 0, 0.0]
+        self.dirty = True
+        self.stats["added"] += 1
+        return True
+
+    def take_due(self, now: float) -> List[Tuple[int, int]]:
+        out = []
+        for cid, (lesson, _, next_at) in self.items.items():
+            if next_at <= now and cid not in self.taken:
+                self.taken.add(cid)
+                out.append((cid, int(lesson)))
+        return out
+
+    def done(self, chat_id: int) -> None:
+        self.taken.discard(chat_id)
+        if self.items.pop(chat_id, None) is not None:
+            self.dirty = True
+            self.stats["done"] += 1
+
+    def fail(self, chat_id: int, retry_after: Optional[float] = None) -> bool:
+        # Экспоненциальная пауза перед следующей попыткой; False — попытки исчерпаны, запись удалена
+        self.taken.discard(chat_id)
+        item = self.items.get(chat_id)
+        if item is None:
+            return False
+        item[1] += 1
+        self.dirty = True
+        if item[1] >= self.max_attempts:
+            del self.items[chat_id]
+            self.stats["gave_up"] += 1
+            return False
+        delay = min(self.max_delay, self.base_delay * 2 ** (item[1] - 1))
+        item[2] = time.time() + max(delay, retry_after or 0)
+        self.stats["retries"] += 1
+        return True
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Выгрузка пользователей одним сжатым документом: строки пишутся из хранилища по мере обхода
+# в gzip во временном файле (в памяти, пока небольшой), без сборки всего списка в памяти.
+
+import gzip
+import json
+import asyncio
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import IO, Iterable, List, Optional, Tuple
+
+FORMATS = ("csv", "jsonl")
+USAGE = ("Фильтры: csv | jsonl, step=N, from=ГГГГ-ММ-ДД, to=ГГГГ-ММ-ДД (по дате последнего урока)\n"
+         "Например: /users jsonl step=2 from=2025-01-01")
+YIELD_EVERY = 5000  # строк между передачей управления event loop
+
+
+@dataclass(frozen=True)
+class ExportFilter:
+    fmt: str = "csv"
+    step: Optional[int] = None
+    since: float = 0.0            # last >= since (unix-время), 0 — без ограничения
+    until: Optional[float] = None  # last < until
+
+    def match(self, step: int, last: float) -> bool:
+        if self.step is not None and step != self.step:
+            return False
+        if self.since and last < self.since:
+            return False
+        if self.until is not None and (not last or last >= self.until):
+            return False
+        return True
+
+    def describe(self) -> str:
+        parts = []
+        if self.step is not None:
+            parts.append(f"урок {self.step}")
+        if self.since:
+            parts.append(f"с {datetime.fromtimestamp(self.since):%Y-%m-%d}")
+        if self.until is not None:
+            parts.append(f"по {datetime.fromtimestamp(self.until - 1):%Y-%m-%d}")
+        return ", ".join(parts) or "все"
+
+
+def parse_filter(args: List[str], step: Optional[int] = None) -> ExportFilter:
+    # Аргументы команды -> фильтр; ValueError с понятным текстом при ошибке
+    fmt, since, until = "csv", 0.0, None
+    for arg in args:
+        key, _, value = arg.partition("=")
+        key = key.lower()
+        if not value and key in FORMATS:
+            fmt = key
+        elif key == "step" and value.isdigit():
+            step = int(value)
+        elif key in ("from", "to"):
+            try:
+                day = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"Не понял дату: {arg}")
+            if key == "from":
+                since = day.timestamp()
+            else:
+                until = (day + timedelta(days=1)).timestamp()  # включительно весь день
+        else:
+            raise ValueError(f"Не понял аргумент: {arg}")
+    return ExportFilter(fmt, step, since, until)
+
+
+def _fmt_last(last: float) -> str:
+    return datetime.fromtimestamp(last).strftime("%Y-%m-%d %H:%M:%S") if last else ""
+
+
+async def write_export(rows: Iterable[Tuple[int, int, float]], flt: ExportFilter,
+                       spool_max: int = 8 * 1024 * 1024) -> Tuple[IO[bytes], int]:
+    # Возвращает (файл с gzip, позиция в начале; число строк). Обход хранилища идёт в потоке loop
+    # (SQLite-соединение нельзя отдавать в другой поток), но с передачей управления каждые YIELD_EVERY строк
+    out = tempfile.SpooledTemporaryFile(max_size=spool_max)
+    n = 0
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as gz:
+        if flt.fmt == "csv":
+            gz.write("chat_id,step,last\n".encode("utf-8"))
+        buf: List[str] = []
+        for cid, step, last in rows:
+            if not flt.match(step, last):
+                continue
+            if flt.fmt == "csv":
+                buf.append(f"{cid},{step},{_fmt_last(last)}\n")
+            else:
+                buf.append(json.dumps({"chat_id": cid, "step": step, "last": _fmt_last(last) or None}) + "\n")
+            n += 1
+            if len(buf) >= YIELD_EVERY:
+                gz.write("".join(buf).encode("utf-8"))
+                buf = []
+                await asyncio.sleep(0)
+        if buf:
+            gz.write("".join(buf).encode("utf-8"))
+    out.seek(0)
+    return out, n
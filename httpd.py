@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Минимальный HTTP/1.1-сервер на asyncio для служебных маршрутов (/health и т.п.).
+# Без зависимостей: run_webhook поднимает свой tornado-сервер, а сюда — только наши ручки.
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+log = logging.getLogger("bot.httpd")
+
+# handler(method, path, headers, body) -> (статус, content-type, тело)
+Response = Tuple[int, str, bytes]
+Handler = Callable[[str, str, Dict[str, str], bytes], Awaitable[Response]]
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large",
+           429: "Too Many Requests", 500: "Internal Server Error"}
+
+# Служебный порт слушает 0.0.0.0, а маршруты только GET: тело больше пары КБ и запрос, который тянется
+# дольше REQUEST_TIMEOUT (в том числе простой keep-alive между запросами), — повод закрыть соединение.
+# Это умолчания start_http_server; фейковый Bot API в bench/ принимает файлы и задаёт свои
+MAX_BODY = 4096
+MAX_HEADERS = 64
+REQUEST_TIMEOUT = 10.0
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+async def read_request(reader: asyncio.StreamReader,
+                       max_body: int = MAX_BODY) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers: Dict[str, str] = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise RequestTooLarge(f"больше {MAX_HEADERS} заголовков")
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length") or 0)
+    if length < 0:
+        raise ValueError(f"Content-Length {length}")
+    if length > max_body:
+        raise RequestTooLarge(f"тело {length} байт")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, ctype: str, body: bytes,
+                   extra: Optional[Dict[str, str]] = None) -> None:
+    head = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+            f"Content-Type: {ctype}", f"Content-Length: {len(body)}"]
+    for k, v in (extra or {}).items():
+        head.append(f"{k}: {v}")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+
+async def start_http_server(host: str, port: int, handler: Handler, max_body: int = MAX_BODY,
+                            timeout: Optional[float] = REQUEST_TIMEOUT) -> asyncio.AbstractServer:
+    # timeout=None — без ограничения времени на запрос
+    async def on_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:  # keep-alive: несколько запросов в одном соединении
+                try:
+                    req = await asyncio.wait_for(read_request(reader, max_body), timeout)
+                except asyncio.TimeoutError:
+                    break
+                except RequestTooLarge as e:
+                    log.warning(f"HTTP: запрос отклонён: {e}")
+                    write_response(writer, 413, "text/plain", b"request too large", {"Connection": "close"})
+                    await writer.drain()
+                    break
+                if req is None:
+                    break
+                method, target, headers, body = req
+                try:
+                    status, ctype, out = await handler(method, target, headers, body)
+                except Exception as e:
+                    log.warning(f"HTTP {method} {target}: {e}")
+                    status, ctype, out = 500, "text/plain", b"error"
+                write_response(writer, status, ctype, out)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass  # клиент ушёл или сервер останавливается
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_conn, host, port)
+
+
+def routes(table: Dict[str, Callable[[], Awaitable[Response]]]) -> Handler:
+    # Простая таблица GET-маршрутов: путь без query-строки -> обработчик
+    async def handler(method: str, target: str, headers: Dict[str, str], body: bytes) -> Response:
+        fn = table.get(target.split("?", 1)[0])
+        if fn is None:
+            return 404, "text/plain", b"not found"
+        if method not in ("GET", "HEAD"):
+            return 405, "text/plain", b"method not allowed"
+        return await fn()
+    return handler
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Метрики в формате Prometheus (text exposition 0.0.4) без сторонних библиотек.
+# Всё считается в памяти процесса: на горячем пути — словарь по меткам, bisect и пара сложений.
+# Отдаётся служебным HTTP-сервером по /metrics.
+
+import time
+import functools
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from telegram.request import HTTPXRequest
+
+import profiler
+
+# Границы бакетов (сек): от быстрых ответов из памяти до долгих загрузок файлов
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_METRICS: List["_Metric"] = []
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        _METRICS.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in sorted(self.values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.bounds = tuple(buckets)
+        # метки -> [счётчики по бакетам (последний — +Inf), сумма, количество]
+        self.series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.bounds) + 1), 0.0, 0]
+        s[0][bisect_left(self.bounds, value)] += 1
+        s[1] += value
+        s[2] += 1
+
+    def samples(self) -> List[str]:
+        out: List[str] = []
+        for k, (counts, total, n) in sorted(self.series.items()):
+            acc = 0
+            for bound, c in zip(self.bounds + (float("inf"),), counts):
+                acc += c
+                le = 'le="' + _fmt(bound) + '"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {n}")
+        return out
+
+
+class Gauge(_Metric):
+    # Значение читается в момент запроса /metrics: fn() -> число или {(метки,): число}
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def samples(self) -> List[str]:
+        v = self.fn()
+        if isinstance(v, dict):
+            return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(x)}" for k, x in sorted(v.items())]
+        return [f"{self.name} {_fmt(v)}"]
+
+
+def render() -> bytes:
+    lines: List[str] = []
+    for m in _METRICS:
+        try:
+            lines.extend(m.render())
+        except Exception as e:  # одна сломанная метрика не должна ронять весь /metrics
+            lines.append(f"# {m.name}: {_escape(e)}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# ===== МЕТРИКИ БОТА =====
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта по обработчику", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+API_SECONDS = Histogram("bot_api_request_seconds", "Время запроса к Bot API по методу", ["method"])
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки Bot API по методу и коду (0 — сетевая ошибка)",
+                     ["method", "code"])
+TICK_SECONDS = Histogram("bot_tick_seconds", "Длительность tick")
+TICK_USERS = Histogram("bot_tick_due_users", "Пользователей к выдаче за один tick",
+                       buckets=(0, 1, 10, 100, 1000, 10000, 100000))
+DELIVERED = Counter("bot_lessons_delivered_total", "Уроков доставлено рассылкой")
+BLOCKED = Counter("bot_users_blocked_total", "Пользователей, заблокировавших бота (рассылка им остановлена)")
+FLUSH_SECONDS = Histogram("bot_state_flush_seconds", "Длительность сброса состояния на диск",
+                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+FLUSH_BYTES = Counter("bot_state_flush_bytes_total", "Байт записано при сбросах состояния")
+UPLOAD_BYTES = Counter("bot_upload_bytes_total", "Байт файлов залито в Telegram (без повторов по file_id)")
+UPLOADS = Counter("bot_uploads_total", "Отправок файлов: upload — заливка, cached — по file_id", ["kind"])
+UPLOAD_FLIGHTS = Counter("bot_upload_flights_total",
+                         "Заливки одного файла: leader — заливал сам, coalesced — дождался чужой и отправил file_id",
+                         ["role"])
+
+
+def timed(name: str, fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    # Обёртка обработчика: время и исключения по имени
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(1, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, name)
+    return wrapper
+
+
+class MeteredRequest(HTTPXRequest):
+    # HTTPXRequest, который меряет каждый запрос к Bot API; метод — последний сегмент URL
+    async def do_request(self, url: str, method: str, request_data: Optional[Any] = None,
+                         *args: Any, **kwargs: Any) -> Tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(1, api_method, "0")
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            API_SECONDS.observe(dt, api_method)
+            profiler.note("api", api_method, dt)
+        if code >= 400:
+            API_ERRORS.inc(1, api_method, str(code))
+        return code, payload
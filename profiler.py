@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Профилирование обработчиков (включается PROFILE=1).
+# Каждый обработчик и tick выполняются внутри Trace: сколько ушло на запросы к Bot API,
+# сколько простояли в лимитере и сколько — своё время (CPU, диск). Медленные операции
+# пишутся в slow.log с разбивкой по шагам; /slow показывает самые медленные с момента запуска.
+# Дополнительно (PROFILE_CPROFILE=1) — cProfile, который раз в минуту перезапускается,
+# чтобы всегда был под рукой профиль последней минуты.
+
+import io
+import os
+import json
+import time
+import heapq
+import pstats
+import cProfile
+import logging
+import functools
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+log = logging.getLogger("bot.profiler")
+
+_CURRENT: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+class Trace:
+    __slots__ = ("op", "started", "t0", "api", "wait", "spans")
+
+    def __init__(self, op: str) -> None:
+        self.op = op
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.api = 0.0    # ожидание ответов Bot API
+        self.wait = 0.0   # ожидание в лимитере
+        self.spans: List[Tuple[str, float]] = []  # (шаг, сек) в порядке завершения
+
+    def report(self, total: float) -> Dict[str, Any]:
+        slowest = sorted(self.spans, key=lambda s: -s[1])[:8]
+        return {
+            "at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "op": self.op,
+            "total_ms": round(total * 1000, 1),
+            "api_ms": round(self.api * 1000, 1),
+            "wait_ms": round(self.wait * 1000, 1),
+            "local_ms": round(max(0.0, total - self.api - self.wait) * 1000, 1),
+            "steps": [[name, round(sec * 1000, 1)] for name, sec in slowest],
+        }
+
+
+def note(kind: str, label: str, seconds: float) -> None:
+    # Вызывается из запросов к API ("api") и лимитера ("wait"); вне Trace ничего не делает
+    tr = _CURRENT.get()
+    if tr is None:
+        return
+    if kind == "api":
+        tr.api += seconds
+    elif kind == "wait":
+        tr.wait += seconds
+    tr.spans.append((f"{kind}:{label}", seconds))
+
+
+@contextmanager
+def step(label: str) -> Iterator[None]:
+    # Именованный шаг внутри обработчика (время включает вложенные вызовы API)
+    tr = _CURRENT.get()
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tr.spans.append((label, time.perf_counter() - t0))
+
+
+class Profiler:
+    def __init__(self, slow_ms: float, log_path: str, keep: int = 50, log_max_bytes: int = 5 * 1024 * 1024) -> None:
+        self.slow_s = slow_ms / 1000
+        self.log_path = log_path
+        self.keep = keep
+        self.log_max_bytes = log_max_bytes
+        self.slowest: List[Tuple[float, int, Dict[str, Any]]] = []  # min-куча из keep самых медленных
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=keep)   # последние медленные
+        self.seq = 0
+        self.stats: Dict[str, float] = {"traces": 0, "slow": 0}
+        self.cprofile: Optional[cProfile.Profile] = None
+        self.cprofile_every = 0   # 0 — cProfile выключен; N — профилируем каждую N-ю минуту
+        self.minute = 0
+        self.last_profile = ""    # текстовый отчёт pstats за последнюю профилированную минуту
+        self.last_profile_at = 0.0
+
+    def wrap(self, op: str, fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(fn)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            tr = Trace(op)
+            token = _CURRENT.set(tr)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _CURRENT.reset(token)
+                self._finish(tr, time.perf_counter() - tr.t0)
+        return wrapper
+
+    def _finish(self, tr: Trace, total: float) -> None:
+        self.stats["traces"] += 1
+        if len(self.slowest) >= self.keep and total <= self.slowest[0][0] and total < self.slow_s:
+            return
+        rep = tr.report(total)
+        self.seq += 1
+        item = (total, self.seq, rep)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, item)
+        elif total > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+        if total >= self.slow_s:
+            self.stats["slow"] += 1
+            self.recent.append(rep)
+            self._write(rep)
+
+    def _write(self, rep: Dict[str, Any]) -> None:
+        try:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.log_max_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rep, ensure_ascii=False) + "\n")
+        except Exception as e:
+            log.warning(f"Не удалось записать {self.log_path}: {e}")
+
+    def top(self, n: int) -> List[Dict[str, Any]]:
+        return [rep for _, _, rep in heapq.nlargest(n, self.slowest)]
+
+    # ===== cProfile последней минуты =====
+    def start_cprofile(self, every: int = 1) -> None:
+        self.cprofile_every = max(1, every)
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def rotate_cprofile(self) -> None:
+        # Раз в минуту: снимаем отчёт с текущего профиля и, если эта минута попадает в выборку, запускаем новый
+        if not self.cprofile_every:
+            return
+        self.minute += 1
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            out = io.StringIO()
+            pstats.Stats(self.cprofile, stream=out).sort_stats("cumulative").print_stats(40)
+            self.last_profile = out.getvalue()
+            self.last_profile_at = time.time()
+            self.cprofile = None
+        if self.minute % self.cprofile_every == 0:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+
+def format_report(rep: Dict[str, Any]) -> str:
+    steps = ", ".join(f"{name} {ms:.0f}" for name, ms in rep["steps"][:5])
+    return (f"{rep['at']} {rep['op']}: {rep['total_ms']:.0f} мс "
+            f"(API {rep['api_ms']:.0f}, лимитер {rep['wait_ms']:.0f}, своё {rep['local_ms']:.0f})"
+            + (f"\n   шаги: {steps}" if steps else ""))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Шардированная рассылка: пользователи делятся на shards частей по chat_id, каждую часть
+# выдаёт ровно один процесс. Кто чем владеет — в общем файле аренды DATA_DIR/leases.json:
+#   {"workers": {id: истекает}, "shards": {"номер": [id, истекает]}}
+# Каждый процесс раз в ttl/3 продлевает свою аренду и перераспределяет части: на живого
+# воркера приходится ceil(shards / живых). Упавший воркер перестаёт продлевать — через ttl
+# его части забирают остальные. Изменения файла — под flock на leases.json.lock.
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from storage import atomic_write
+
+log = logging.getLogger("bot.shards")
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    # Как ((chat_id % n) + n) % n в SQL: у SQLite остаток от отрицательного числа отрицательный
+    return chat_id % shards
+
+
+class ShardLeases:
+    def __init__(self, path: str, shards: int, worker_id: str, ttl: float = 30.0) -> None:
+        self.path = path
+        self.shards = shards
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.owned: Dict[int, float] = {}  # часть -> до какого времени наша аренда
+        self.draining: Set[int] = set()    # отдаём: новых выдач нет, аренда снимается на следующем цикле
+        self.in_flight: Dict[int, int] = {}  # часть -> начатых выдач (hold), которые ещё не закончились
+        self.stats: Dict[str, float] = {"renewals": 0, "acquired": 0, "released": 0, "lost": 0, "held": 0,
+                                      "workers": 0}
+
+    def owns(self, chat_id: int) -> bool:
+        # Выдавать можно, пока до конца аренды больше трети ttl (запас на пропущенное продление)
+        s = shard_of(chat_id, self.shards)
+        return s not in self.draining and self.owned.get(s, 0.0) - self.ttl / 3 > time.time()
+
+    def handing_over(self, chat_id: int) -> bool:
+        # Часть отдаём или уже не наша (аренда истекла). False при owns() == False значит:
+        # часть наша, просто аренда близка к концу — после продления выдачи продолжатся
+        s = shard_of(chat_id, self.shards)
+        return s in self.draining or self.owned.get(s, 0.0) <= time.time()
+
+    @contextmanager
+    def hold(self, chat_id: int) -> Iterator[None]:
+        # Выдача в полёте: пока она не закончилась, отдаваемую часть не снимаем. Отправка может
+        # ждать RetryAfter дольше цикла продления — иначе новый владелец выдал бы тот же урок ещё раз
+        s = shard_of(chat_id, self.shards)
+        self.in_flight[s] = self.in_flight.get(s, 0) + 1
+        try:
+            yield
+        finally:
+            self.in_flight[s] -= 1
+            if not self.in_flight[s]:
+                del self.in_flight[s]
+
+    def active(self) -> List[int]:
+        limit = time.time() + self.ttl / 3
+        return sorted(s for s, exp in self.owned.items() if s not in self.draining and exp > limit)
+
+    def _rank(self, shard: int) -> int:
+        # Rendezvous-хэш: у каждого воркера свой порядок предпочтения частей — меньше переездов
+        return zlib.crc32(f"{self.worker_id}:{shard}".encode("utf-8"))
+
+    @contextmanager
+    def _locked(self) -> Iterator[Dict[str, Any]]:
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                table: Dict[str, Any] = {"workers": {}, "shards": {}}
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        table.update(json.load(f))
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    log.warning(f"Не удалось прочитать {self.path}, начинаем заново: {e}")
+                yield table
+                atomic_write(self.path, json.dumps(table, separators=(",", ":")).encode("utf-8"))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def renew(self) -> Tuple[List[int], List[int]]:
+        # Продление + перераспределение. Возвращает (полученные части, потерянные не по своей воле)
+        now = time.time()
+        expires = now + self.ttl
+        with self._locked() as table:
+            workers = {w: e for w, e in table["workers"].items() if e > now}
+            workers[self.worker_id] = expires
+            leases = {int(s): v for s, v in table["shards"].items() if v[1] > now}
+            mine = {s for s, (owner, _) in leases.items() if owner == self.worker_id}
+
+            lost = sorted(set(self.owned) - mine)
+            # отдаваемые с прошлого цикла: новых выдач нет, и если начатые закончились — снимаем аренду
+            for s in self.draining & mine:
+                if self.in_flight.get(s):
+                    self.stats["held"] += 1
+                    continue
+                del leases[s]
+                mine.discard(s)
+                self.stats["released"] += 1
+            self.draining = set()
+
+            target = -(-self.shards // len(workers))
+            gained: List[int] = []
+            if len(mine) > target:
+                # лишние части помечаем к отдаче, аренду держим ещё цикл, пока дорабатывают воркеры
+                self.draining = set(sorted(mine, key=self._rank)[target:])
+            else:
+                free = sorted((s for s in range(self.shards) if s not in leases), key=self._rank)
+                gained = free[:target - len(mine)]
+                mine.update(gained)
+            for s in mine:
+                leases[s] = [self.worker_id, expires]
+
+            table["workers"] = workers
+            table["shards"] = {str(s): v for s, v in sorted(leases.items())}
+
+        self.owned = {s: expires for s in mine}
+        self.stats["renewals"] += 1
+        self.stats["acquired"] += len(gained)
+        self.stats["lost"] += len(lost)
+        self.stats["workers"] = len(workers)
+        if gained or lost or self.draining:
+            log.info(f"Шарды: воркеров {len(workers)}, мои {sorted(mine)} (+{gained}, потеряны {lost}, "
+                     f"отдаю {sorted(self.draining)})")
+        return gained, lost
+
+    def release_all(self) -> None:
+        # При остановке: свои части и запись о воркере убираем сразу, чтобы их не ждали ttl
+        try:
+            with self._locked() as table:
+                table["workers"].pop(self.worker_id, None)
+                table["shards"] = {s: v for s, v in table["shards"].items() if v[0] != self.worker_id}
+        except Exception as e:
+            log.warning(f"Не удалось снять аренду шардов: {e}")
+        self.stats["released"] += len(self.owned)
+        self.owned = {}
+        self.draining = set()
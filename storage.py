@@ -0,0 +1,1399 @@
+# -*- coding: utf-8 -*-
+# Хранилище прогресса пользователей.
+# Три варианта с одинаковым интерфейсом Store:
+#   JsonStore   — всё в памяти (компактная UserTable), на диске бинарный снимок state.snap + журнал
+#                 state.journal (старый state.json читается для переноса)
+#   MmapStore   — state.bin: записи фиксированной ширины в mmap, изменение урока — запись на месте
+#   SqliteStore — state.db (WAL), выборки через индексы по step и времени следующей выдачи
+# chat_id везде int, last — unix-время (0 — «никогда»).
+
+import os
+import sys
+import csv
+import json
+import mmap
+import time
+import heapq
+import struct
+import zlib
+import sqlite3
+import asyncio
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from operator import itemgetter
+from datetime import datetime
+from typing import IO, Callable, Dict, Any, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+
+log = logging.getLogger("bot.storage")
+
+# Шардированная рассылка (см. shards.py): (всего частей, номера своих частей); None — все пользователи
+Shards = Optional[Tuple[int, List[int]]]
+
+
+def ts_to_iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts).isoformat() if ts else datetime.min.isoformat()
+
+
+def iso_to_ts(last: Optional[str]) -> float:
+    if not last:
+        return 0.0
+    dt = datetime.fromisoformat(last)
+    return 0.0 if dt == datetime.min else dt.timestamp()
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    # Пишем во временный файл и подменяем им старый: при падении на диске остаётся целая версия
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Store:
+    # interval — пауза между уроками (сек), max_step — последний урок (после него выдача не планируется)
+    def __init__(self, interval: float, max_step: int) -> None:
+        self.interval = interval
+        self.max_step = max_step
+        self.stats: Dict[str, float] = {
+            "runs": 0, "popped_last": 0, "due_last": 0, "popped_total": 0,
+            "flushes": 0, "marks": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0,
+        }
+        self.on_flush: Optional[Callable[[float, int], None]] = None  # (секунды, байт) — для метрик
+        # Пользователей на каждом уроке: считаются один раз при загрузке, дальше — в put()
+        self.counts: Dict[int, int] = {}
+        # Заблокировавшие бота (JsonStore, MmapStore; у SqliteStore — колонка blocked): шаг не меняется,
+        # в расписание не попадают до put() или unblock(). Файл blocked_file пишется при flush()
+        self.blocked: Set[int] = set()
+        self.blocked_file: Optional[str] = None
+        self._blocked_dirty = False
+
+    def due_ts(self, step: int, last: float) -> Optional[float]:
+        if step >= self.max_step:
+            return None
+        return last + self.interval if last else 0.0
+
+    def load(self) -> None:
+        raise NotImplementedError
+
+    def set_max_step(self, max_step: int) -> None:
+        # Каталог уроков вырос — тем, кто был на последнем уроке, снова планируем выдачу
+        if max_step != self.max_step:
+            self.max_step = max_step
+            self._reschedule()
+
+    def _reschedule(self) -> None:
+        raise NotImplementedError
+
+    def get(self, chat_id: int) -> Optional[Tuple[int, float]]:
+        raise NotImplementedError
+
+    def put(self, chat_id: int, step: int, last: float) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def count_by_step(self) -> Dict[int, int]:
+        return {step: n for step, n in self.counts.items() if n}
+
+    def _count(self, old_step: Optional[int], step: int) -> None:
+        if old_step == step:
+            return
+        if old_step is not None:
+            self.counts[old_step] -= 1
+        self.counts[step] = self.counts.get(step, 0) + 1
+
+    def iter_users(self, step: Optional[int] = None) -> Iterator[Tuple[int, int, float]]:
+        raise NotImplementedError
+
+    # Пользователь заблокировал бота: урок не засчитываем, из расписания убираем до put()/unblock()
+    def block(self, chat_id: int) -> None:
+        self.blocked.add(chat_id)
+        self._blocked_dirty = True
+
+    # /start после блокировки: снова в расписание с того же урока. False — блокировки не было
+    def unblock(self, chat_id: int) -> bool:
+        if chat_id not in self.blocked:
+            return False
+        st = self.get(chat_id)
+        if st is None:
+            self._clear_block(chat_id)
+        else:
+            self.put(chat_id, st[0], st[1])  # put() снимает блокировку и планирует выдачу
+        return True
+
+    def _clear_block(self, chat_id: int) -> None:
+        if chat_id in self.blocked:
+            self.blocked.discard(chat_id)
+            self._blocked_dirty = True
+
+    def _load_blocked(self) -> None:
+        self.blocked = set()
+        self._blocked_dirty = False
+        if self.blocked_file is None or not os.path.exists(self.blocked_file):
+            return
+        try:
+            with open(self.blocked_file, "r", encoding="utf-8") as f:
+                self.blocked = set(json.load(f))
+        except Exception as e:
+            log.warning(f"Не удалось прочитать {self.blocked_file}: {e}")
+
+    def _save_blocked(self) -> None:
+        if not self._blocked_dirty or self.blocked_file is None:
+            return
+        try:
+            atomic_write(self.blocked_file, json.dumps(sorted(self.blocked)).encode("utf-8"))
+            self._blocked_dirty = False
+        except Exception as e:
+            log.warning(f"Не удалось записать {self.blocked_file}: {e}")
+
+    # Страница пользователей в порядке (step, last, chat_id), строго после/до строки cursor
+    # (chat_id, step, last) — курсор берётся из крайней строки предыдущей страницы.
+    # step — только этот урок; backward — страница перед курсором (строки всё равно по возрастанию)
+    def page(self, cursor: Optional[Tuple[int, int, float]], limit: int, step: Optional[int] = None,
+             backward: bool = False) -> List[Tuple[int, int, float]]:
+        raise NotImplementedError
+
+    # Можно ли звать page() без ожидания. JsonStore/MmapStore строят индекс для page() в фоне
+    # по первому вызову этого метода — бот, которым не листают /users, не держит его в памяти
+    def page_ready(self) -> bool:
+        return True
+
+    # Забирает пользователей, которым пора выдать урок: [(chat_id, step)].
+    # Забранные выпадают из расписания до следующего put(); shards — только из своих частей
+    def pop_due(self, now: float, shards: Shards = None) -> List[Tuple[int, int]]:
+        raise NotImplementedError
+
+    def next_due(self, shards: Shards = None) -> Optional[float]:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.flush()
+
+    def _record_pop(self, popped: int, due: int) -> None:
+        self.stats["runs"] += 1
+        self.stats["popped_last"] = popped
+        self.stats["due_last"] = due
+        self.stats["popped_total"] += popped
+
+    def _record_flush(self, t0: float, nbytes: int = 0) -> None:
+        ms = (time.perf_counter() - t0) * 1000
+        self.stats["flushes"] += 1
+        self.stats["last_flush_ms"] = ms
+        self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], ms)
+        if self.on_flush is not None:
+            self.on_flush(ms / 1000, nbytes)
+
+
+# ===== users.csv: кто и когда впервые нажал /start =====
+class UserRegistry:
+    # Множество id читаем из файла один раз при старте, новые строки дописываем пачками
+    def __init__(self, path: str, max_pending: int = 500) -> None:
+        self.path = path
+        self.max_pending = max_pending
+        self.seen: Set[int] = set()
+        self.pending: List[Tuple[int, str]] = []
+
+    def load(self) -> None:
+        self.seen = set()
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r", newline="", encoding="utf-8") as f:
+                    for row in csv.reader(f):
+                        if row and row[0].lstrip("-").isdigit():
+                            self.seen.add(int(row[0]))
+        except Exception as e:
+            log.warning(f"Не удалось прочитать {self.path}: {e}")
+        log.info(f"{os.path.basename(self.path)}: известно {len(self.seen)} id")
+
+    def add(self, chat_id: int, when: datetime) -> bool:
+        if chat_id in self.seen:
+            return False
+        self.seen.add(chat_id)
+        self.pending.append((chat_id, when.isoformat()))
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+        return True
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        try:
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerows(self.pending)
+            self.pending = []
+        except Exception as e:
+            log.warning(f"Не удалось обновить {self.path}: {e}")
+
+
+# ===== Таблица пользователей в памяти =====
+class UserTable:
+    # Колонки array, отсортированные по chat_id: int64 id, uint8 step (до 255 уроков), uint32 last
+    # (unix-секунды) — 13 байт на пользователя против ~150 у dict с кортежами. Поиск — bisect.
+    # Новые пользователи сначала попадают в небольшой dict fresh и вливаются в колонки пачкой,
+    # когда его размер дорастёт до 1/16 таблицы: вставка в середину array не делается по одной.
+    MERGE_MIN = 4096
+
+    def __init__(self) -> None:
+        self.ids = array("q")
+        self.steps = array("B")
+        self.lasts = array("I")
+        self.fresh: Dict[int, Tuple[int, int]] = {}
+
+    @classmethod
+    def from_columns(cls, ids: array, steps: array, lasts: array) -> "UserTable":
+        # Массовая загрузка: колонки в любом порядке, без повторов id
+        t = cls()
+        if all(a < b for a, b in zip(ids, islice(ids, 1, None))):
+            t.ids, t.steps, t.lasts = ids, steps, lasts  # снимок пишется по возрастанию id — сортировать нечего
+            return t
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        t.ids = array("q", [ids[i] for i in order])
+        t.steps = array("B", [steps[i] for i in order])
+        t.lasts = array("I", [lasts[i] for i in order])
+        return t
+
+    def copy(self) -> "UserTable":
+        self._merge()
+        t = UserTable()
+        t.ids, t.steps, t.lasts = array("q", self.ids), array("B", self.steps), array("I", self.lasts)
+        return t
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.fresh)
+
+    def _find(self, chat_id: int) -> int:
+        i = bisect_left(self.ids, chat_id)
+        return i if i < len(self.ids) and self.ids[i] == chat_id else -1
+
+    def get(self, chat_id: int) -> Optional[Tuple[int, int]]:
+        st = self.fresh.get(chat_id)
+        if st is not None:
+            return st
+        i = self._find(chat_id)
+        return (self.steps[i], self.lasts[i]) if i >= 0 else None
+
+    def set(self, chat_id: int, step: int, last: int) -> None:
+        if chat_id not in self.fresh:
+            i = self._find(chat_id)
+            if i >= 0:
+                self.steps[i] = step
+                self.lasts[i] = last
+                return
+        self.fresh[chat_id] = (step, last)
+        if len(self.fresh) >= max(self.MERGE_MIN, len(self.ids) >> 4):
+            self._merge()
+
+    def set_many(self, ids: Iterable[int], steps: Iterable[int], lasts: Iterable[int]) -> None:
+        # Массовое set() (журнал при загрузке), при повторах id побеждает более поздняя запись.
+        # Журнал у порога сжатия — сотни тысяч записей, поштучный bisect по array занимает секунды.
+        # Поэтому dict id -> значение по журналу и новые колонки одним map(dict.pop/get, ids, прежние):
+        # pop убирает найденных, и в new_steps остаются только новые пользователи
+        self._merge()
+        new_steps, new_lasts = dict(zip(ids, steps)), dict(zip(ids, lasts))
+        if len(new_steps) * 16 < len(self.ids):
+            for cid, step in new_steps.items():
+                self.set(cid, step, new_lasts[cid])
+            return
+        table = self.ids.tolist()
+        self.lasts = array("I", map(new_lasts.get, table, self.lasts))
+        self.steps = array("B", map(new_steps.pop, table, self.steps))
+        self.fresh = {cid: (step, new_lasts[cid]) for cid, step in new_steps.items()}
+        self._merge()
+
+    def _merge(self) -> None:
+        # Сливаем fresh в колонки: между вставками копируем куски срезами (это C, а не цикл Python)
+        if not self.fresh:
+            return
+        ids, steps, lasts = array("q"), array("B"), array("I")
+        prev = 0
+        for cid, (step, last) in sorted(self.fresh.items()):
+            i = bisect_left(self.ids, cid, prev)
+            ids += self.ids[prev:i]
+            steps += self.steps[prev:i]
+            lasts += self.lasts[prev:i]
+            ids.append(cid)
+            steps.append(step)
+            lasts.append(last)
+            prev = i
+        ids += self.ids[prev:]
+        steps += self.steps[prev:]
+        lasts += self.lasts[prev:]
+        self.ids, self.steps, self.lasts = ids, steps, lasts  # старые колонки остаются у текущих итераторов
+        self.fresh = {}
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        self._merge()
+        return zip(self.ids, self.steps, self.lasts)
+
+    def with_step(self, step: int) -> Iterator[Tuple[int, int, int]]:
+        # Поиск байта по колонке step вместо сравнения в цикле
+        self._merge()
+        ids, lasts, raw, b = self.ids, self.lasts, self.steps.tobytes(), bytes([step])
+        i = raw.find(b)
+        while i >= 0:
+            yield ids[i], step, lasts[i]
+            i = raw.find(b, i + 1)
+
+    def count_by_step(self) -> Dict[int, int]:
+        out: Dict[int, int] = {}
+        if self.steps:
+            raw = self.steps.tobytes()
+            for step in range(max(self.steps) + 1):
+                c = raw.count(bytes([step]))
+                if c:
+                    out[step] = c
+        for step, _ in self.fresh.values():
+            out[step] = out.get(step, 0) + 1
+        return out
+
+
+# ===== Упорядоченный индекс (step, last, chat_id) для постраничного просмотра =====
+_CID_BIAS = 1 << 63  # chat_id бывает отрицательным (группы)
+
+
+def order_key(chat_id: int, step: int, last: float) -> int:
+    # (step, last, chat_id) в одном int: сравнение ключей = сравнение кортежей
+    return (step << 96) | (int(last) << 64) | (chat_id + _CID_BIAS)
+
+
+def order_row(key: int) -> Tuple[int, int, int]:
+    return (key & ((1 << 64) - 1)) - _CID_BIAS, key >> 96, (key >> 64) & 0xFFFFFFFF
+
+
+class SortedKeys:
+    # Отсортированные int-ключи блоками по ~LOAD штук: вставка/удаление — bisect по максимумам
+    # блоков и insort внутри одного блока, без сдвига всего списка
+    LOAD = 1000
+
+    def __init__(self, keys: Iterable[int] = ()) -> None:
+        keys = sorted(keys)
+        self.blocks: List[List[int]] = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self.maxes: List[int] = [b[-1] for b in self.blocks]
+
+    def add(self, key: int) -> None:
+        if not self.blocks:
+            self.blocks, self.maxes = [[key]], [key]
+            return
+        i = min(bisect_left(self.maxes, key), len(self.blocks) - 1)
+        b = self.blocks[i]
+        insort(b, key)
+        self.maxes[i] = b[-1]
+        if len(b) > 2 * self.LOAD:
+            self.blocks[i:i + 1] = [b[:self.LOAD], b[self.LOAD:]]
+            self.maxes[i:i + 1] = [b[self.LOAD - 1], b[-1]]
+
+    def discard(self, key: int) -> None:
+        i = bisect_left(self.maxes, key)
+        if i == len(self.blocks):
+            return
+        b = self.blocks[i]
+        j = bisect_left(b, key)
+        if j < len(b) and b[j] == key:
+            del b[j]
+            if b:
+                self.maxes[i] = b[-1]
+            else:
+                del self.blocks[i], self.maxes[i]
+
+    def after(self, key: int) -> Iterator[int]:
+        # Ключи > key по возрастанию
+        i = bisect_right(self.maxes, key)
+        if i < len(self.blocks):
+            b = self.blocks[i]
+            yield from b[bisect_right(b, key):]
+        for i in range(i + 1, len(self.blocks)):
+            yield from self.blocks[i]
+
+    def before(self, key: int) -> Iterator[int]:
+        # Ключи < key по убыванию
+        i = bisect_left(self.maxes, key)
+        if i < len(self.blocks):
+            b = self.blocks[i]
+            yield from reversed(b[:bisect_left(b, key)])
+        for i in range(min(i, len(self.blocks)) - 1, -1, -1):
+            yield from reversed(self.blocks[i])
+
+
+def build_order(rows: Iterable[Tuple[int, int, float]]) -> SortedKeys:
+    t0 = time.perf_counter()
+    order = SortedKeys(order_key(cid, s, last) for cid, s, last in rows)
+    log.info(f"Индекс для /users построен за {(time.perf_counter() - t0) * 1000:.0f} мс")
+    return order
+
+
+class OrderIndex:
+    # SortedKeys для page(), построенный в фоновом потоке: на миллионе пользователей это ~1.5 с,
+    # и построение в page() стояло бы в event loop. rows — копия данных (поток читает только её);
+    # put() за время построения копятся в log и применяются в потоке loop при первом get()
+    def __init__(self, rows: Iterable[Tuple[int, int, float]]) -> None:
+        self._order: Optional[SortedKeys] = None
+        self._log: List[Tuple[int, Optional[Tuple[int, float]], int, int]] = []
+        self._thread: Optional[threading.Thread] = threading.Thread(
+            target=self._build, args=(rows,), name="order-index", daemon=True)
+        self._thread.start()
+
+    def _build(self, rows: Iterable[Tuple[int, int, float]]) -> None:
+        self._order = build_order(rows)
+
+    def update(self, chat_id: int, old: Optional[Tuple[int, float]], step: int, last: int) -> None:
+        if self._thread is not None:
+            self._log.append((chat_id, old, step, last))
+            return
+        if old is not None:
+            self._order.discard(order_key(chat_id, *old))
+        self._order.add(order_key(chat_id, step, last))
+
+    def ready(self) -> bool:
+        return self._thread is None or not self._thread.is_alive()
+
+    def get(self) -> SortedKeys:
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            for entry in self._log:
+                self.update(*entry)
+            self._log = []
+        return self._order
+
+
+def page_keys(order: SortedKeys, cursor: Optional[Tuple[int, int, float]], limit: int,
+              step: Optional[int] = None, backward: bool = False) -> List[Tuple[int, int, float]]:
+    # Store.page() поверх SortedKeys (JsonStore, MmapStore)
+    if cursor is not None:
+        key = order_key(*cursor)
+    elif backward:
+        key = (step + 1) << 96 if step is not None else 1 << 200
+    else:
+        key = (step << 96) - 1 if step is not None else -1
+    rows: List[Tuple[int, int, float]] = []
+    for k in (order.before(key) if backward else order.after(key)):
+        row = order_row(k)
+        if step is not None and row[1] != step:
+            break
+        rows.append(row)
+        if len(rows) >= limit:
+            break
+    return rows[::-1] if backward else rows
+
+
+# ===== Бинарный снимок UserTable: заголовок + колонки как есть (little-endian) =====
+SNAP_MAGIC = b"BOTSNAP\0"
+SNAP_VERSION = 1
+_SNAP_HEADER = struct.Struct("<8sIIQ")  # магия, версия, crc32 колонок, пользователей
+
+
+def _le(a: array) -> bytes:
+    if sys.byteorder != "little":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def write_snap(path: str, table: UserTable) -> int:
+    # table — копия без fresh (UserTable.copy): колонки уже отсортированы по chat_id
+    cols = [_le(table.ids), _le(table.steps), _le(table.lasts)]
+    crc = 0
+    for c in cols:
+        crc = zlib.crc32(c, crc)
+    data = _SNAP_HEADER.pack(SNAP_MAGIC, SNAP_VERSION, crc, len(table.ids)) + b"".join(cols)
+    atomic_write(path, data)
+    return len(data)
+
+
+def read_snap(path: str) -> UserTable:
+    with open(path, "rb") as f:
+        raw = f.read()
+    magic, version, crc, n = _SNAP_HEADER.unpack_from(raw, 0)
+    if magic != SNAP_MAGIC or version != SNAP_VERSION:
+        raise ValueError(f"{path}: не снимок состояния (или версия {version} неизвестна)")
+    t = UserTable()
+    pos = _SNAP_HEADER.size
+    for col in (t.ids, t.steps, t.lasts):
+        size = n * col.itemsize
+        col.frombytes(raw[pos:pos + size])
+        pos += size
+    if pos != len(raw) or zlib.crc32(raw[_SNAP_HEADER.size:]) != crc:
+        raise ValueError(f"{path}: снимок повреждён (размер или crc32 не сходятся)")
+    if sys.byteorder != "little":
+        for col in (t.ids, t.lasts):
+            col.byteswap()
+    return t
+
+
+# ===== Журнал: строка заголовка + записи по 3 int64 little-endian (chat_id, step, last в unix-секундах) =====
+# Фиксированные записи, а не строки JSON: разбор json.loads + fromisoformat на каждую строку занимал
+# секунды на сотнях тысяч строк, а так журнал читается одним frombytes
+JOURNAL_HEADER = b"#journal 1\n"
+_JREC_SIZE = 24
+
+
+def journal_records(rows: Iterable[Tuple[int, int, int]]) -> bytes:
+    flat = array("q")
+    for row in rows:
+        flat.extend(row)
+    return _le(flat)
+
+
+# ===== JSON: снимок + журнал, расписание — куча в памяти =====
+class JsonStore(Store):
+    # state_file — state.json прежнего формата: читается, только если ещё нет снимка snap_file
+    # (по умолчанию рядом, .snap). Первый записанный снимок переименовывает его в .json.bak
+    def __init__(self, state_file: str, journal_file: str, interval: float, max_step: int,
+                 max_dirty: int = 500, compact_ratio: float = 1.0, compact_min: int = 1024 * 1024,
+                 snap_file: Optional[str] = None) -> None:
+        super().__init__(interval, max_step)
+        self.state_file = state_file
+        self.snap_file = snap_file or os.path.splitext(state_file)[0] + ".snap"
+        self.blocked_file = os.path.splitext(self.snap_file)[0] + ".blocked"
+        self.journal_file = journal_file
+        self.max_dirty = max_dirty
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.users = UserTable()
+        self.dirty: Set[int] = set()  # chat_id, изменённые после последнего сброса
+        # (время следующей выдачи, chat_id). Старые записи не удаляем, а пропускаем при извлечении
+        self.heap: List[Tuple[float, int]] = []
+        # Порядок для /users: строится в фоне по первому page_ready(), дальше поддерживается в put()
+        self.order: Optional[OrderIndex] = None
+        self._compacting = False
+        self.stats.update({
+            "heap": 0, "stale_total": 0, "last_bytes": 0, "bytes_total": 0,
+            "journal_bytes": 0, "compactions": 0, "last_compact_ms": 0.0,
+        })
+
+    # --- загрузка ---
+    def load(self) -> None:
+        self.users = UserTable()
+        self.order = None
+        try:
+            if os.path.exists(self.snap_file):
+                self.users = self._read_snap_or_exit()
+            elif os.path.exists(self.state_file) and os.path.getsize(self.state_file) > 0:
+                log.info(f"Снимка {self.snap_file} ещё нет — читаю {self.state_file}")
+                with open(self.state_file, "r", encoding="utf-8") as f:
+                    raw = json.load(f)
+                ids, steps, lasts = array("q"), array("B"), array("I")
+                for cid, st in raw.items():
+                    ids.append(int(cid))
+                    steps.append(st.get("step", 1))
+                    lasts.append(int(iso_to_ts(st.get("last"))))
+                del raw
+                self.users = UserTable.from_columns(ids, steps, lasts)
+            else:
+                log.info("STATE не найден или пуст — начнём с нуля")
+        except Exception as e:
+            log.warning(f"Не удалось загрузить состояние: {e}")
+            self.users = UserTable()
+        replayed = self._replay_journal()
+        self._load_blocked()
+        self.counts = self.users.count_by_step()
+        self._reschedule()
+        log.info(f"Загружено пользователей: {len(self.users)} (из журнала: {replayed} записей), "
+                 f"в очереди {len(self.heap)}")
+
+    def _read_snap_or_exit(self) -> UserTable:
+        # Битый снимок нельзя заменять пустой таблицей: бот решит, что пользователей нет, а первое же
+        # сжатие журнала перезапишет снимок одними новыми (state.json к этому времени уже .bak).
+        # Переносы в SQLite/state.bin тоже перенесли бы 0 пользователей — поэтому не стартуем вовсе
+        try:
+            return read_snap(self.snap_file)
+        except Exception as e:
+            backup = self.state_file + ".bak"
+            log.error(f"Снимок {self.snap_file} не читается: {e}. Бот остановлен, чтобы не затереть состояние")
+            if os.path.exists(backup):
+                log.error(f"Откат: переименуй {backup} в {os.path.basename(self.state_file)} и убери "
+                          f"{os.path.basename(self.snap_file)} — загрузится прежний state.json и журнал "
+                          f"{self.journal_file} (изменения между последним state.json и журналом потеряются)")
+            raise SystemExit(1)
+
+    def _replay_journal(self) -> int:
+        # Каждая запись журнала — полное состояние пользователя, поэтому повторное применение безопасно.
+        # Возвращает число применённых записей
+        try:
+            if not os.path.exists(self.journal_file):
+                return 0
+            with open(self.journal_file, "rb") as f:
+                raw = f.read()
+        except Exception as e:
+            log.warning(f"Не удалось прочитать журнал: {e}")
+            return 0
+        if not raw:
+            return 0
+        if not raw.startswith(JOURNAL_HEADER):
+            # чужой или испорченный файл: пропустить его — значит молча потерять изменения после снимка,
+            # а первое же сжатие перезапишет журнал. Как и с битым снимком, не стартуем
+            log.error(f"Журнал {self.journal_file} не читается: нет заголовка {JOURNAL_HEADER.strip().decode()}. "
+                      f"Бот остановлен, чтобы не затереть состояние")
+            raise SystemExit(1)
+        body = raw[len(JOURNAL_HEADER):]
+        end = len(body) - len(body) % _JREC_SIZE
+        if end < len(body):
+            # оборванная последняя запись (сбой посреди записи): отрезаем, иначе следующие
+            # дописанные записи съедут
+            log.warning("Журнал оборван на последней записи — отрезаю её")
+            body = body[:end]
+            try:
+                os.truncate(self.journal_file, len(JOURNAL_HEADER) + end)
+            except OSError as e:
+                log.warning(f"Не удалось обрезать журнал: {e}")
+        vals = array("q")
+        vals.frombytes(body)
+        if sys.byteorder != "little":
+            vals.byteswap()
+        ids, steps, lasts = vals[0::3], vals[1::3], vals[2::3]
+        if steps and (min(steps) < 0 or max(steps) > 255 or min(lasts) < 0 or max(lasts) > 0xFFFFFFFF):
+            log.warning("В журнале есть записи с недопустимыми значениями — пропускаю их")
+            good = [k for k in range(len(ids)) if 0 <= steps[k] <= 255 and 0 <= lasts[k] <= 0xFFFFFFFF]
+            ids, steps, lasts = ([col[k] for k in good] for col in (ids, steps, lasts))
+        self.users.set_many(ids, steps, lasts)
+        return len(ids)
+
+    def _reschedule(self) -> None:
+        self.heap = []
+        for cid, step, last in self.users:
+            due = self.due_ts(step, last)
+            if due is not None and cid not in self.blocked:
+                self.heap.append((due, cid))
+        heapq.heapify(self.heap)
+        self.stats["heap"] = len(self.heap)
+
+    # --- чтение/запись ---
+    def get(self, chat_id: int) -> Optional[Tuple[int, float]]:
+        return self.users.get(chat_id)
+
+    def put(self, chat_id: int, step: int, last: float) -> None:
+        last = int(last)  # в таблице — целые секунды; расписание считаем от того же значения
+        old = self.users.get(chat_id)
+        if self.order is not None:
+            self.order.update(chat_id, old, step, last)
+        self._count(old[0] if old else None, step)
+        self.users.set(chat_id, step, last)
+        self._clear_block(chat_id)
+        due = self.due_ts(step, last)
+        if due is not None:
+            heapq.heappush(self.heap, (due, chat_id))
+            self.stats["heap"] = len(self.heap)
+        self.dirty.add(chat_id)
+        self.stats["marks"] += 1
+        if len(self.dirty) >= self.max_dirty:
+            self.flush()
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def iter_users(self, step: Optional[int] = None) -> Iterator[Tuple[int, int, float]]:
+        # Итерация идёт по текущим колонкам: put() во время обхода не ломает его
+        return iter(self.users) if step is None else self.users.with_step(step)
+
+    def page(self, cursor: Optional[Tuple[int, int, float]], limit: int, step: Optional[int] = None,
+             backward: bool = False) -> List[Tuple[int, int, float]]:
+        if self.order is None:
+            self.order = OrderIndex(self.users.copy())
+        return page_keys(self.order.get(), cursor, limit, step, backward)
+
+    def page_ready(self) -> bool:
+        if self.order is None:
+            self.order = OrderIndex(self.users.copy())
+        return self.order.ready()
+
+    # --- расписание ---
+    def pop_due(self, now: float, shards: Shards = None) -> List[Tuple[int, int]]:
+        if shards is not None:
+            raise ValueError("JsonStore живёт в одном процессе — для шардов нужен SqliteStore")
+        due: List[Tuple[int, int]] = []
+        popped = 0
+        while self.heap and self.heap[0][0] <= now:
+            ts, cid = heapq.heappop(self.heap)
+            popped += 1
+            st = self.users.get(cid)
+            # запись устарела: пользователь уже продвинулся (/next), прошёл все уроки или заблокировал бота
+            if st is None or self.due_ts(*st) != ts or cid in self.blocked:
+                self.stats["stale_total"] += 1
+                continue
+            due.append((cid, st[0]))
+        self.stats["heap"] = len(self.heap)
+        self._record_pop(popped, len(due))
+        return due
+
+    def next_due(self, shards: Shards = None) -> Optional[float]:
+        if shards is not None:
+            raise ValueError("JsonStore живёт в одном процессе — для шардов нужен SqliteStore")
+        return self.heap[0][0] if self.heap else None
+
+    # --- сброс на диск ---
+    def _snapshot(self) -> UserTable:
+        # Копия колонок — быстрое копирование памяти; JSON из неё собирается уже в _write_snapshot
+        return self.users.copy()
+
+    def _write_snapshot(self, table: UserTable) -> int:
+        written = write_snap(self.snap_file, table)
+        if os.path.exists(self.state_file):
+            # дальше он бы только устаревал; оставляем копию для отката на прежнюю версию бота
+            os.replace(self.state_file, self.state_file + ".bak")
+            log.info(f"Состояние теперь в {self.snap_file}, {self.state_file} переименован в .bak")
+        return written
+
+    def save(self) -> Optional[int]:
+        # Полный снимок синхронно (журнал при этом больше не нужен)
+        try:
+            written = self._write_snapshot(self._snapshot())
+            atomic_write(self.journal_file, JOURNAL_HEADER)
+            self.dirty.clear()
+            return written
+        except Exception as e:
+            log.warning(f"Не удалось сохранить состояние: {e}")
+            return None
+
+    def flush(self) -> None:
+        self._save_blocked()
+        if not self.dirty:
+            return
+        t0 = time.perf_counter()
+        rows = []
+        for cid in self.dirty:
+            st = self.users.get(cid)
+            if st is not None:
+                rows.append((cid, st[0], st[1]))
+        data = journal_records(rows)
+        try:
+            with open(self.journal_file, "ab") as f:
+                if f.tell() == 0:
+                    f.write(JOURNAL_HEADER)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                journal_size = f.tell()
+        except Exception as e:
+            log.warning(f"Не удалось дописать журнал: {e}")
+            return  # dirty не чистим — попробуем при следующем сбросе
+        self.dirty.clear()
+        self._record_flush(t0, len(data))
+        self.stats["last_bytes"] = len(data)
+        self.stats["bytes_total"] += len(data)
+        self.stats["journal_bytes"] = journal_size
+        self._maybe_compact(journal_size)
+
+    def _maybe_compact(self, journal_size: int) -> None:
+        if self._compacting:
+            return
+        snap_size = os.path.getsize(self.snap_file) if os.path.exists(self.snap_file) else 0
+        if journal_size < max(self.compact_min, self.compact_ratio * snap_size):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()  # вне event loop (например, при остановке) — просто пишем снимок
+            return
+        # Копия состояния снимается здесь, в потоке loop: всё, что в журнале до offset, в неё уже вошло
+        self._compacting = True
+        out, offset, t0 = self._snapshot(), journal_size, time.perf_counter()
+        fut = loop.run_in_executor(None, self._write_snapshot, out)
+        fut.add_done_callback(lambda f: self._finish_compact(f, offset, t0))
+
+    def _finish_compact(self, fut: "asyncio.Future[int]", offset: int, t0: float) -> None:
+        # Выполняется в потоке loop, поэтому конкурентных дописываний журнала нет
+        self._compacting = False
+        if fut.exception() is not None:
+            log.warning(f"Не удалось сжать журнал: {fut.exception()}")
+            return
+        try:
+            # Оставляем только хвост, дописанный пока писался снимок. Падение до этой строки
+            # безопасно: старые записи журнала просто переиграются поверх нового снимка
+            with open(self.journal_file, "rb") as f:
+                f.seek(offset)
+                tail = JOURNAL_HEADER + f.read()
+            atomic_write(self.journal_file, tail)
+        except Exception as e:
+            log.warning(f"Не удалось обрезать журнал: {e}")
+            return
+        ms = (time.perf_counter() - t0) * 1000
+        self.stats["compactions"] += 1
+        self.stats["last_compact_ms"] = ms
+        self.stats["journal_bytes"] = len(tail)
+        log.info(f"Журнал сжат: снимок {fut.result()} байт за {ms:.0f} мс, хвост {len(tail)} байт")
+
+
+# ===== Бинарный файл фиксированных записей в mmap =====
+_REC = struct.Struct("<qBII")  # chat_id, step, last, crc32 первых трёх — 17 байт на слот
+_REC_BODY = struct.Struct("<qBI")
+_KEY = struct.Struct("<q")
+_VAL = struct.Struct("<BII")
+_HEADER = struct.Struct("<8sIIQQ")  # магия, версия, флаги, слотов, пользователей
+_FIB = 0x9E3779B97F4A7C15  # мультипликативный хэш (Фибоначчи) для номера слота
+
+
+def _rec_crc(chat_id: int, step: int, last: int) -> int:
+    return zlib.crc32(_REC_BODY.pack(chat_id, step, last))
+
+
+class MmapStore(Store):
+    # state.bin: заголовок HEADER_SIZE байт + capacity слотов <qBII (chat_id 0 — пустой слот).
+    # Открытая адресация с линейным пробированием; пользователи не удаляются, поэтому без надгробий.
+    # Смена урока — запись 9 байт на месте (step, last, crc), новый пользователь — 17 байт (ключ
+    # пишется последним). crc32 записи нужен пересборке: мусор оборванной страницы отличим от данных;
+    # flush() — msync. Флаг DIRTY в заголовке ставится (и сбрасывается на диск) до первой записи
+    # после сброса и снимается после msync: если при открытии он стоит, процесс упал между сбросами —
+    # таблица пересобирается из уцелевших записей (_recover).
+    # Старт — только mmap; куча расписания и счётчики по урокам строятся в фоновом потоке по копии
+    # таблицы, а put() на это время пишутся в список и применяются поверх (_index)
+    MAGIC = b"BOTSTATE"
+    VERSION = 1
+    HEADER_SIZE = 64
+    FLAG_DIRTY = 1
+    MIN_CAPACITY = 1 << 12
+    MAX_LOAD = 0.5
+
+    def __init__(self, path: str, interval: float, max_step: int, max_dirty: int = 500,
+                 migrate_from: Optional[JsonStore] = None) -> None:
+        super().__init__(interval, max_step)
+        self.path = path
+        self.blocked_file = os.path.splitext(path)[0] + ".blocked"
+        self.max_dirty = max_dirty
+        self.migrate_from = migrate_from
+        self.file: Optional[IO[bytes]] = None
+        self.mm: Optional[mmap.mmap] = None
+        self.capacity = 0
+        self.count = 0
+        self.is_dirty = False  # флаг DIRTY уже стоит в файле
+        self.pending = 0       # записей с последнего msync
+        self.heap: List[Tuple[float, int]] = []
+        self.order: Optional[OrderIndex] = None
+        self._index_thread: Optional[threading.Thread] = None
+        self._index_result: Optional[Tuple[List[Tuple[float, int]], Dict[int, int]]] = None
+        self._index_log: List[Tuple[int, Optional[int], int, int]] = []  # put() во время построения
+        self.stats.update({"heap": 0, "stale_total": 0, "capacity": 0, "recovered": 0, "index_ms": 0.0})
+
+    # --- файл ---
+    def _slot_bits(self) -> int:
+        return self.capacity.bit_length() - 1
+
+    def _create(self, path: str, capacity: int, rows: Iterable[Tuple[int, int, int]]) -> int:
+        # Новый файл целиком (рядом, затем os.replace): при падении посередине старый цел
+        tmp = path + ".tmp"
+        n = 0
+        with open(tmp, "w+b") as f:
+            f.truncate(self.HEADER_SIZE + capacity * _REC.size)
+            mm = mmap.mmap(f.fileno(), 0)
+            mask, shift = capacity - 1, 64 - (capacity.bit_length() - 1)
+            for cid, step, last in rows:
+                i = ((cid * _FIB) & 0xFFFFFFFFFFFFFFFF) >> shift
+                while True:
+                    off = self.HEADER_SIZE + i * _REC.size
+                    k = _KEY.unpack_from(mm, off)[0]
+                    if k == 0:
+                        _REC.pack_into(mm, off, cid, step, last, _rec_crc(cid, step, last))
+                        n += 1
+                        break
+                    if k == cid:
+                        # повтор — берём более позднюю запись
+                        _VAL.pack_into(mm, off + 8, step, last, _rec_crc(cid, step, last))
+                        break
+                    i = (i + 1) & mask
+            _HEADER.pack_into(mm, 0, self.MAGIC, self.VERSION, 0, capacity, n)
+            mm.flush()
+            mm.close()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return n
+
+    def _capacity_for(self, n: int) -> int:
+        cap = self.MIN_CAPACITY
+        while n > cap * self.MAX_LOAD:
+            cap <<= 1
+        return cap
+
+    def _open(self) -> None:
+        self.file = open(self.path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, version, flags, capacity, count = _HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"{self.path}: не файл состояния (или версия {version} неизвестна)")
+        if capacity & (capacity - 1) or len(self.mm) != self.HEADER_SIZE + capacity * _REC.size:
+            raise ValueError(f"{self.path}: размер не сходится с заголовком (слотов {capacity})")
+        self.capacity, self.count = capacity, count
+        self.is_dirty = bool(flags & self.FLAG_DIRTY)
+        self.stats["capacity"] = capacity
+
+    def _close_map(self) -> None:
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _records(self) -> Iterator[Tuple[int, int, int]]:
+        # По копии таблицы: put() и рост файла во время обхода его не ломают
+        raw = self.mm[self.HEADER_SIZE:]
+        return ((cid, step, last) for cid, step, last, _ in _REC.iter_unpack(raw) if cid)
+
+    def _plausible(self, cid: int, step: int, last: int) -> bool:
+        # Такую запись бот мог записать: урок 1..max_step, last не 0 (put() пишет время выдачи) и не из будущего
+        return 1 <= step <= self.max_step and 0 < last <= time.time() + 86400
+
+    def _recover(self) -> None:
+        # Процесс упал между сбросами: пересобираем таблицу из читаемых записей, цепочки пробирования
+        # строим заново. Мусор оборванной записи страницы выглядит как занятые слоты со случайными
+        # chat_id — отбрасываем записи с неверным crc и те, что бот записать не мог (_plausible)
+        t0 = time.perf_counter()
+        raw = self.mm[self.HEADER_SIZE:]
+        found = [r for r in _REC.iter_unpack(raw) if r[0]]
+        rows = [(cid, step, last) for cid, step, last, crc in found
+                if crc == _rec_crc(cid, step, last) and self._plausible(cid, step, last)]
+        dropped = len(found) - len(rows)
+        self._close_map()
+        n = self._create(self.path, self._capacity_for(len(rows)), rows)
+        self._open()
+        self.stats["recovered"] += 1
+        log.warning(f"{self.path}: файл не был закрыт штатно — пересобран за "
+                    f"{(time.perf_counter() - t0) * 1000:.0f} мс, пользователей {n}, отброшено {dropped}")
+
+    def _migrate(self, src: JsonStore) -> int:
+        # Одноразовый перенос из снимка JsonStore + журнала; их файлы остаются как резервная копия
+        src.load()
+        n = self._create(self.path, self._capacity_for(len(src)),
+                         ((cid, step, int(last)) for cid, step, last in src.iter_users()))
+        if src.blocked - self.blocked:
+            self.blocked |= src.blocked
+            self._blocked_dirty = True
+        log.info(f"state.bin: перенесено из JSON {n} пользователей")
+        return n
+
+    def load(self) -> None:
+        t0 = time.perf_counter()
+        self._close_map()
+        self._load_blocked()
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            if self.migrate_from is not None:
+                self._migrate(self.migrate_from)
+            else:
+                self._create(self.path, self.MIN_CAPACITY, ())
+        self._open()
+        if self.is_dirty:
+            self._recover()
+        self.order = None
+        self._start_index()
+        log.info(f"state.bin: пользователей {self.count}, слотов {self.capacity}, "
+                 f"открыт за {(time.perf_counter() - t0) * 1000:.0f} мс")
+
+    # --- расписание и счётчики: строятся в фоне ---
+    def _start_index(self) -> None:
+        raw = self.mm[self.HEADER_SIZE:]  # копия памяти — миллисекунды даже на миллион слотов
+        self._index_log = []
+        self._index_result = None
+        self._index_thread = threading.Thread(target=self._build_index, args=(raw, frozenset(self.blocked)),
+                                              name="state-index", daemon=True)
+        self._index_thread.start()
+
+    def _build_index(self, raw: bytes, blocked: FrozenSet[int]) -> None:
+        t0 = time.perf_counter()
+        heap: List[Tuple[float, int]] = []
+        counts: Dict[int, int] = {}
+        for cid, step, last, _ in _REC.iter_unpack(raw):
+            if not cid:
+                continue
+            counts[step] = counts.get(step, 0) + 1
+            due = self.due_ts(step, last)
+            if due is not None and cid not in blocked:
+                heap.append((due, cid))
+        heapq.heapify(heap)
+        self.stats["index_ms"] = (time.perf_counter() - t0) * 1000
+        self._index_result = (heap, counts)
+
+    def _index(self) -> None:
+        # Дождаться фонового построения и применить put(), сделанные за это время
+        if self._index_thread is None:
+            return
+        self._index_thread.join()
+        self._index_thread = None
+        self.heap, self.counts = self._index_result
+        self._index_result = None
+        for cid, old_step, step, last in self._index_log:
+            self._count(old_step, step)
+            due = self.due_ts(step, last)
+            if due is not None:
+                heapq.heappush(self.heap, (due, cid))
+        self._index_log = []
+        self.stats["heap"] = len(self.heap)
+        log.info(f"state.bin: расписание {len(self.heap)} построено за {self.stats['index_ms']:.0f} мс")
+
+    def _reschedule(self) -> None:
+        self._index()
+        self.heap = []
+        for cid, step, last in self._records():
+            due = self.due_ts(step, last)
+            if due is not None and cid not in self.blocked:
+                self.heap.append((due, cid))
+        heapq.heapify(self.heap)
+        self.stats["heap"] = len(self.heap)
+
+    # --- чтение/запись ---
+    def _probe(self, chat_id: int) -> Tuple[int, bool]:
+        # (смещение слота, найден ли): свой слот или первый пустой на пути пробирования
+        mm, mask = self.mm, self.capacity - 1
+        i = ((chat_id * _FIB) & 0xFFFFFFFFFFFFFFFF) >> (64 - self._slot_bits())
+        while True:
+            off = self.HEADER_SIZE + i * _REC.size
+            k = _KEY.unpack_from(mm, off)[0]
+            if k == chat_id:
+                return off, True
+            if k == 0:
+                return off, False
+            i = (i + 1) & mask
+
+    def get(self, chat_id: int) -> Optional[Tuple[int, float]]:
+        off, found = self._probe(chat_id)
+        return _VAL.unpack_from(self.mm, off + 8)[:2] if found else None
+
+    def _mark_dirty(self) -> None:
+        # Флаг — на диск раньше данных: после сбоя ОС незаписанный флаг с изменёнными данными невозможен
+        if self.is_dirty:
+            return
+        _HEADER.pack_into(self.mm, 0, self.MAGIC, self.VERSION, self.FLAG_DIRTY, self.capacity, self.count)
+        self.mm.flush(0, mmap.PAGESIZE)
+        self.is_dirty = True
+
+    def _grow(self) -> None:
+        t0 = time.perf_counter()
+        self.flush()
+        rows = list(self._records())
+        self._close_map()
+        self._create(self.path, self.capacity * 2, rows)
+        self._open()
+        self.stats["capacity"] = self.capacity
+        log.info(f"state.bin: слотов {self.capacity} (перестроено за {(time.perf_counter() - t0) * 1000:.0f} мс)")
+
+    def put(self, chat_id: int, step: int, last: float) -> None:
+        last = int(last)
+        off, found = self._probe(chat_id)
+        old = _VAL.unpack_from(self.mm, off + 8)[:2] if found else None
+        if not found and self.count + 1 > self.capacity * self.MAX_LOAD:
+            self._grow()
+            off, _ = self._probe(chat_id)
+        self._mark_dirty()
+        _VAL.pack_into(self.mm, off + 8, step, last, _rec_crc(chat_id, step, last))
+        if not found:
+            _KEY.pack_into(self.mm, off, chat_id)  # ключ последним: слот появляется уже заполненным
+            self.count += 1
+            _HEADER.pack_into(self.mm, 0, self.MAGIC, self.VERSION, self.FLAG_DIRTY, self.capacity, self.count)
+        self._clear_block(chat_id)
+        if self.order is not None:
+            self.order.update(chat_id, old, step, last)
+        if self._index_thread is not None:
+            self._index_log.append((chat_id, old[0] if old else None, step, last))
+        else:
+            self._count(old[0] if old else None, step)
+            due = self.due_ts(step, last)
+            if due is not None:
+                heapq.heappush(self.heap, (due, chat_id))
+                self.stats["heap"] = len(self.heap)
+        self.pending += 1
+        self.stats["marks"] += 1
+        if self.pending >= self.max_dirty:
+            self.flush()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def count_by_step(self) -> Dict[int, int]:
+        self._index()
+        return super().count_by_step()
+
+    def iter_users(self, step: Optional[int] = None) -> Iterator[Tuple[int, int, float]]:
+        rows = self._records()
+        return rows if step is None else (r for r in rows if r[1] == step)
+
+    def page(self, cursor: Optional[Tuple[int, int, float]], limit: int, step: Optional[int] = None,
+             backward: bool = False) -> List[Tuple[int, int, float]]:
+        if self.order is None:
+            self.order = OrderIndex(self._records())
+        return page_keys(self.order.get(), cursor, limit, step, backward)
+
+    def page_ready(self) -> bool:
+        if self.order is None:
+            self.order = OrderIndex(self._records())
+        return self.order.ready()
+
+    # --- расписание ---
+    def pop_due(self, now: float, shards: Shards = None) -> List[Tuple[int, int]]:
+        if shards is not None:
+            raise ValueError("state.bin открывает один процесс — для шардов нужен SqliteStore")
+        self._index()
+        due: List[Tuple[int, int]] = []
+        popped = 0
+        while self.heap and self.heap[0][0] <= now:
+            ts, cid = heapq.heappop(self.heap)
+            popped += 1
+            st = self.get(cid)
+            if st is None or self.due_ts(*st) != ts or cid in self.blocked:
+                self.stats["stale_total"] += 1
+                continue
+            due.append((cid, st[0]))
+        self.stats["heap"] = len(self.heap)
+        self._record_pop(popped, len(due))
+        return due
+
+    def next_due(self, shards: Shards = None) -> Optional[float]:
+        if shards is not None:
+            raise ValueError("state.bin открывает один процесс — для шардов нужен SqliteStore")
+        self._index()
+        return self.heap[0][0] if self.heap else None
+
+    # --- сброс на диск ---
+    def flush(self) -> None:
+        self._save_blocked()
+        if not self.is_dirty or self.mm is None:
+            return
+        t0 = time.perf_counter()
+        try:
+            self.mm.flush()
+            _HEADER.pack_into(self.mm, 0, self.MAGIC, self.VERSION, 0, self.capacity, self.count)
+            self.mm.flush(0, mmap.PAGESIZE)
+        except Exception as e:
+            log.warning(f"Не удалось сбросить {self.path}: {e}")
+            return
+        nbytes = self.pending * _REC.size
+        self.is_dirty = False
+        self.pending = 0
+        self._record_flush(t0, nbytes)
+
+    def close(self) -> None:
+        if self._index_thread is not None:
+            self._index_thread.join()
+        self.flush()
+        self._close_map()
+
+
+# ===== SQLite: индексы по step и времени выдачи =====
+class SqliteStore(Store):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            step    INTEGER NOT NULL,
+            last    REAL    NOT NULL,
+            due     REAL,           -- NULL: выдача не запланирована (всё выдано или урок уже в работе)
+            blocked INTEGER NOT NULL DEFAULT 0  -- 1: заблокировал бота, due NULL до put()/unblock()
+        );
+        CREATE INDEX IF NOT EXISTS users_step ON users(step, last);
+        CREATE INDEX IF NOT EXISTS users_due ON users(due) WHERE due IS NOT NULL;
+    """
+
+    # shared=True — базу одновременно используют несколько процессов (шардированная рассылка):
+    # каждое изменение коммитится сразу (иначе открытая транзакция держит блокировку записи),
+    # счётчики по урокам читаются из базы, а забранные другими процессами строки не трогаем
+    def __init__(self, db_file: str, interval: float, max_step: int, max_dirty: int = 500,
+                 migrate_from: Optional[JsonStore] = None, shared: bool = False) -> None:
+        super().__init__(interval, max_step)
+        self.db_file = db_file
+        self.shared = shared
+        self.max_dirty = 1 if shared else max_dirty
+        self.migrate_from = migrate_from
+        self.pending = 0  # изменений в незакоммиченной транзакции
+        self.stats["pending"] = 0
+        self.db = sqlite3.connect(db_file, timeout=30 if shared else 5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def load(self) -> None:
+        total = self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if total == 0 and self.migrate_from is not None:
+            total = self._migrate(self.migrate_from)
+        self.counts = dict(self.db.execute("SELECT step, COUNT(*) FROM users GROUP BY step").fetchall())
+        if not self.shared:
+            self._reschedule()  # в общей базе — по частям, когда их получает процесс (reschedule_shard)
+        log.info(f"SQLite: пользователей {total} ({self.db_file})")
+
+    def _reschedule(self) -> None:
+        # Забранные pop_due, но не выданные до остановки, и дошедшие до конца старого каталога —
+        # возвращаем в расписание
+        self.db.execute(
+            "UPDATE users SET due = CASE WHEN last > 0 THEN last + ? ELSE 0 END "
+            "WHERE due IS NULL AND step < ? AND NOT blocked",
+            (self.interval, self.max_step),
+        )
+        self.db.commit()
+
+    def set_max_step(self, max_step: int) -> None:
+        if self.shared and max_step > self.max_step:
+            # строки с due NULL и step < старого max — в работе у других процессов; возвращаем в
+            # расписание только дошедших до конца старого каталога
+            self.db.execute(
+                "UPDATE users SET due = CASE WHEN last > 0 THEN last + ? ELSE 0 END "
+                "WHERE due IS NULL AND step >= ? AND step < ? AND NOT blocked",
+                (self.interval, self.max_step, max_step),
+            )
+            self.db.commit()
+            self.max_step = max_step
+            return
+        super().set_max_step(max_step)
+
+    def reschedule_shard(self, shard: int, shards: int) -> int:
+        # Часть перешла к этому процессу: забранное прежним владельцем, но не выданное — снова в расписание
+        cur = self.db.execute(
+            "UPDATE users SET due = CASE WHEN last > 0 THEN last + ? ELSE 0 END "
+            "WHERE due IS NULL AND step < ? AND NOT blocked AND ((chat_id % ?) + ?) % ? = ?",
+            (self.interval, self.max_step, shards, shards, shards, shard),
+        )
+        self.db.commit()
+        return cur.rowcount
+
+    def reschedule_user(self, chat_id: int) -> None:
+        # Забранный pop_due, но не выданный (часть не отдавали, аренда просто не продлилась вовремя)
+        row = self.db.execute("SELECT step, last FROM users WHERE chat_id = ? AND due IS NULL AND NOT blocked",
+                              (chat_id,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("UPDATE users SET due = ? WHERE chat_id = ?", (self.due_ts(row[0], row[1]), chat_id))
+        self._changed()
+
+    @staticmethod
+    def _shard_sql(shards: Shards) -> Tuple[str, List[int]]:
+        if shards is None:
+            return "", []
+        n, own = shards
+        return (f" AND ((chat_id % ?) + ?) % ? IN ({','.join('?' * len(own))})", [n, n, n] + list(own))
+
+    def _migrate(self, src: JsonStore) -> int:
+        # Одноразовый перенос из снимка JsonStore + журнала; их файлы остаются как резервная копия
+        src.load()
+        rows = [(cid, step, last, self.due_ts(step, last)) for cid, step, last in src.iter_users()]
+        self.db.executemany("INSERT OR REPLACE INTO users(chat_id, step, last, due) VALUES (?, ?, ?, ?)", rows)
+        self.db.executemany("UPDATE users SET blocked = 1, due = NULL WHERE chat_id = ?",
+                            [(cid,) for cid in src.blocked])
+        self.db.commit()
+        log.info(f"SQLite: перенесено из JSON {len(rows)} пользователей")
+        return len(rows)
+
+    def get(self, chat_id: int) -> Optional[Tuple[int, float]]:
+        row = self.db.execute("SELECT step, last FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, chat_id: int, step: int, last: float) -> None:
+        if not self.shared:  # в общей базе счётчики читаются из неё (count_by_step)
+            old = self.db.execute("SELECT step FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+            self._count(old[0] if old else None, step)
+        self.db.execute(
+            "INSERT OR REPLACE INTO users(chat_id, step, last, due) VALUES (?, ?, ?, ?)",
+            (chat_id, step, last, self.due_ts(step, last)),
+        )  # REPLACE ставит blocked по умолчанию (0): put() снимает блокировку
+        self._changed()
+
+    def block(self, chat_id: int) -> None:
+        self.db.execute("UPDATE users SET blocked = 1, due = NULL WHERE chat_id = ?", (chat_id,))
+        self._changed()
+
+    def unblock(self, chat_id: int) -> bool:
+        row = self.db.execute("SELECT step, last FROM users WHERE chat_id = ? AND blocked", (chat_id,)).fetchone()
+        if row is None:
+            return False
+        self.db.execute("UPDATE users SET blocked = 0, due = ? WHERE chat_id = ?",
+                        (self.due_ts(row[0], row[1]), chat_id))
+        self._changed()
+        return True
+
+    def _changed(self) -> None:
+        self.pending += 1
+        self.stats["marks"] += 1
+        self.stats["pending"] = self.pending
+        if self.pending >= self.max_dirty:
+            self.flush()
+
+    def __len__(self) -> int:
+        if self.shared:
+            return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return sum(self.counts.values())
+
+    def count_by_step(self) -> Dict[int, int]:
+        if self.shared:
+            # put() делают и другие процессы — свои счётчики были бы неполными
+            return dict(self.db.execute("SELECT step, COUNT(*) FROM users GROUP BY step").fetchall())
+        return super().count_by_step()
+
+    def iter_users(self, step: Optional[int] = None) -> Iterator[Tuple[int, int, float]]:
+        if step is None:
+            cur = self.db.execute("SELECT chat_id, step, last FROM users")
+        else:
+            cur = self.db.execute("SELECT chat_id, step, last FROM users WHERE step = ? ORDER BY last", (step,))
+        yield from cur
+
+    def page(self, cursor: Optional[Tuple[int, int, float]], limit: int, step: Optional[int] = None,
+             backward: bool = False) -> List[Tuple[int, int, float]]:
+        # Keyset-пагинация по индексу users_step(step, last) (+ chat_id = rowid)
+        op, order = ("<", "DESC") if backward else (">", "ASC")
+        where, args = [], []  # type: List[str], List[Any]
+        if step is not None:
+            where.append("step = ?")
+            args.append(step)
+        if cursor is not None:
+            cid, s, last = cursor
+            if step is not None:
+                where.append(f"(last, chat_id) {op} (?, ?)")
+                args += [last, cid]
+            else:
+                where.append(f"(step, last, chat_id) {op} (?, ?, ?)")
+                args += [s, last, cid]
+        sql = ("SELECT chat_id, step, last FROM users"
+               + (" WHERE " + " AND ".join(where) if where else "")
+               + f" ORDER BY step {order}, last {order}, chat_id {order} LIMIT ?")
+        rows = self.db.execute(sql, args + [limit]).fetchall()
+        return rows[::-1] if backward else rows
+
+    def pop_due(self, now: float, shards: Shards = None) -> List[Tuple[int, int]]:
+        if shards is not None and not shards[1]:
+            return []
+        if self.shared and not self.db.in_transaction:
+            # выборка и пометка — одной транзакцией: иначе put() другого процесса между ними потеряется
+            self.db.execute("BEGIN IMMEDIATE")
+        where, args = self._shard_sql(shards)
+        rows = self.db.execute(
+            "SELECT chat_id, step FROM users WHERE due IS NOT NULL AND due <= ?" + where + " ORDER BY due",
+            [now] + args,
+        ).fetchall()
+        if rows:
+            self.db.executemany("UPDATE users SET due = NULL WHERE chat_id = ?", [(cid,) for cid, _ in rows])
+            self.pending += len(rows)
+            if self.pending >= self.max_dirty:
+                self.flush()
+        elif self.shared:
+            self.db.commit()  # пусто — отпускаем блокировку записи, взятую BEGIN IMMEDIATE
+        self._record_pop(len(rows), len(rows))
+        return [(cid, step) for cid, step in rows]
+
+    def next_due(self, shards: Shards = None) -> Optional[float]:
+        if shards is None:
+            return self.db.execute("SELECT MIN(due) FROM users WHERE due IS NOT NULL").fetchone()[0]
+        if not shards[1]:
+            return None
+        # ORDER BY + LIMIT идёт по индексу users_due до первой подходящей строки
+        where, args = self._shard_sql(shards)
+        row = self.db.execute(
+            "SELECT due FROM users WHERE due IS NOT NULL" + where + " ORDER BY due LIMIT 1", args
+        ).fetchone()
+        return row[0] if row else None
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        t0 = time.perf_counter()
+        try:
+            self.db.commit()
+        except Exception as e:
+            log.warning(f"Не удалось записать state.db: {e}")
+            return
+        self.pending = 0
+        self.stats["pending"] = 0
+        self._record_flush(t0)
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Счётчики событий по часам и по дням (старты, выданные уроки) для трендов в /stats.
+# Кольцевые буферы фиксированного размера: добавление O(1), память не растёт;
+# сохраняются в DATA_DIR/timeseries.json при плановом сбросе состояния.
+
+import os
+import json
+import time
+import fcntl
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from storage import atomic_write
+
+log = logging.getLogger("bot.timeseries")
+
+HOURS = 24 * 7  # почасовые — за неделю
+DAYS = 90       # по дням — за три месяца
+
+
+def _local(ts: float) -> float:
+    # Границы суток — по местному времени процесса (TZ), а не по UTC
+    return ts + time.localtime(ts).tm_gmtoff
+
+
+class RingSeries:
+    # counts[b % size] — число событий в корзине b (b = местное время // width);
+    # head — последняя корзина, до которой буфер «докручен» (промежуточные обнулены)
+    def __init__(self, width: int, size: int) -> None:
+        self.width = width
+        self.size = size
+        self.counts: List[int] = [0] * size
+        self.head = -1
+
+    def _advance(self, b: int) -> None:
+        if b <= self.head:
+            return
+        if self.head < 0 or b - self.head >= self.size:
+            self.counts = [0] * self.size
+        else:
+            for k in range(self.head + 1, b + 1):
+                self.counts[k % self.size] = 0
+        self.head = b
+
+    def add(self, ts: float, n: int = 1) -> None:
+        b = int(_local(ts) // self.width)
+        self._advance(b)
+        if b > self.head - self.size:  # слишком старые события (вне окна) отбрасываем
+            self.counts[b % self.size] += n
+
+    def last(self, n: int, now: float) -> List[Tuple[float, int]]:
+        # [(начало корзины — unix-время, число)] за последние n корзин, от старых к новым
+        self._advance(int(_local(now) // self.width))
+        n = min(n, self.size)
+        offset = time.localtime(now).tm_gmtoff
+        return [(b * self.width - offset, self.counts[b % self.size]) for b in range(self.head - n + 1, self.head + 1)]
+
+    def to_json(self) -> Dict[str, object]:
+        return {"width": self.width, "head": self.head, "counts": self.counts}
+
+    def from_json(self, raw: Dict[str, object]) -> None:
+        counts = raw.get("counts")
+        if raw.get("width") == self.width and isinstance(counts, list) and len(counts) == self.size:
+            self.counts = [int(c) for c in counts]
+            self.head = int(raw.get("head", -1))
+
+
+class TimeSeries:
+    # shared=True — файл пишут несколько процессов (шардированная рассылка): при save() под flock
+    # перечитываем файл и добавляем к нему свои события с прошлого сохранения
+    def __init__(self, path: str, names: Tuple[str, ...], shared: bool = False) -> None:
+        self.path = path
+        self.names = names
+        self.shared = shared
+        self.series: Dict[str, Dict[str, RingSeries]] = {}
+        self._reset()
+        self.pending: List[Tuple[str, int, float]] = []  # события после последнего save() (только shared)
+        self.dirty = False
+
+    def _reset(self) -> None:
+        self.series = {
+            name: {"hour": RingSeries(3600, HOURS), "day": RingSeries(86400, DAYS)} for name in self.names
+        }
+
+    def add(self, name: str, n: int = 1, ts: Optional[float] = None) -> None:
+        ts = time.time() if ts is None else ts
+        for ring in self.series[name].values():
+            ring.add(ts, n)
+        if self.shared:
+            self.pending.append((name, n, ts))
+        self.dirty = True
+
+    def hours(self, name: str, n: int = 24) -> List[Tuple[float, int]]:
+        return self.series[name]["hour"].last(n, time.time())
+
+    def days(self, name: str, n: int = 30) -> List[Tuple[float, int]]:
+        return self.series[name]["day"].last(n, time.time())
+
+    def load(self) -> None:
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    raw = json.load(f)
+                for name, rings in self.series.items():
+                    for kind, ring in rings.items():
+                        ring.from_json(raw.get(name, {}).get(kind, {}))
+        except Exception as e:
+            log.warning(f"Не удалось загрузить {self.path}: {e}")
+
+    def save(self) -> None:
+        if self.shared:
+            self._sync()
+            return
+        if not self.dirty:
+            return
+        try:
+            self._write()
+            self.dirty = False
+        except Exception as e:
+            log.warning(f"Не удалось сохранить {self.path}: {e}")
+
+    def _write(self) -> None:
+        data = {name: {kind: ring.to_json() for kind, ring in rings.items()} for name, rings in self.series.items()}
+        atomic_write(self.path, json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+    def _sync(self) -> None:
+        # Даже без своих событий перечитываем файл — так /stats видит выдачи других процессов
+        try:
+            with open(self.path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._reset()
+                    self.load()
+                    for name, n, ts in self.pending:
+                        for ring in self.series[name].values():
+                            ring.add(ts, n)
+                    if self.pending:
+                        self._write()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            self.pending = []
+            self.dirty = False
+        except Exception as e:
+            log.warning(f"Не удалось сохранить {self.path}: {e}")
+
+
+def sparkline(values: List[int]) -> str:
+    bars = "▁▂▃▄▅▆▇█"
+    top = max(values) if values else 0
+    if not top:
+        return bars[0] * len(values)
+    return "".join(bars[min(len(bars) - 1, v * (len(bars) - 1) // top)] if v else " " for v in values)
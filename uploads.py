@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Заливка файлов в Telegram: потоком с диска и с ограничением одновременных заливок.
+#   StreamingInputFile — InputFile, который отдаёт httpx открытый файл, а не bytes: тело multipart
+#                        читается с диска кусками по 64 КБ (httpx FileField.CHUNK_SIZE)
+#   UploadGate         — не больше slots заливок сразу и не больше budget байт в полёте;
+#                        остальные ждут своей очереди (FIFO), файл больше бюджета идёт один
+
+import time
+import asyncio
+import logging
+import mimetypes
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import IO, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from telegram import InputFile
+
+log = logging.getLogger("bot.uploads")
+
+
+class StreamingInputFile(InputFile):
+    # InputFile(f) в PTB 20.7 читает файл целиком (load_file) — 1.5 ГБ видео = 1.5 ГБ в памяти
+    # на каждую заливку. Здесь в input_file_content лежит сам файл: field_tuple уходит в httpx
+    # как (имя, файл, mime), и httpx стримит его, а при повторе запроса перематывает seek(0)
+    def __init__(self, f: IO[bytes], filename: str, mimetype: Optional[str] = None) -> None:
+        super().__init__(b"", filename=filename)
+        self.input_file_content = f  # type: ignore[assignment]
+        self.mimetype = mimetype or mimetypes.guess_type(filename, strict=False)[0] or self.mimetype
+
+
+class UploadGate:
+    def __init__(self, slots: int, budget: int) -> None:
+        self.slots = max(1, slots)
+        self.budget = budget  # байт одновременно заливаемых файлов
+        self.active = 0
+        self.in_flight = 0
+        self.queue: Deque[Tuple[int, "asyncio.Future[None]"]] = deque()
+        self.stats: Dict[str, float] = {"uploads": 0, "queued": 0, "wait_s": 0.0}
+
+    def _fits(self, size: int) -> bool:
+        if self.active >= self.slots:
+            return False
+        return self.active == 0 or self.in_flight + size <= self.budget
+
+    def _grant(self, size: int) -> None:
+        self.active += 1
+        self.in_flight += size
+
+    def _release(self, size: int) -> None:
+        self.active -= 1
+        self.in_flight -= size
+        self._wake()
+
+    def _wake(self) -> None:
+        # Строго по очереди: маленькие файлы не обгоняют большой, иначе он может ждать вечно
+        while self.queue and self._fits(self.queue[0][0]):
+            size, fut = self.queue.popleft()
+            if fut.done():  # ожидающего отменили
+                continue
+            self._grant(size)
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, size: int,
+                   on_wait: Optional[Callable[[int], Awaitable[None]]] = None) -> AsyncIterator[None]:
+        # on_wait(место в очереди) вызывается, если сразу начать нельзя, — например, уведомить пользователя
+        if not self.queue and self._fits(size):
+            self._grant(size)
+        else:
+            fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+            entry = (size, fut)
+            self.queue.append(entry)
+            self.stats["queued"] += 1
+            t0 = time.monotonic()
+            try:
+                if on_wait is not None:
+                    try:
+                        await on_wait(len(self.queue))
+                    except Exception as e:
+                        log.warning(f"Не удалось уведомить об очереди на заливку: {e}")
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release(size)  # место выдали одновременно с отменой — возвращаем
+                else:
+                    fut.cancel()
+                    try:
+                        self.queue.remove(entry)
+                    except ValueError:
+                        pass
+                    self._wake()
+                raise
+            finally:
+                self.stats["wait_s"] += time.monotonic() - t0
+        self.stats["uploads"] += 1
+        try:
+            yield
+        finally:
+            self._release(size)